@@ -0,0 +1,65 @@
+"""
+Benchmark the sorted-search spike trialization (ingest.ephys.trialize_spikes)
+against the per-trial masking loop previously used in EphysIngest._load
+
+Usage:
+    python development/benchmark_trialize_spikes.py [trial_count] [spike_count] [unit_count]
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from pipeline.ingest.ephys import trialize_spikes
+
+
+def trialize_spikes_per_trial(spikes, units, trial_start, trial_go, unit_ids):
+    t, trial_spikes, trial_units = 0, [], []
+
+    while t < len(trial_start) - 1:
+        s0, s1 = trial_start[t], trial_start[t + 1]
+        trial_idx = np.where((spikes > s0) & (spikes < s1))
+        trial_spikes.append(spikes[trial_idx] - trial_go[t])
+        trial_units.append(units[trial_idx])
+        t += 1
+
+    trial_idx = np.where((spikes > trial_start[-1]))
+    trial_spikes.append(spikes[trial_idx] - trial_go[t])
+    trial_units.append(units[trial_idx])
+
+    return [[trial_spikes[t][np.where(trial_units[t] == u)]
+             for t in range(len(trial_start))] for u in unit_ids]
+
+
+def make_session(trial_count, spike_count, unit_count, hz=30000, trial_dur=6, seed=0):
+    rng = np.random.default_rng(seed)
+    trial_start = np.arange(trial_count) * trial_dur * hz + hz
+    trial_go = trial_start + 2.5 * hz
+    spikes = np.sort(rng.integers(0, (trial_count + 1) * trial_dur * hz, spike_count))
+    units = rng.integers(0, unit_count, spike_count)
+    return spikes, units, trial_start, trial_go
+
+
+def main(trial_count=500, spike_count=10000000, unit_count=400):
+    spikes, units, trial_start, trial_go = make_session(trial_count, spike_count, unit_count)
+    unit_ids = list(set(units))
+
+    print('{} trials - {} spikes - {} units'.format(trial_count, spike_count, unit_count))
+
+    t0 = time.time()
+    _, unit_trial_spikes = trialize_spikes(spikes, units, trial_start, trial_go, unit_ids=unit_ids)
+    t_sorted = time.time() - t0
+    print('sorted-search: {:.2f}s'.format(t_sorted))
+
+    t0 = time.time()
+    expected = trialize_spikes_per_trial(spikes, units, trial_start, trial_go, unit_ids)
+    t_loop = time.time() - t0
+    print('per-trial loop: {:.2f}s'.format(t_loop))
+
+    assert all(np.array_equal(a, b) for u_a, u_b in zip(unit_trial_spikes, expected) for a, b in zip(u_a, u_b))
+    print('identical results - speedup: {:.1f}x'.format(t_loop / t_sorted))
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
@@ -1,3 +1,4 @@
+import time
 import logging
 
 import numpy as np
@@ -8,7 +9,6 @@ import scipy.io as scio
 
 import nrrd
 
-from . import InsertBuffer
 from . import get_schema_name
 
 schema = dj.schema(get_schema_name('ccf'))
@@ -89,9 +89,9 @@ class CCFAnnotation(dj.Manual):
     """
 
     @classmethod
-    def load_ccf_annotation(cls):
+    def load_ccf_annotation(cls, ccf_label_id=CCFLabel.CCF_R3_20UM_ID, chunksz=200000):
         """
-        Load the CCF r3 10 uM NRRD Dataset scaled to 20um.
+        Load the CCF r3 10 uM NRRD Dataset scaled to the resolution of "ccf_label_id" (default 20um).
 
         Expects dj.config:
 
@@ -104,13 +104,17 @@ class CCFAnnotation(dj.Manual):
                 }
             }
 
+        All voxels are labeled in a single pass over the volume (sorted search of the ontology region ids),
+         then inserted in batches of "chunksz" voxels, in (ccf_x, ccf_y, ccf_z) primary key order.
+        Re-running is safe (duplicates are skipped).
+
         see also:
 
         http://download.alleninstitute.org/informatics-archive/current-release/mouse_ccf/annotation/ccf_2017
 
         """
 
-        ccf_vol_res = CCFLabel.CCF_R3_20UM_RESOLUTION
+        ccf_vol_res = (CCFLabel & {'ccf_label_id': ccf_label_id}).fetch1('ccf_resolution')
         vol_res = 10                         # volume resolution from the nrrd
         ds_factor = ccf_vol_res / vol_res    # down-sample factor
         assert int(ds_factor) == ds_factor   # futureproofing paranoia
@@ -130,41 +134,42 @@ class CCFAnnotation(dj.Manual):
         log.info('.. loaded stack of shape {} from {}'
                  .format(stack.shape, stack_path))
 
-        # iterate over ccf ontology region id/name records,
+        # label all voxels with the ccf ontology regions - in the (ccf_x, ccf_y, ccf_z) order
         regions = get_ontology_regions()
-        chunksz, ib_args = 50000, {'skip_duplicates': True,
-                                   'allow_direct_insert': True}
-
-        for idx, (region_id, r) in enumerate(regions.iterrows()):
+        region_ids = regions.index.values.astype(int)
+        region_names = regions.region_name.values
 
-            region_id = int(region_id)
+        labels = stack.transpose((2, 1, 0))  # ML (ccf_x), DV (ccf_y), AP (ccf_z)
+        vol_shape = labels.shape
+        labels = labels.ravel()
 
-            log.info('.. loading region {} ({}/{}) ({})'
-                     .format(region_id, idx, len(regions), r.region_name))
+        region_sorter = np.argsort(region_ids)
+        voxel_regions = region_sorter[np.clip(np.searchsorted(region_ids, labels, sorter=region_sorter),
+                                              0, len(region_ids) - 1)]
+        voxels = np.flatnonzero(region_ids[voxel_regions] == labels)  # voxels in an ontology region
+        voxel_regions = voxel_regions[voxels]
+        del labels
 
-            # extracting filled volumes from stack in scaled [[x,y,z]] shape,
-            vol = (np.array(np.where(stack == region_id)).T[:, [2, 1, 0]]
-                   * scale_factor)
+        log.info('.. {} annotated voxels in {} regions'.format(
+            len(voxels), len(np.unique(voxel_regions))))
 
-            if not vol.shape[0]:
-                log.info('.. region {} volume: shape {} - skipping'
-                         .format(region_id, vol.shape))
-                continue
+        ib_args = {'skip_duplicates': True, 'allow_direct_insert': True}
 
-            log.info('.. region {} volume: shape {}'.format(
-                region_id, vol.shape))
+        start_time = time.time()
+        for b0 in range(0, len(voxels), chunksz):
+            b1 = min(b0 + chunksz, len(voxels))
+            # extracting voxels in scaled [[x,y,z]] shape,
+            vol = (np.array(np.unravel_index(voxels[b0:b1], vol_shape)).T * scale_factor).tolist()
+            annotations = region_names[voxel_regions[b0:b1]]
 
             with dj.conn().transaction:
-                with InsertBuffer(CCF, chunksz, **ib_args) as buf:
-                    for vox in vol:
-                        buf.insert1((CCFLabel.CCF_R3_20UM_ID, *vox))
+                CCF.insert([(ccf_label_id, *vox) for vox in vol], **ib_args)
+                cls.insert([(ccf_label_id, *vox, version_name, annotation)
+                            for vox, annotation in zip(vol, annotations)], **ib_args)
 
-                with InsertBuffer(cls, chunksz, **ib_args) as buf:
-                    for vox in vol:
-                        buf.insert1({'ccf_label_id': CCFLabel.CCF_R3_20UM_ID,
-                                     'ccf_x': vox[0], 'ccf_y': vox[1], 'ccf_z': vox[2],
-                                     'annotation_version': version_name,
-                                     'annotation': r.region_name})
+            elapsed = time.time() - start_time
+            log.info('.. inserted {}/{} voxels ({:.1f}%) - {:.0f} voxels/s'.format(
+                b1, len(voxels), b1 / len(voxels) * 100, b1 / elapsed))
 
         log.info('.. done.')
 
@@ -210,3 +215,168 @@ def get_ccf_xyz_max():
                                      ymax='max(ccf_y)',
                                      zmax='max(ccf_z)').fetch1('xmax', 'ymax', 'zmax')
     return _ccf_xyz_max
+
+
+# ========= CCF ANNOTATION VOLUME ======
+
+class CCFAnnotationVolume:
+    """
+    Dense (ML x DV x AP) volume of the CCF annotation, i.e. the brain region of each CCF voxel,
+     for point, batch and slice region lookups with numpy indexing (instead of restricting CCFAnnotation)
+    Voxels are indexed by (ccf_x, ccf_y, ccf_z) / resolution - coordinates are in um, as in the CCF table
+    """
+
+    def __init__(self, labels, region_names, color_codes, resolution):
+        """
+        :param labels: (ML x DV x AP) array of region index + 1 per voxel (0: not annotated)
+        :param region_names: array of region names (annotation), indexed by the region index
+        :param color_codes: array of region color codes, indexed by the region index
+        :param resolution: voxel resolution (um)
+        """
+        self.labels = labels
+        self.region_names = np.append(np.asarray(region_names, dtype=object), None)  # -1: not annotated
+        self.color_codes = np.append(np.asarray(color_codes, dtype=object), None)
+        self.resolution = resolution
+
+    @property
+    def xyz_max(self):
+        return tuple(int((n - 1) * self.resolution) for n in self.labels.shape)
+
+    def region_indices(self, ccf_x, ccf_y, ccf_z):
+        """
+        Region index of CCF points (scalars or arrays of the same shape), -1 if not annotated or out of the volume
+        """
+        voxels = [np.round(np.asarray(c) / self.resolution).astype(int) for c in (ccf_x, ccf_y, ccf_z)]
+        in_volume = np.logical_and.reduce([(v >= 0) & (v < n) for v, n in zip(voxels, self.labels.shape)])
+        voxels = [np.where(in_volume, v, 0) for v in voxels]
+        return np.where(in_volume, self.labels[tuple(voxels)].astype(int), 0) - 1
+
+    def is_annotated(self, ccf_x, ccf_y, ccf_z):
+        return self.region_indices(ccf_x, ccf_y, ccf_z) >= 0
+
+    def lookup(self, ccf_x, ccf_y, ccf_z):
+        """
+        Region name (annotation) of CCF points (scalars or arrays of the same shape), None if not annotated
+        """
+        return self.region_names[self.region_indices(ccf_x, ccf_y, ccf_z)]
+
+    def lookup_color(self, ccf_x, ccf_y, ccf_z):
+        """
+        Region color code of CCF points (scalars or arrays of the same shape), None if not annotated
+        """
+        return self.color_codes[self.region_indices(ccf_x, ccf_y, ccf_z)]
+
+    def get_slice(self, origin, u, v, shape):
+        """
+        Sample an arbitrary plane of the volume
+        :param origin: (ccf_x, ccf_y, ccf_z) of the first point of the plane (um)
+        :param u: (x, y, z) step vector along the plane rows (um)
+        :param v: (x, y, z) step vector along the plane columns (um)
+        :param shape: (rows, columns) number of points of the plane
+        :return: (rows x columns) arrays of ccf_x, ccf_y, ccf_z and region index (-1 if not annotated)
+        """
+        i, j = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+        ccf_x, ccf_y, ccf_z = (o + i * du + j * dv for o, du, dv in zip(origin, u, v))
+        return ccf_x, ccf_y, ccf_z, self.region_indices(ccf_x, ccf_y, ccf_z)
+
+    @classmethod
+    def from_db(cls, ccf_label_id=CCFLabel.CCF_R3_20UM_ID, annotation_version=None, slab_count=10):
+        """
+        Build the volume from CCFAnnotation - fetched in ML (ccf_x) slabs
+        annotation_version defaults to dj.config['custom']['ccf_data_paths']['version_name']
+        """
+        if annotation_version is None:
+            annotation_version = dj.config['custom']['ccf_data_paths']['version_name']
+        resolution = (CCFLabel & {'ccf_label_id': ccf_label_id}).fetch1('ccf_resolution')
+        region_names, color_codes = (CCFBrainRegion & {'annotation_version': annotation_version}).fetch(
+            'region_name', 'color_code')
+        region_order = np.argsort(region_names.astype(str))  # sorted locally - for np.searchsorted
+        region_names, color_codes = region_names[region_order].astype(str), color_codes[region_order].astype(str)
+
+        q_annotation = CCFAnnotation & {'ccf_label_id': ccf_label_id, 'annotation_version': annotation_version}
+        xmax, ymax, zmax = (dj.U().aggr(q_annotation, xmax='max(ccf_x)', ymax='max(ccf_y)',
+                                        zmax='max(ccf_z)')).fetch1('xmax', 'ymax', 'zmax')
+        if xmax is None:
+            raise dj.DataJointError('No CCFAnnotation for ccf_label_id {} and annotation_version {}'.format(
+                ccf_label_id, annotation_version))
+
+        labels = np.zeros((xmax // resolution + 1, ymax // resolution + 1, zmax // resolution + 1),
+                          dtype=np.uint16)
+
+        slab_size = int(np.ceil(labels.shape[0] / slab_count)) * resolution
+        for x0 in range(0, xmax + 1, slab_size):
+            ccf_x, ccf_y, ccf_z, annotations = (q_annotation & 'ccf_x >= {} and ccf_x < {}'.format(
+                x0, x0 + slab_size)).fetch('ccf_x', 'ccf_y', 'ccf_z', 'annotation')
+            labels[ccf_x // resolution, ccf_y // resolution, ccf_z // resolution] = np.searchsorted(
+                region_names, annotations.astype(str)) + 1  # region index + 1
+            log.debug('.. CCF annotation volume: loaded ccf_x in [{}, {})'.format(x0, x0 + slab_size))
+
+        return cls(labels, region_names, color_codes, resolution)
+
+    @classmethod
+    def load(cls, fp):
+        with np.load(fp) as f:
+            return cls(f['labels'], f['region_names'], f['color_codes'], int(f['resolution']))
+
+    def save(self, fp):
+        np.savez_compressed(fp, labels=self.labels, region_names=self.region_names[:-1].astype(str),
+                            color_codes=self.color_codes[:-1].astype(str), resolution=self.resolution)
+
+
+_annotation_volumes = {}
+
+
+def get_ccf_cache_dir():
+    """
+    retrieve the local directory where the CCF annotation volumes are cached
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'ccf.cache_dir': '/path/string'
+        }
+        ...
+      }
+
+    default to ~/.cache/map-ephys
+    """
+    return pathlib.Path(dj.config.get('custom', {}).get(
+        'ccf.cache_dir', pathlib.Path.home() / '.cache' / 'map-ephys'))
+
+
+def get_annotation_volume(ccf_label_id=CCFLabel.CCF_R3_20UM_ID, annotation_version=None):
+    """
+    Return the CCFAnnotationVolume of a CCF label and annotation version
+     (default to dj.config['custom']['ccf_data_paths']['version_name'])
+    Loaded once per process - from the local disk cache if available, otherwise from CCFAnnotation
+     (and then saved to the local disk cache)
+    """
+    if annotation_version is None:
+        annotation_version = dj.config['custom']['ccf_data_paths']['version_name']
+
+    cache_key = (ccf_label_id, annotation_version)
+    if cache_key not in _annotation_volumes:
+        cache_fp = get_ccf_cache_dir() / 'ccf_annotation_{}_{}.npz'.format(ccf_label_id, annotation_version)
+        if cache_fp.exists():
+            log.info('Loading CCF annotation volume from {}'.format(cache_fp))
+            volume = CCFAnnotationVolume.load(cache_fp)
+        else:
+            log.info('Loading CCF annotation volume from CCFAnnotation')
+            volume = CCFAnnotationVolume.from_db(ccf_label_id, annotation_version)
+            cache_fp.parent.mkdir(parents=True, exist_ok=True)
+            volume.save(cache_fp)
+        _annotation_volumes[cache_key] = volume
+
+    return _annotation_volumes[cache_key]
+
+
+def clear_annotation_volume_cache(remove_files=False):
+    """
+    Clear the process-level CCF annotation volumes (e.g. after (re)loading CCFAnnotation)
+    :param remove_files: also remove the local disk cache
+    """
+    _annotation_volumes.clear()
+    if remove_files:
+        for fp in get_ccf_cache_dir().glob('ccf_annotation_*.npz'):
+            fp.unlink()
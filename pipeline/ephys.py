@@ -213,6 +213,40 @@ class Unit(dj.Imported):
         spike_times : longblob # (s) per-trial spike times relative to go-cue
         """
 
+    class TrialSpikesCompact(dj.Part):
+        definition = """
+        # Per-trial spike times of all trials of a unit, in a compact (CSR) layout
+        -> master
+        ---
+        trials : longblob          # trial numbers, ascending
+        trial_offsets : longblob   # (len(trials) + 1) - spike_times[trial_offsets[i]:trial_offsets[i+1]] are the spikes of trials[i]
+        spike_times : longblob     # (s) concatenated per-trial spike times relative to go-cue
+        """
+
+        @staticmethod
+        def pack(trials, trial_spikes):
+            """
+            Pack per-trial spike times into the compact layout
+            :param trials: trial numbers
+            :param trial_spikes: per-trial spike times (same length as trials)
+            :return: dict of 'trials', 'trial_offsets', 'spike_times'
+            """
+            order = np.argsort(trials, kind='stable')
+            trial_spikes = [np.asarray(trial_spikes[i], dtype=float) for i in order]
+            return {'trials': np.asarray(trials)[order],
+                    'trial_offsets': np.concatenate([[0], np.cumsum([len(s) for s in trial_spikes])]).astype(int),
+                    'spike_times': np.concatenate(trial_spikes) if trial_spikes else np.array([])}
+
+        @staticmethod
+        def unpack(trial_offsets, spike_times):
+            """
+            Unpack the compact layout into an (object) array of per-trial spike times
+            """
+            trial_spikes = np.empty(len(trial_offsets) - 1, dtype=object)
+            for i, spikes in enumerate(np.split(spike_times, trial_offsets[1:-1])):
+                trial_spikes[i] = spikes
+            return trial_spikes
+
 
 @schema
 class TrialEvent(dj.Imported):
@@ -423,15 +457,18 @@ class UnitStat(dj.Computed):
     min_isi = 0  # threshold for duplicate spikes
 
     # NOTE - this key_source logic relies on ALL TrialSpikes ingest all at once in a transaction
-    key_source = ProbeInsertion & Unit.TrialSpikes
+    key_source = ProbeInsertion & [Unit.TrialSpikes, Unit.TrialSpikesCompact]
 
     def make(self, key):
         # Following isi_violations() function
         # Ref: https://github.com/AllenInstitute/ecephys_spike_sorting/blob/master/ecephys_spike_sorting/modules/quality_metrics/metrics.py
+        session_trials, session_tr_start, session_tr_stop = (experiment.SessionTrial & key).fetch(
+            'trial', 'start_time', 'stop_time')
+
         def make_insert():
-            for unit in (Unit & key).fetch('KEY'):
-                trial_spikes, tr_start, tr_stop = (Unit.TrialSpikes * experiment.SessionTrial & unit).fetch(
-                    'spike_times', 'start_time', 'stop_time')
+            for unit, trials, trial_spikes in fetch_trial_spikes(Unit & key):
+                is_unit_trial = np.isin(session_trials, trials)
+                tr_start, tr_stop = session_tr_start[is_unit_trial], session_tr_stop[is_unit_trial]
 
                 isis = np.hstack(np.diff(spks) for spks in trial_spikes)
 
@@ -696,4 +733,64 @@ def check_unit_criteria(unit_key):
 
 
 
- 
\ No newline at end of file
+ 
+
+
+def check_trial_spikes(units):
+    """
+    Raise if any of the specified units was ingested with the "compact" trial spikes layout
+     (ephys.Unit.TrialSpikesCompact only, see ingest.ephys.get_trial_spikes_layout) - for the code that still reads
+     Unit.TrialSpikes / Unit.UnitTrial directly instead of through fetch_trial_spikes()
+    :param units: unit key(s) or query of the ephys.Unit table (or any restriction of it, e.g. a session key)
+    """
+    compact_only = (Unit.TrialSpikesCompact & units) - Unit.TrialSpikes
+    if compact_only:
+        raise NotImplementedError('{} unit(s) only have ephys.Unit.TrialSpikesCompact (trial spikes layout "compact")'
+                                  ' - not supported by this function, which reads ephys.Unit.TrialSpikes'.format(
+            len(compact_only)))
+
+
+def fetch_trial_spikes(units, trials=None):
+    """
+    Fetch the per-trial spike times (relative to go-cue) of the specified units,
+     equivalent to (Unit.TrialSpikes & unit & trials).fetch('trial', 'spike_times', order_by='trial')
+     for each unit, but in one query from Unit.TrialSpikesCompact
+     (falling back to Unit.TrialSpikes for units ingested without the compact layout)
+    :param units: unit key(s) or query of the ephys.Unit table
+    :param trials: (optional) trial restriction, e.g. a TrialCondition query or a list of trial keys
+    :return: list of (unit_key, trials, trial_spikes) - one per unit, with
+        trials: array of trial numbers (ascending)
+        trial_spikes: (object) array of per-trial spike times
+    """
+    unit_keys = (Unit & units).fetch('KEY')
+    if not unit_keys:
+        return []
+
+    if trials is not None:
+        session_trials = {}
+        for subject_id, session, trial in zip(*(experiment.SessionTrial & (Unit & units) & trials).fetch(
+                'subject_id', 'session', 'trial')):
+            session_trials.setdefault((subject_id, session), []).append(trial)
+
+    compact_trial_spikes = {tuple(k[a] for a in Unit.primary_key): (tr, offsets, spikes)
+                            for k, tr, offsets, spikes in zip(*(Unit.TrialSpikesCompact & unit_keys).fetch(
+                                'KEY', 'trials', 'trial_offsets', 'spike_times'))}
+
+    unit_trial_spikes = []
+    for unit_key in unit_keys:
+        unit_id = tuple(unit_key[a] for a in Unit.primary_key)
+        if unit_id in compact_trial_spikes:
+            unit_trials, offsets, spikes = compact_trial_spikes[unit_id]
+            trial_spikes = Unit.TrialSpikesCompact.unpack(offsets, spikes)
+            if trials is not None:
+                is_selected = np.isin(unit_trials, session_trials.get(
+                    (unit_key['subject_id'], unit_key['session']), []))
+                unit_trials, trial_spikes = unit_trials[is_selected], trial_spikes[is_selected]
+        else:
+            q_trial_spikes = Unit.TrialSpikes & unit_key
+            if trials is not None:
+                q_trial_spikes &= trials
+            unit_trials, trial_spikes = q_trial_spikes.fetch('trial', 'spike_times', order_by='trial')
+        unit_trial_spikes.append((unit_key, unit_trials, trial_spikes))
+
+    return unit_trial_spikes
@@ -4,7 +4,7 @@ import numpy as np
 import pathlib
 
 from . import lab, ccf
-from . import get_schema_name
+from . import get_schema_name, dict_to_hash
 
 schema = dj.schema(get_schema_name('experiment'))
 
@@ -434,13 +434,8 @@ class Breathing(dj.Imported):
     key_source = Session & ephys.ProbeInsertion & (BehaviorTrial & 'task = "multi-target-licking"')
 
     def make(self, key):
-        # channel 2 is for breathing data
-        breathing_trials_data = extract_nidq_trial_data(key, channel=2)
-        for d in breathing_trials_data:
-            d['breathing'] = d.pop('data')
-            d['breathing_timestamps'] = d.pop('timestamps')
-
-        self.insert(breathing_trials_data, allow_direct_insert=True)
+        # channel 2 is for breathing data - read together with Piezoelectric (channel 3), see get_nidq_trial_data
+        self.insert(fetch_nidq_trial_entries(key, 'breathing'))
 
 
 @schema
@@ -456,13 +451,8 @@ class Piezoelectric(dj.Imported):
                 BehaviorTrial & 'task = "multi-target-licking"')
 
     def make(self, key):
-        # channel 3 is for piezoelectric data
-        piezoelectric_trials_data = extract_nidq_trial_data(key, channel=3)
-        for d in piezoelectric_trials_data:
-            d['piezoelectric'] = d.pop('data')
-            d['piezoelectric_timestamps'] = d.pop('timestamps')
-
-        self.insert(piezoelectric_trials_data, allow_direct_insert=True)
+        # channel 3 is for piezoelectric data - read together with Breathing (channel 2), see get_nidq_trial_data
+        self.insert(fetch_nidq_trial_entries(key, 'piezoelectric'))
 
 
 # ---- Photostim trials ----
@@ -582,6 +572,14 @@ def get_session_ephys_data_directory(session_key):
 
 
 def extract_nidq_trial_data(session_key, channel):
+    """
+    Extract the per-trial data of one or more NIDQ channels for a session
+     - only the sample ranges of the trials matched to behavior are read from the nidq.bin
+    :param session_key: session key
+    :param channel: a NIDQ channel index, or a list of channel indices (extracted together, in one pass)
+    :return: list of trial dictionaries with 'data' and 'timestamps' (s, relative to the start of the trial)
+             'data' is a 1D array for a single channel, or a (channel x sample) array for a list of channels
+    """
     from pipeline.ingest import ephys as ephys_ingest
     session_ephys_dir = get_session_ephys_data_directory(session_key)
 
@@ -607,23 +605,72 @@ def extract_nidq_trial_data(session_key, channel):
                                     ' "*.XA_0_0.txt"'
                                     ' found in {}'.format(session_ephys_dir))
 
-    chan_list = [channel]
-    breathing_data, sampling_rate = ephys_ingest.read_SGLX_bin(nidq_bin_fp, chan_list)
+    chan_list = list(np.atleast_1d(channel))
+    sampling_rate = ephys_ingest.readSGLX.SampRate(ephys_ingest.readSGLX.readMeta(nidq_bin_fp))
 
     trial_starts_indices = (trial_start_times * sampling_rate).astype(int)
-    # segment to per-trial
-    all_trials_data = []
+    # trial windows (in samples) of the ephys trials matched to behavior
+    matched_trials, trial_windows = [], []
     for idx in range(len(trial_starts_indices)):
         start_idx = trial_starts_indices[idx]
         end_idx = trial_starts_indices[idx + 1] if start_idx < trial_starts_indices[-1] else -1
-        trial_data = breathing_data[:, start_idx:end_idx].flatten()
 
         ephys_bitcode = ephys_bitcodes[idx]
         matched_trial_idx = np.where(behavior_bitcodes == ephys_bitcode)[0]
 
         if len(matched_trial_idx):
-            all_trials_data.append({
-                **session_key, 'trial': behav_trials[matched_trial_idx[0]],
-                'data': trial_data,
-                'timestamps': np.arange(len(trial_data)) / sampling_rate})
+            matched_trials.append(behav_trials[matched_trial_idx[0]])
+            trial_windows.append((start_idx, end_idx))
+
+    # read all channels, trial by trial
+    trials_data, sampling_rate = ephys_ingest.read_SGLX_bin_windows(nidq_bin_fp, chan_list, trial_windows)
+
+    all_trials_data = []
+    for trial, trial_data in zip(matched_trials, trials_data):
+        all_trials_data.append({
+            **session_key, 'trial': trial,
+            'data': trial_data if np.ndim(channel) else trial_data.flatten(),
+            'timestamps': np.arange(trial_data.shape[-1]) / sampling_rate})
     return all_trials_data
+
+
+# NIDQ channels of the per-trial analog recordings - extracted together in one pass over the nidq.bin
+nidq_trial_channels = {'breathing': 2, 'piezoelectric': 3}
+
+
+_nidq_trial_data = {}
+
+
+def get_nidq_trial_data(session_key):
+    """
+    Extract all "nidq_trial_channels" of a session in one pass over the nidq.bin (see extract_nidq_trial_data)
+     - the last session read is kept in memory, so populating Breathing and Piezoelectric
+       in the same process reads each session once (see clear_nidq_trial_data_cache)
+    :param session_key: session key
+    :return: list of trial dictionaries with 'data' (channel x sample, ordered as "nidq_trial_channels") and 'timestamps'
+    """
+    session_hash = dict_to_hash({k: session_key[k] for k in Session.primary_key})
+    if session_hash not in _nidq_trial_data:
+        _nidq_trial_data.clear()
+        _nidq_trial_data[session_hash] = extract_nidq_trial_data(session_key, list(nidq_trial_channels.values()))
+    return _nidq_trial_data[session_hash]
+
+
+def clear_nidq_trial_data_cache():
+    """
+    Drop the in-memory NIDQ trial data of the last session read
+    """
+    _nidq_trial_data.clear()
+
+
+def fetch_nidq_trial_entries(session_key, data_type):
+    """
+    Build the per-trial entries of one of the "nidq_trial_channels" (e.g. 'breathing') for its table
+    :param session_key: session key
+    :param data_type: a key of "nidq_trial_channels"
+    :return: list of entries with the trial, data_type and data_type + '_timestamps' attributes
+    """
+    chn_idx = list(nidq_trial_channels).index(data_type)
+    return [{**session_key, 'trial': d['trial'],
+             data_type: d['data'][chn_idx], data_type + '_timestamps': d['timestamps']}
+            for d in get_nidq_trial_data(session_key)]
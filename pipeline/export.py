@@ -102,6 +102,7 @@ def _export_recording(insert_key, output_dir='./', filename=None, overwrite=Fals
         filename will be autogenerated using the 'mkfilename'
         function.
     '''
+    ephys.check_trial_spikes(insert_key)  # reads ephys.Unit.TrialSpikes
 
     if filename is None:
         filename = mkfilename(insert_key)
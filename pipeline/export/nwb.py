@@ -97,9 +97,8 @@ def datajoint_to_nwb(session_key):
             device=ephys_device,
             location=insert_location)
 
-        electrode_query = (lab.ProbeType.Electrode * lab.ElectrodeConfig.Electrode
-                           & electrode_config)
-        for electrode in electrode_query.fetch(as_dict=True):
+        electrodes = lab.get_electrodes(electrode_config['probe_type'], electrode_config['electrode_config_hash'])
+        for electrode in (dict(zip(electrodes.dtype.names, e)) for e in electrodes):
             nwbfile.add_electrode(
                 id=electrode['electrode'], group=electrode_group,
                 filtering='', imp=-1.,
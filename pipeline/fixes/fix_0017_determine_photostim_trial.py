@@ -6,7 +6,7 @@ from decimal import Decimal
 import datajoint as dj
 import re
 
-from pipeline import lab, experiment, report
+from pipeline import lab, experiment, report, util
 from pipeline.ingest import behavior as behavior_ingest
 from pipeline.fixes import schema, FixHistory
 
@@ -114,6 +114,7 @@ def _fix_one_session(key):
             (experiment.PhotostimTrial & invalid_photostim_trials).delete()
             # delete ProbeLevelPhotostimEffectReport figures associated with this session
             (report.ProbeLevelPhotostimEffectReport & key).delete()
+        util.clear_trial_set_cache(key)
 
     return True, invalid_photostim_trials
 
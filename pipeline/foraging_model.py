@@ -1,10 +1,55 @@
+import logging
+import multiprocessing as mp
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import datajoint as dj
 import numpy as np
-from . import experiment, ephys, get_schema_name, foraging_analysis
-from .model.bandit_model_comparison import BanditModelComparison
+from . import experiment, ephys, get_schema_name, foraging_analysis, dict_to_hash
+from .model.bandit_model_comparison import BanditModelComparison, MODELS
 
 schema = dj.schema(get_schema_name('foraging_model'))
 
+log = logging.getLogger(__name__)
+
+
+def get_cross_validation_workers():
+    """
+    retrieve the number of processes used to fit the cross-validation folds in FittedSessionModel
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'foraging_model.cross_validation_workers': 2
+        }
+        ...
+      }
+
+    default to 2 (the number of folds); 1 fits the folds one after another.
+    Folds are always fitted serially inside daemonic workers (e.g. populate_fitted_session_models), which can't have children
+    """
+    return int(dj.config.get('custom', {}).get('foraging_model.cross_validation_workers', 2))
+
+
+def get_warm_start_fraction():
+    """
+    retrieve the fraction of the initial DE population in FittedSessionModel seeded from previous fits
+    (see get_warm_start_params)
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'foraging_model.warm_start_fraction': 0.5
+        }
+        ...
+      }
+
+    default to 0 (no warm start, random initial population)
+    """
+    return float(dj.config.get('custom', {}).get('foraging_model.warm_start_fraction', 0))
+
 
 @schema
 class ModelClass(dj.Lookup):
@@ -82,97 +127,7 @@ class Model(dj.Manual):
 
     @classmethod
     def load_models(cls):
-        # Original definition from the Dynamic-Foraging repo, using the format: [forager, [para_names], [lower bounds], [higher bounds], desc(optional)]
-        MODELS = [
-            # No bias
-            ['LossCounting', ['loss_count_threshold_mean', 'loss_count_threshold_std'],
-             [0, 0], [40, 10], 'LossCounting: mean, std, no bias'],
-
-            ['RW1972_epsi', ['learn_rate', 'epsilon'],
-             [0, 0], [1, 1], 'SuttonBarto: epsilon, no bias'],
-
-            ['RW1972_softmax', ['learn_rate', 'softmax_temperature'],
-             [0, 1e-2], [1, 15], 'SuttonBarto: softmax, no bias'],
-
-            ['LNP_softmax', ['tau1', 'softmax_temperature'],
-             [1e-3, 1e-2], [100, 15], 'Sugrue2004, Corrado2005: one tau, no bias'],
-
-            ['LNP_softmax', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature'],
-             [1e-3, 1e-1, 0, 1e-2], [15, 40, 1, 15], 'Corrado2005, Iigaya2019: two taus, no bias'],
-
-            ['Bari2019', ['learn_rate', 'forget_rate', 'softmax_temperature'],
-             [0, 0, 1e-2], [1, 1, 15], 'RL: chosen, unchosen, softmax, no bias'],
-
-            ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature'],
-             [0, 0, 1e-2], [1, 1, 15], 'RL: rew, unrew, softmax, no bias'],
-
-            ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature'],
-             [0, 0, 0, 1e-2], [1, 1, 1, 15], 'RL: rew, unrew, unchosen, softmax, no bias'],
-
-            # With bias
-            ['RW1972_epsi', ['learn_rate', 'epsilon', 'biasL'],
-             [0, 0, -0.5], [1, 1, 0.5], 'SuttonBarto: epsilon'],
-
-            ['RW1972_softmax', ['learn_rate', 'softmax_temperature', 'biasL'],
-             [0, 1e-2, -5], [1, 15, 5], 'SuttonBarto: softmax'],
-
-            ['LNP_softmax', ['tau1', 'softmax_temperature', 'biasL'],
-             [1e-3, 1e-2, -5], [100, 15, 5], 'Sugrue2004, Corrado2005: one tau'],
-
-            ['LNP_softmax', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature', 'biasL'],
-             [1e-3, 1e-1, 0, 1e-2, -5], [15, 40, 1, 15, 5], 'Corrado2005, Iigaya2019: two taus'],
-
-            ['Bari2019', ['learn_rate', 'forget_rate', 'softmax_temperature', 'biasL'],
-             [0, 0, 1e-2, -5], [1, 1, 15, 5], 'RL: chosen, unchosen, softmax'],
-
-            ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature', 'biasL'],
-             [0, 0, 1e-2, -5], [1, 1, 15, 5], 'RL: rew, unrew, softmax'],
-
-            ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL'],
-             [0, 0, 0, 1e-2, -5], [1, 1, 1, 15, 5], '(full Hattori) RL: rew, unrew, unchosen, softmax'],
-
-            # With bias and choice kernel 
-            ['RW1972_softmax_CK', ['learn_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 1e-2, -5, 0, 1e-2], [1, 15, 5, 1, 20], 'SuttonBarto: softmax, choice kernel'],
-
-            ['LNP_softmax_CK', ['tau1', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [1e-3, 1e-2, -5, 0, 1e-2], [100, 15, 5, 1, 20], 'Sugrue2004, Corrado2005: one tau, choice kernel'],
-
-            ['LNP_softmax_CK', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [1e-3, 1e-1, 0, 1e-2, -5, 0, 1e-2], [15, 40, 1, 15, 5, 1, 20], 'Corrado2005, Iigaya2019: two taus, choice kernel'],
-
-            ['Bari2019_CK', ['learn_rate', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 15, 5, 1, 20], 'RL: chosen, unchosen, softmax, choice kernel'],
-
-            ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 15, 5, 1, 20], 'RL: rew, unrew, softmax, choice kernel'],
-
-            ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 1, 15, 5, 1, 20], 'Hattori + choice kernel'],
-
-            ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
-             [0, 0, 0, 1e-2, -5, 1, 1e-2], [1, 1, 1, 15, 5, 1, 20], 'choice_step_size fixed at 1 --> Bari 2019: only the last choice matters'],
-
-            ['CANN', ['learn_rate', 'tau_cann', 'softmax_temperature', 'biasL'],
-             [0, 0, 1e-2, -5], [1, 1000, 15, 5], "Ulises' CANN model, ITI decay, with bias"],
-            
-            ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-             [0, 0, 0, 0, 1e-2, -5], [1, 1, 10, 1, 15, 5], "Ulises' synaptic model"],
-            
-            ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-             [0, 0, 0, -100, 1e-2, -5], [1, 1, 10, 100, 15, 5], "Ulises' synaptic model (unconstrained \\rho)"],
-            
-            ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-             [0, 0, 0, -1e6, 1e-2, -5], [1, 1, 1e6, 1e6, 15, 5], "Ulises' synaptic model (really unconstrained I_0 and \\rho)"],
-            
-            # ['Synaptic_W>0', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-            #  [0, 0, 0, -100, 1e-2, -5], [1, 1, 10, 100, 15, 5], "Ulises' synaptic model (W > 0, partially constrained I_0 and \\rho)"],
-            
-            # ['Synaptic_W>0', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
-            #  [0, 0, 0, -1e6, 1e-2, -5], [1, 1, 10, 1e6, 15, 5], "Ulises' synaptic model (W > 0, unconstrained I_0 and \\rho)"],
-        ]
-
-        # Parse and insert MODELS
+        # Parse and insert MODELS (the original definition from the Dynamic-Foraging repo, see model.bandit_model_comparison)
         for model_id, model in enumerate(MODELS):
             # Insert Model
             model_class = [mc for mc in ModelClass.fetch("model_class") if mc in model[0]][0]
@@ -276,6 +231,15 @@ class FittedSessionModel(dj.Computed):
         fitted_value: float
         """
 
+    class WallTime(dj.Part):
+        definition = """
+        # Wall time of this fit, used to estimate the cost of future fits (see estimate_fitting_cost)
+        -> master
+        ---
+        fit_time: float                 # (s) fitting
+        cross_validation_time: float    # (s) cross validation
+        """
+
     class TrialLatentVariable(dj.Part):
         """
         To save all fitted latent variables that will be correlated to ephys
@@ -311,8 +275,25 @@ class FittedSessionModel(dj.Computed):
             model_comparison_this = BanditModelComparison(choice_history, reward_history, iti=iti, model=model_str)
         else:
             model_comparison_this = BanditModelComparison(choice_history, reward_history, iti=None, model=model_str)
-        model_comparison_this.fit(pool='', plot_predictive=None, if_verbose=False)  # Parallel on sessions, not on DE
-        model_comparison_this.cross_validate(pool='', k_fold=2, if_verbose=False)
+        # Parallel on sessions, not on DE; DE population is evaluated at once in this process
+        fit_settings = {'DE_pop_size': 16, 'DE_vectorized': True}
+        warm_start_fraction = get_warm_start_fraction()
+        warm_start = get_warm_start_params(key) if warm_start_fraction > 0 else []
+        start = time.time()
+        model_comparison_this.fit(pool='', fit_settings={**fit_settings, 'warm_start': warm_start,
+                                                         'warm_start_fraction': warm_start_fraction},
+                                  plot_predictive=None, if_verbose=False)
+        fit_time = time.time() - start
+        cv_seed = int(dict_to_hash(key)[:8], 16)   # Reproducible folds for each session and model
+        cv_workers = get_cross_validation_workers()
+        if cv_workers > 1 and not mp.current_process().daemon:
+            with ProcessPoolExecutor(cv_workers) as fold_executor:
+                model_comparison_this.cross_validate(pool='', k_fold=2, fit_settings=fit_settings, if_verbose=False,
+                                                     fold_executor=fold_executor, seed=cv_seed)
+        else:
+            model_comparison_this.cross_validate(pool='', k_fold=2, fit_settings=fit_settings, if_verbose=False,
+                                                 seed=cv_seed)
+        cross_validation_time = time.time() - start - fit_time
 
         # ------ Grab results ----
         fit_result = model_comparison_this.results_raw[0]
@@ -338,6 +319,7 @@ class FittedSessionModel(dj.Computed):
         # Insert fitted params (`order_by` is critical!)
         self.Param.insert([dict(**key, model_param=param, fitted_value=x) 
 	                         for param, x in zip((Model.Param & key).fetch('model_param', order_by='param_idx'), fit_result.x)])
+        self.WallTime.insert1(dict(**key, fit_time=fit_time, cross_validation_time=cross_validation_time))
         
         # Insert latent variables (trial number offset -1 here!!)
         choice_prob = fit_result.predictive_choice_prob[:, 1:]  # Model must have this
@@ -420,6 +402,119 @@ class FittedSessionModelComparison(dj.Computed):
                                 'best_cross_validation_test': best_cross_validation_test})
 
 
+# ============= Warm start =============
+
+def get_warm_start_params(key, max_fits=10):
+    """
+    Fitted parameters of previous fits that can seed the fitting of `key` (session + model):
+    fits of the same subject and the same model class that share parameter names with this model,
+    from the same session first, then from the nearest sessions (the same model before a related one)
+    Returns [n_fits, n_params] with params in the order of Model.Param.param_idx of this model
+    (NaN for params the previous fit doesn't have)
+    """
+    param_names = (Model.Param & key).fetch('model_param', order_by='param_idx')
+    previous_fits = (FittedSessionModel * Model.proj('model_class') & {'subject_id': key['subject_id']}
+                     & {'model_class': (Model & key).fetch1('model_class')}) - key
+    if not previous_fits:
+        return np.empty([0, len(param_names)])
+
+    fitted_params = {}
+    for session, model_id, param, value in zip(*(FittedSessionModel.Param & previous_fits.proj()).fetch(
+            'session', 'model_id', 'model_param', 'fitted_value')):
+        fitted_params.setdefault((session, model_id), {})[param] = value
+
+    fits = sorted((fit for fit, params in fitted_params.items() if set(params) & set(param_names)),
+                  key=lambda fit: (abs(fit[0] - key['session']), fit[1] != key['model_id']))[:max_fits]
+    return np.array([[fitted_params[fit].get(param, np.nan) for param in param_names] for fit in fits],
+                    dtype=float).reshape(-1, len(param_names))
+
+
+# ============= Fitting scheduler =============
+
+def estimate_fitting_cost(keys):
+    """
+    Estimated wall time of FittedSessionModel.make() for each (session, model) key in `keys`
+        cost = rate * n_trials * n_params
+    where rate (seconds per trial per parameter) is the median over recorded FittedSessionModel.WallTime of the
+    same model class (or of all models if this class has never been fitted). Without any record, rate = 1 so that
+    only the relative costs are meaningful.
+    """
+    session_trials = {(s['subject_id'], s['session']): s['n_trials'] for s in
+                      experiment.Session.aggr(experiment.BehaviorTrial & 'outcome != "ignore"',
+                                              n_trials='count(*)').fetch(as_dict=True)}
+    model_class, model_n_params = {}, {}
+    for model_id, mc, n_params in zip(*Model.fetch('model_id', 'model_class', 'n_params')):
+        model_class[model_id], model_n_params[model_id] = mc, n_params
+
+    # Recorded rates
+    mc, n_trials, n_params, fit_time, cv_time = (FittedSessionModel.WallTime * FittedSessionModel
+                                                 * Model.proj('model_class')).fetch(
+        'model_class', 'n_trials', 'n_params', 'fit_time', 'cross_validation_time')
+    rates = (fit_time + cv_time) / np.maximum(n_trials * n_params, 1)
+    default_rate = np.median(rates) if len(rates) else 1.
+    class_rate = {c: np.median(rates[mc == c]) for c in set(mc)}
+
+    return np.array([class_rate.get(model_class[key['model_id']], default_rate)
+                     * session_trials.get((key['subject_id'], key['session']), 0)
+                     * model_n_params[key['model_id']] for key in keys])
+
+
+def order_fitting_jobs(keys, costs):
+    """
+    The (session, model) keys sorted longest-first by their estimated costs (ties keep their order)
+    """
+    return [keys[i] for i in np.argsort(-np.asarray(costs), kind='stable')]
+
+
+def _init_fitting_worker():
+    """
+    Worker process initializer - use a connection of its own (not the one inherited from the parent process)
+    """
+    dj.conn().connect()
+
+
+def _populate_fitted_session_model(key):
+    """
+    Fit one (session, model) job in a worker process; returns the key and the populate errors (if any)
+    """
+    errors = FittedSessionModel.populate(key, reserve_jobs=True, suppress_errors=True, display_progress=False)
+    return key, errors
+
+
+def populate_fitted_session_models(*restrictions, processes=None):
+    """
+    Populate FittedSessionModel by dispatching the (session, model) jobs longest-first (by estimate_fitting_cost)
+    across a worker pool, which shortens the makespan of refitting many sessions.
+    Each job fits in a single process (DE population vectorized, no pool in the fitting), so pools are never nested.
+    :param restrictions: restrictions on FittedSessionModel.key_source
+    :param processes: number of worker processes (default: cpu_count - 1); 1 runs in this process
+    """
+    keys = (FittedSessionModel.key_source & dj.AndList(restrictions) - FittedSessionModel).fetch('KEY')
+    if not keys:
+        return
+
+    costs = estimate_fitting_cost(keys)
+    keys = order_fitting_jobs(keys, costs)
+    log.info('Fitting {} session models, estimated total cost {:.3g}'.format(len(keys), costs.sum()))
+
+    processes = processes or max(mp.cpu_count() - 1, 1)
+    if processes == 1:
+        for key in keys:
+            FittedSessionModel.populate(key, reserve_jobs=True, display_progress=False)
+        return
+
+    # workers need connections of their own, hence a pool of this function's own (with _init_fitting_worker)
+    pool = mp.Pool(processes, initializer=_init_fitting_worker)
+    try:
+        # chunksize=1 keeps the longest-first order: an idle worker always takes the next longest job
+        for key, errors in pool.imap_unordered(_populate_fitted_session_model, keys, chunksize=1):
+            for error in errors or []:
+                log.warning('Fitting {} failed: {}'.format(key, error))
+    finally:
+        pool.close()
+        pool.join()
+
+
 # ============= Helpers =============
 
 def get_session_history(session_key, remove_ignored=True):
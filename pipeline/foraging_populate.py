@@ -18,10 +18,16 @@ def populatemytables_core(arguments,runround):
         # report.SessionLevelForagingSummary.populate(**arguments)   
         # report.SessionLevelForagingLickingPSTH.populate(**arguments)   
 
-        foraging_model.FittedSessionModel.populate(**arguments)
-        foraging_model.FittedSessionModelComparison.populate(**arguments)
+        # FittedSessionModel is populated by foraging_model.populate_fitted_session_models() (longest jobs first)
         # psth_foraging.UnitPeriodLinearFit.populate(**arguments)
         
+def populate_model_fitting(paralel = True):
+    if paralel:
+        foraging_model.populate_fitted_session_models()   # Its own pool, whose workers open their own connections
+    else:
+        foraging_model.populate_fitted_session_models(processes = 1)
+    foraging_model.FittedSessionModelComparison.populate(display_progress = True)
+        
 def populatemytables(paralel = True, cores = 9):
     IDs = {k: v for k, v in zip(*lab.WaterRestriction().fetch('water_restriction_number', 'subject_id'))}              
     if paralel:
@@ -46,6 +52,8 @@ def populatemytables(paralel = True, cores = 9):
         for runround in [1]:
             arguments = {'display_progress' : True, 'reserve_jobs' : False,'order' : 'random'}
             populatemytables_core(arguments,runround)
+    
+    populate_model_fitting(paralel = paralel)
             
             
 if __name__ == '__main__' and use_ray == False:  # This is a workaround for mp.apply_async to run in Windows
@@ -291,16 +291,19 @@ def retrieve_pseudocoronal_slice(probe_insertion, shank_no=1):
     ap_coords = (voxel_res * np.round(ap_coords / voxel_res)).astype(np.int)
     ml_coords = (voxel_res * np.round(ml_coords / voxel_res)).astype(np.int)
 
-    # ---- extract pseudoconoral plane from DB ----
-    q_ccf = ccf.CCFAnnotation * ccf.CCFBrainRegion.proj(..., annotation='region_name')
-    dv_pts, lr_pts, ap_pts, color_codes = (
-            q_ccf & [{'ccf_y': dv, 'ccf_z': ap} for ap, dv in zip(ap_coords, dv_coords)]).fetch(
-        'ccf_y', 'ccf_x', 'ccf_z', 'color_code', order_by='ccf_y')
+    # ---- extract pseudoconoral plane from the CCF annotation volume ----
+    ccf_volume = ccf.get_annotation_volume()
+    lr_coords = np.arange(0, ccf_volume.xyz_max[0] + voxel_res, voxel_res)
+    lr_grid, dv_grid = np.meshgrid(lr_coords, dv_coords)  # (DV x ML)
+    ap_grid = np.broadcast_to(ap_coords[:, np.newaxis], lr_grid.shape)
+
+    region_indices = ccf_volume.region_indices(lr_grid, dv_grid, ap_grid)
+    is_annotated = region_indices >= 0
+    dv_pts, lr_pts, ap_pts = dv_grid[is_annotated], lr_grid[is_annotated], ap_grid[is_annotated]
+    color_codes = ccf_volume.color_codes[region_indices[is_annotated]]
 
     # ---- CCF coords for voxels on the interpolated probe/shank track ----
-    coronal_point_cloud = set(zip(lr_pts, dv_pts, ap_pts))  # ML, DV, AP
-    shank_ccfs = np.vstack([(ml, dv, ap)
-                            for dv, ap, ml in zip(dv_coords, ap_coords, ml_coords)
-                            if (ml, dv, ap) in coronal_point_cloud])
+    on_track = ccf_volume.is_annotated(ml_coords, dv_coords, ap_coords)
+    shank_ccfs = np.vstack([ml_coords, dv_coords, ap_coords]).T[on_track]  # ML, DV, AP
 
     return np.vstack([dv_pts, lr_pts, ap_pts, color_codes]).T, shank_ccfs
@@ -10,6 +10,7 @@ from glob import glob
 from tqdm import tqdm
 import re
 from itertools import repeat
+import multiprocessing as mp
 import pandas as pd
 
 import scipy.io as spio
@@ -19,7 +20,7 @@ import numpy as np
 import datajoint as dj
 #import pdb
 
-from pipeline import lab, experiment, ephys, report, tracking
+from pipeline import lab, experiment, ephys, report, tracking, psth, psth_foraging
 from pipeline import InsertBuffer, dict_value_to_hash
 
 from .. import get_schema_name
@@ -51,6 +52,51 @@ def get_ephys_paths():
     return dj.config.get('custom', {}).get('ephys_data_paths', None)
 
 
+def get_trial_spikes_layout():
+    """
+    retrieve the storage layout of the trialized spikes from dj.config
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'ephys.trial_spikes_layout': 'both'
+        }
+        ...
+      }
+
+    with:
+      - 'both' (default): one row per unit in ephys.Unit.TrialSpikesCompact
+                          and one row per (unit, trial) in ephys.Unit.UnitTrial and ephys.Unit.TrialSpikes
+      - 'compact': one row per unit in ephys.Unit.TrialSpikesCompact only - read through ephys.fetch_trial_spikes()
+                   (psth, PeriodSelectivity, UnitPsth, ...). Unsupported by the code that still reads
+                   ephys.Unit.TrialSpikes directly (oralfacial_analysis, mtl_analysis, plot.behavior_plot, export),
+                   which raises for such units (see ephys.check_trial_spikes)
+    """
+    layout = dj.config.get('custom', {}).get('ephys.trial_spikes_layout', 'both')
+    if layout not in ('both', 'compact'):
+        raise ValueError('Unknown ephys.trial_spikes_layout: {} - expecting "both" or "compact"'.format(layout))
+    return layout
+
+
+def get_ingest_worker_count():
+    """
+    retrieve the number of worker processes used to load the probes of a session in parallel
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'ephys.ingest_workers': 4
+        }
+        ...
+      }
+
+    default to 1 (probes loaded one after another)
+    """
+    return int(dj.config.get('custom', {}).get('ephys.ingest_workers', 1))
+
+
 @schema
 class EphysIngest(dj.Imported):
     # subpaths like: \2017-10-21\tw5ap_imec3_opt3_jrc.mat
@@ -107,6 +153,7 @@ class EphysIngest(dj.Imported):
         clustering_label = data['clustering_label']
         cluster_noise_label = data.get('cluster_noise_label')
         bitcode_raw = data['bitcode_raw']
+        cluster_index = data.get('cluster_index')  # ClusterSpikeIndex of the spikes, if provided by the loader
 
         log.info('-- Start insertions for probe: {} - Clustering method: {} - Label: {}'.format(probe, method, clustering_label))
 
@@ -134,6 +181,7 @@ class EphysIngest(dj.Imported):
         if method in ['jrclust_v3', 'jrclust_v4']:
             units, spikes, spike_sites, spike_depths = (v[i] for v, i in zip(
                 (units, spikes, spike_sites, spike_depths), repeat((units > 0))))
+            cluster_index = None
 
         # scale amplitudes by uV/bit scaling factor (for kilosort2)
         if method in ['kilosort2']:
@@ -192,57 +240,41 @@ class EphysIngest(dj.Imported):
         if probe == 1 and 'digMarkerPerTrial' in bitcode_raw:   # Only import once for one session
             insert_ephys_events(skey, bitcode_raw, shared_trial_num)
 
-        # trialize the spikes & subtract go cue
-        t, trial_spikes, trial_units = 0, [], []
-
-        spike_trial_num = np.full_like(spikes, np.nan)
-
-        while t < len(trial_start) - 1:
-
-            s0, s1 = trial_start[t], trial_start[t+1]
-
-            trial_idx = np.where((spikes > s0) & (spikes < s1))
-            spike_trial_num[trial_idx] = trials[t]   # Assign (behavioral) trial number to each spike
-
-            trial_spikes.append(spikes[trial_idx] - trial_go[t])
-            trial_units.append(units[trial_idx])
+        # units
+        unit_set = set(units)
 
-            t += 1
+        # spikes grouped by unit (ordered as unit_set)
+        if cluster_index is None:
+            cluster_index = ClusterSpikeIndex(units, list(unit_set))
+        else:
+            cluster_index = cluster_index.select(list(unit_set))
 
-        # ... including the last trial
-        trial_idx = np.where((spikes > s1))
-        trial_spikes.append(spikes[trial_idx] - trial_go[t])
-        trial_units.append(units[trial_idx])
+        # trialize the spikes & subtract go cue
+        spike_trial_idx, unit_trial_spikes = trialize_spikes(spikes, units, trial_start, trial_go,
+                                                             unit_ids=list(unit_set))
 
-        trial_spikes = np.array(trial_spikes)
-        trial_units = np.array(trial_units)
+        spike_trial_num = np.full(spikes.shape, np.nan)  # (behavioral) trial number of each spike
+        spike_trial_num[spike_trial_idx >= 0] = np.asarray(trials)[spike_trial_idx[spike_trial_idx >= 0]]
 
         # convert spike data to seconds
         spikes = spikes / hz
         trial_start = trial_start / hz
-        trial_spikes = trial_spikes / hz
-
-        # units
-        unit_set = set(units)
+        unit_trial_spikes = [[spks / hz for spks in unit_spks] for unit_spks in unit_trial_spikes]
 
         # build spike arrays
-        unit_spikes = np.array([spikes[np.where(units == u)] for u in unit_set]) - trial_start[0]
+        unit_spikes = [unit_spks - trial_start[0] for unit_spks in cluster_index.split(spikes)]
 
-        unit_trial_spikes = np.array(
-            [[trial_spikes[t][np.where(trial_units[t] == u)]
-              for t in range(len(trials))] for u in unit_set])
-
-        q_electrodes = lab.ProbeType.Electrode * lab.ElectrodeConfig.Electrode & e_config_key
+        e_config_hash = (lab.ElectrodeConfig & e_config_key).fetch1('electrode_config_hash')
+        electrode_map = lab.get_electrode_map(e_config_key['probe_type'], e_config_hash)
         site2electrode_map = {}
         for recorded_site, (shank, shank_col, shank_row, _) in enumerate(npx_meta.shankmap['data']):
-            site2electrode_map[recorded_site + 1] = (q_electrodes
-                                                     & {'shank': shank + 1,  # this is a 1-indexed pipeline
-                                                        'shank_col': shank_col + 1,
-                                                        'shank_row': shank_row + 1}).fetch1('KEY')
+            site2electrode_map[recorded_site + 1] = electrode_map[(shank + 1,  # this is a 1-indexed pipeline
+                                                                   shank_col + 1,
+                                                                   shank_row + 1)]
 
         spike_sites = np.array([site2electrode_map[s]['electrode'] for s in spike_sites])
-        unit_spike_sites = np.array([spike_sites[np.where(units == u)] for u in unit_set])
-        unit_spike_depths = np.array([spike_depths[np.where(units == u)] for u in unit_set])
+        unit_spike_sites = cluster_index.split(spike_sites)
+        unit_spike_depths = cluster_index.split(spike_depths)
 
         if into_archive:
             log.info('.. inserting clustering timestamp and label')
@@ -260,7 +292,7 @@ class EphysIngest(dj.Imported):
                 'ephys_file': ef_path.relative_to(rigpath).as_posix()},
                 allow_direct_insert=True)
 
-            unit_spike_trial_num = np.array([spike_trial_num[np.where(units == u)] for u in unit_set])
+            unit_spike_trial_num = cluster_index.split(spike_trial_num)
 
             with InsertBuffer(ephys.ArchivedClustering.Unit, 10, skip_duplicates=True,
                               allow_direct_insert=True) as ib:
@@ -340,39 +372,54 @@ class EphysIngest(dj.Imported):
                     if ib.flush():
                         log.debug('.... {}'.format(u))
 
-            # insert Unit.UnitTrial
-            log.info('.. ephys.Unit.UnitTrial')
+            # insert Unit.TrialSpikesCompact
+            log.info('.. ephys.Unit.TrialSpikesCompact')
             dj.conn().ping()
-            with InsertBuffer(ephys.Unit.UnitTrial, 10000, skip_duplicates=True,
+            with InsertBuffer(ephys.Unit.TrialSpikesCompact, 10, skip_duplicates=True,
                               allow_direct_insert=True) as ib:
-
                 for i, u in enumerate(unit_set):
-                    for t in range(len(trials)):
-                        if len(unit_trial_spikes[i][t]):
+                    ib.insert1({**skey,
+                                'insertion_number': probe,
+                                'clustering_method': method,
+                                'unit': u,
+                                **ephys.Unit.TrialSpikesCompact.pack(trials, unit_trial_spikes[i])})
+                    if ib.flush():
+                        log.debug('.... {}'.format(u))
+
+            if get_trial_spikes_layout() == 'both':
+                # insert Unit.UnitTrial
+                log.info('.. ephys.Unit.UnitTrial')
+                dj.conn().ping()
+                with InsertBuffer(ephys.Unit.UnitTrial, 10000, skip_duplicates=True,
+                                  allow_direct_insert=True) as ib:
+
+                    for i, u in enumerate(unit_set):
+                        for t in range(len(trials)):
+                            if len(unit_trial_spikes[i][t]):
+                                ib.insert1({**skey,
+                                            'insertion_number': probe,
+                                            'clustering_method': method,
+                                            'unit': u,
+                                            'trial': trials[t]})
+                                if ib.flush():
+                                    log.debug('.... (u: {}, t: {})'.format(u, t))
+
+                # insert TrialSpikes
+                log.info('.. ephys.Unit.TrialSpikes')
+                dj.conn().ping()
+                with InsertBuffer(ephys.Unit.TrialSpikes, 10000, skip_duplicates=True,
+                                  allow_direct_insert=True) as ib:
+                    for i, u in enumerate(unit_set):
+                        for t in range(len(trials)):
                             ib.insert1({**skey,
                                         'insertion_number': probe,
                                         'clustering_method': method,
                                         'unit': u,
-                                        'trial': trials[t]})
+                                        'trial': trials[t],
+                                        'spike_times': unit_trial_spikes[i][t]})
                             if ib.flush():
                                 log.debug('.... (u: {}, t: {})'.format(u, t))
 
-            # insert TrialSpikes
-            log.info('.. ephys.Unit.TrialSpikes')
-            dj.conn().ping()
-            with InsertBuffer(ephys.Unit.TrialSpikes, 10000, skip_duplicates=True,
-                              allow_direct_insert=True) as ib:
-                for i, u in enumerate(unit_set):
-                    for t in range(len(trials)):
-                        ib.insert1({**skey,
-                                    'insertion_number': probe,
-                                    'clustering_method': method,
-                                    'unit': u,
-                                    'trial': trials[t],
-                                    'spike_times': unit_trial_spikes[i][t]})
-                        if ib.flush():
-                            log.debug('.... (u: {}, t: {})'.format(u, t))
-
             if metrics is not None:
                 metrics.columns = [c.lower() for c in metrics.columns]  # lower-case col names
                 # -- confirm correct attribute names from the PD
@@ -433,12 +480,19 @@ class EphysIngest(dj.Imported):
             log.info('-- ephys ingest for {} - probe {} complete'.format(skey, probe))
 
 
-def do_ephys_ingest(session_key, replace=False, probe_insertion_exists=False, into_archive=False):
+def do_ephys_ingest(session_key, replace=False, probe_insertion_exists=False, into_archive=False,
+                    n_workers=None):
     """
     Perform ephys-ingestion for a particular session (defined by session_key) to either
         + fresh ingest of new probe insertion and clustering results
         + archive existing clustering results and replace with new one (set 'replace=True')
+    With n_workers > 1 (default from `get_ingest_worker_count()`), the clustering results of the probes
+     are loaded in parallel in a pool of worker processes, the insertions are still done
+     probe by probe (in order) in a single transaction
     """
+    if n_workers is None:
+        n_workers = get_ingest_worker_count()
+
     # =========== Find Ephys Recording ============
     key = (experiment.Session & session_key).fetch1()
     sinfo = ((lab.WaterRestriction
@@ -489,25 +543,49 @@ def do_ephys_ingest(session_key, replace=False, probe_insertion_exists=False, in
             raise IdenticalClusterResultError(identical_clustering_results)
 
     def do_insert():
-        # do the insertion per probe for all probes
+        probes = []
         for probe_no, (f, cluster_method, npx_meta) in clustering_files.items():
             insertion_key = {'subject_id': sinfo['subject_id'], 'session': sinfo['session'], 'insertion_number': probe_no}
             if probe_insertion_exists and (ephys.Unit & insertion_key):
                 # if probe_insertion exists and there exists also units for this insertion_key, skip over it
                 continue
-            try:
-                log.info('------ Start loading clustering results for probe: {} ------'.format(probe_no))
-                loader = cluster_loader_map[cluster_method]
-                dj.conn().ping()
-                EphysIngest()._load(loader(sinfo, *f), probe_no, npx_meta, rigpath,
-                                    probe_insertion_exists=probe_insertion_exists, into_archive=into_archive)
-            except (ProbeInsertionError, ClusterMetricError, FileNotFoundError) as e:
-                dj.conn().cancel_transaction()  # either successful ingestion of all probes, or none at all
-                if isinstance(e, ProbeInsertionError):
-                    log.warning('Probe Insertion Error: \n{}. \nSkipping...'.format(str(e)))
-                else:
-                    log.warning('Error: {}'.format(str(e)))
-                return
+            probes.append(probe_no)
+
+        pool = None
+        if n_workers > 1 and len(probes) > 1:
+            # load all probes in parallel - results collected in order below
+            log.info('------ Loading clustering results for probes: {} in {} worker processes ------'.format(
+                probes, min(n_workers, len(probes))))
+            pool = mp.Pool(min(n_workers, len(probes)), initializer=_init_load_worker)
+            loading = {probe_no: pool.apply_async(_load_clustering,
+                                                  (clustering_files[probe_no][1], sinfo, clustering_files[probe_no][0]))
+                       for probe_no in probes}
+
+        try:
+            # do the insertion per probe for all probes
+            for probe_no in probes:
+                f, cluster_method, npx_meta = clustering_files[probe_no]
+                try:
+                    log.info('------ Start loading clustering results for probe: {} ------'.format(probe_no))
+                    if pool is None:
+                        loader = cluster_loader_map[cluster_method]
+                        data = loader(sinfo, *f)
+                    else:
+                        data = loading[probe_no].get()
+                    dj.conn().ping()
+                    EphysIngest()._load(data, probe_no, npx_meta, rigpath,
+                                        probe_insertion_exists=probe_insertion_exists, into_archive=into_archive)
+                except (ProbeInsertionError, ClusterMetricError, FileNotFoundError) as e:
+                    dj.conn().cancel_transaction()  # either successful ingestion of all probes, or none at all
+                    if isinstance(e, ProbeInsertionError):
+                        log.warning('Probe Insertion Error: \n{}. \nSkipping...'.format(str(e)))
+                    else:
+                        log.warning('Error: {}'.format(str(e)))
+                    return
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
     # the insert part
     if dj.conn().in_transaction:
@@ -521,6 +599,24 @@ def do_ephys_ingest(session_key, replace=False, probe_insertion_exists=False, in
             do_insert()
 
 
+def _init_load_worker():
+    """
+    Worker process initializer - use a connection of its own (not the one inherited from the parent process)
+    """
+    dj.conn().connect()
+
+
+def _load_clustering(cluster_method, sinfo, cluster_files):
+    """
+    Load the clustering results of one probe in a worker process
+    File-backed arrays (h5py datasets, memmaps) are read into memory so the results can be sent back
+    """
+    data = cluster_loader_map[cluster_method](sinfo, *cluster_files)
+    return {k: (v[()] if isinstance(v, h5py.Dataset)
+                else np.array(v) if isinstance(v, np.memmap) else v)
+            for k, v in data.items()}
+
+
 def _gen_probe_insert(sinfo, probe, npx_meta, probe_insertion_exists=False):
     '''
     generate probe insertion for session / probe - for neuropixels recording
@@ -565,12 +661,13 @@ def _gen_electrode_config(npx_meta):
     if re.search('(1.0|2.0)', npx_meta.probe_model):
         eg_members = []
         probe_type = {'probe_type': npx_meta.probe_model}
-        q_electrodes = lab.ProbeType.Electrode & probe_type
+        electrode_map = lab.get_electrode_map(npx_meta.probe_model)
         for shank, shank_col, shank_row, is_used in npx_meta.shankmap['data']:
-            electrode = (q_electrodes & {'shank': shank + 1,  # shank is 1-indexed in this pipeline
-                                         'shank_col': shank_col + 1,
-                                         'shank_row': shank_row + 1}).fetch1('KEY')
-            eg_members.append({**electrode, 'is_used': is_used, 'electrode_group': 0})
+            site = (shank + 1, shank_col + 1, shank_row + 1)  # shank is 1-indexed in this pipeline
+            if site not in electrode_map:
+                raise dj.DataJointError('No electrode of probe type {} found at (shank, shank_col, shank_row): {}'.format(
+                    npx_meta.probe_model, site))
+            eg_members.append({**electrode_map[site], 'is_used': is_used, 'electrode_group': 0})
     else:
         raise NotImplementedError('Processing for neuropixels probe model {} not yet implemented'.format(
             npx_meta.probe_model))
@@ -598,6 +695,128 @@ def _gen_electrode_config(npx_meta):
     return e_config
 
 
+# ======== Helpers for spike grouping by cluster ========
+class ClusterSpikeIndex:
+    """
+    Index of the spikes of each cluster (CSR-like: per-cluster start/stop offsets into a cluster-sorted spike order),
+     built with a single stable sort of the spike clusters - so grouping spikes by cluster costs O(spikes log spikes)
+     once per probe, instead of one full scan of the spikes per cluster
+    Spikes of each cluster are kept in their original order
+    """
+
+    def __init__(self, spike_clusters, cluster_ids=None):
+        """
+        :param spike_clusters: array of cluster id per spike
+        :param cluster_ids: ordering of the clusters in the index - default to the sorted unique clusters
+        """
+        spike_clusters = np.asarray(spike_clusters)
+        self.order = np.argsort(spike_clusters, kind='stable')  # spike indices, sorted by cluster
+        self._sorted_clusters = spike_clusters[self.order]
+        self._set_clusters(np.unique(spike_clusters) if cluster_ids is None else cluster_ids)
+
+    def _set_clusters(self, cluster_ids):
+        self.cluster_ids = np.asarray(cluster_ids)
+        self.starts = np.searchsorted(self._sorted_clusters, self.cluster_ids, side='left')
+        self.stops = np.searchsorted(self._sorted_clusters, self.cluster_ids, side='right')
+
+    def select(self, cluster_ids):
+        """
+        New index over the same spikes, for a different selection/ordering of the clusters (no re-sorting)
+        """
+        index = ClusterSpikeIndex.__new__(ClusterSpikeIndex)
+        index.order, index._sorted_clusters = self.order, self._sorted_clusters
+        index._set_clusters(cluster_ids)
+        return index
+
+    @property
+    def spike_counts(self):
+        return self.stops - self.starts
+
+    def spike_indices(self, cluster_id):
+        """
+        Indices (into the spike arrays) of the spikes of one cluster
+        """
+        start = np.searchsorted(self._sorted_clusters, cluster_id, side='left')
+        stop = np.searchsorted(self._sorted_clusters, cluster_id, side='right')
+        return self.order[start:stop]
+
+    def split(self, values):
+        """
+        Group a per-spike array by cluster
+        :param values: array with one value per spike (e.g. spike times, sites, depths)
+        :return: list of arrays, one per cluster (ordered as self.cluster_ids)
+        """
+        values = np.asarray(values)[self.order]
+        return [values[start:stop] for start, stop in zip(self.starts, self.stops)]
+
+
+# ======== Helpers for spike trialization ========
+def find_spike_trials(spikes, trial_start):
+    """
+    Locate the trial of each spike with a sorted search over the trial start times
+    A spike belongs to trial t if trial_start[t] < spike < trial_start[t + 1],
+     the last trial extends to the end of the recording.
+    Spikes before the first trial or falling exactly on a trial start are not assigned.
+    :param spikes: array of spike times
+    :param trial_start: monotonically increasing array of trial start times (same unit as spikes)
+    :return: array of trial indices (into trial_start), one per spike, -1 for unassigned spikes
+    """
+    spikes = np.asarray(spikes)
+    trial_start = np.asarray(trial_start)
+
+    trial_idx = np.searchsorted(trial_start, spikes, side='left') - 1
+    on_trial_start = np.searchsorted(trial_start, spikes, side='right') - 1 != trial_idx
+    trial_idx[on_trial_start] = -1
+
+    return trial_idx
+
+
+def trialize_spikes(spikes, units, trial_start, trial_go, unit_ids=None):
+    """
+    Split the session spike train into per-unit, per-trial spike times relative to the go-cue,
+     in a single pass over the spikes (sorted search + stable sort by unit and trial)
+    :param spikes: array of spike times
+    :param units: array of unit id per spike (same size as spikes)
+    :param trial_start: monotonically increasing array of trial start times (same unit as spikes)
+    :param trial_go: array of go-cue times per trial (same size as trial_start)
+    :param unit_ids: ordering of the units in the output - default to the sorted unique units
+    :return: spike_trial_idx - trial index (into trial_start) per spike, -1 for spikes not in any trial
+             unit_trial_spikes - (unit x trial) nested list of spike times relative to the go-cue of that trial,
+                                 spikes in each trial are kept in their original order
+    """
+    spikes = np.asarray(spikes)
+    units = np.asarray(units)
+    trial_go = np.asarray(trial_go)
+    unit_ids = np.unique(units) if unit_ids is None else np.asarray(unit_ids)
+    trial_count = len(trial_start)
+
+    spike_trial_idx = find_spike_trials(spikes, trial_start)
+
+    # position of each spike's unit in unit_ids
+    unit_sorter = np.argsort(unit_ids)
+    unit_pos = np.searchsorted(unit_ids, units, sorter=unit_sorter)
+    unit_pos = unit_sorter[np.clip(unit_pos, 0, len(unit_ids) - 1)]
+    is_valid = (spike_trial_idx >= 0) & (unit_ids[unit_pos] == units)
+
+    # group spikes by (unit, trial) - stable sorts keep the spike ordering within each group
+    unit_pos, trial_idx = unit_pos[is_valid], spike_trial_idx[is_valid]
+    group_idx = unit_pos * trial_count + trial_idx
+    if max(len(unit_ids), trial_count) <= np.iinfo(np.uint16).max:
+        # two stable passes on 16-bit keys (radix sort) - trial then unit
+        order = np.argsort(trial_idx.astype(np.uint16), kind='stable')
+        order = order[np.argsort(unit_pos[order].astype(np.uint16), kind='stable')]
+    else:
+        order = np.argsort(group_idx, kind='stable')
+    trial_spike_times = (spikes[is_valid] - trial_go[trial_idx])[order]
+
+    group_offsets = np.cumsum(np.bincount(group_idx, minlength=len(unit_ids) * trial_count))
+    group_spikes = np.split(trial_spike_times, group_offsets[:-1])
+
+    unit_trial_spikes = [group_spikes[u * trial_count:(u + 1) * trial_count] for u in range(len(unit_ids))]
+
+    return spike_trial_idx, unit_trial_spikes
+
+
 # ======== Loaders for clustering results ========
 def _decode_notes(fh, notes):
     '''
@@ -820,8 +1039,11 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
     ks.extract_spike_depths()
 
     # ---- Unit-level results ----
+    # -- Spikes grouped by cluster
+    cluster_index = ClusterSpikeIndex(ks.data['spike_clusters'], ks.data['cluster_ids'])
+
     # -- Remove 0-spike units
-    withspike_idx = [i for i, u in enumerate(ks.data['cluster_ids']) if (ks.data['spike_clusters'] == u).any()]
+    withspike_idx = np.where(cluster_index.spike_counts > 0)[0]
 
     valid_units = ks.data['cluster_ids'][withspike_idx]
     valid_unit_labels = ks.data['cluster_groups'][withspike_idx]
@@ -852,7 +1074,8 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
     else:
         vmax_unit_site, unit_xpos, unit_ypos, unit_amp = [], [], [], []
         for unit in valid_units:
-            template_idx = ks.data['spike_templates'][np.where(ks.data['spike_clusters'] == unit)[0][0]]
+            unit_spike_idx = cluster_index.spike_indices(unit)
+            template_idx = ks.data['spike_templates'][unit_spike_idx[0]]
             chn_templates = ks.data['templates'][template_idx, :, :]
             site_idx = np.abs(np.abs(chn_templates).max(axis=0)).argmax()
             vmax_unit_site.append(ks.data['channel_map'][site_idx])
@@ -860,7 +1083,7 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
             unit_xpos.append(ks.data['channel_positions'][site_idx, 0])
             unit_ypos.append(ks.data['channel_positions'][site_idx, 1])
             # unit amp
-            amps = ks.data['amplitudes'][ks.data['spike_clusters'] == unit]
+            amps = ks.data['amplitudes'][unit_spike_idx]
             scaled_templates = np.matmul(chn_templates, ks.data['whitening_mat_inv'])
             best_chn_wf = scaled_templates[:, site_idx] * amps.mean()
             unit_amp.append(best_chn_wf.max() - best_chn_wf.min())
@@ -870,7 +1093,8 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
         dj.conn().ping()
 
         unit_wfs = extract_ks_waveforms(npx_dir, ks, wf_win=[-int(ks.data['templates'].shape[1]/2),
-                                                             int(ks.data['templates'].shape[1]/2)])
+                                                             int(ks.data['templates'].shape[1]/2)],
+                                        cluster_index=cluster_index)
         unit_wav = np.dstack([unit_wfs[u]['mean_wf']
                               for u in valid_units]).transpose((2, 1, 0))  # unit x channel x sample
         unit_snr = [unit_wfs[u]['snr'][np.where(ks.data['channel_map'] == u_site)[0][0]]
@@ -920,7 +1144,8 @@ def _load_kilosort2(sinfo, ks_dir, npx_dir):
         'clustering_label': clustering_label,
         'ks_channel_map': ks.data['channel_map'] + 1,  # channel numbering in this pipeline is 1-based indexed
         'cluster_noise_label': cluster_noise_label,
-        'bitcode_raw': bitcode_raw
+        'bitcode_raw': bitcode_raw,
+        'cluster_index': cluster_index
     }
 
     return data
@@ -1553,45 +1778,95 @@ class Kilosort:
         self._data['spike_sites'] = self.data['channel_map'][spike_site_ind]
 
 
-def extract_ks_waveforms(npx_dir, ks, n_wf=500, wf_win=(-41, 41), bit_volts=None):
+def extract_ks_waveforms(npx_dir, ks, n_wf=500, wf_win=(-41, 41), bit_volts=None, chunk_size=65536, seed=None,
+                         cluster_index=None):
     """
+    Extract the mean waveform and the per-channel SNR of each cluster, from up to "n_wf" randomly selected spikes,
+     in a single streaming pass over the raw data:
+        - the selected spikes of all clusters are sorted by time
+        - the raw .ap.bin is read sequentially in chunks of "chunk_size" samples
+        - per-cluster sums (and sums of squares) of the spike waveforms are accumulated chunk by chunk
+    Memory use (besides the per-cluster accumulators) is bounded by ~ chunk_size x channel x 10 bytes
     :param npx_dir: directory to the ap.bin and ap.meta
     :param ks: instance of Kilosort
     :param n_wf: number of spikes per unit to extract the waveforms
     :param wf_win: number of sample pre and post a spike
     :param bit_volts: scalar required to convert int16 values into microvolts
-    :return: dictionary of the clusters' waveform (sample x channel x spike) and snr per channel for each cluster
+    :param chunk_size: number of samples read from the raw data at a time
+    :param seed: seed for the random selection of the spikes
+    :param cluster_index: ClusterSpikeIndex of the kilosort spikes (built from ks.data['spike_clusters'] if not provided)
+    :return: dictionary of the clusters' mean waveform (sample x channel) and snr per channel for each cluster
     """
     bin_fp = next(pathlib.Path(npx_dir).glob('*.ap.bin'))
     meta_fp = next(pathlib.Path(npx_dir).glob('*.ap.meta'))
 
     meta = NeuropixelsMeta(meta_fp)
-    channel_num = meta.meta['nSavedChans']
 
     if bit_volts is None:
         bit_volts = npx_bit_volts[re.match('neuropixels (\d.0)', meta.probe_model).group()]
 
-    raw_data = np.memmap(bin_fp, dtype='int16', mode='r')
-    data = np.reshape(raw_data, (int(raw_data.size / channel_num), channel_num))
+    raw_data = readSGLX.makeMemMapRaw(bin_fp, readSGLX.readMeta(bin_fp))  # (channel x sample)
+    sample_count = raw_data.shape[1]
 
     chan_map = ks.data['channel_map']
+    cluster_ids = ks.data['cluster_ids']
+    wf_len = wf_win[-1] - wf_win[0]
 
-    unit_wfs = {}
-    for unit in tqdm(ks.data['cluster_ids']):
-        spikes = ks.data['spike_times'][ks.data['spike_clusters'] == unit]
-        np.random.shuffle(spikes)
-        spikes = spikes[:n_wf]
+    # ---- randomly select up to n_wf spikes per cluster ----
+    rng = np.random.default_rng(seed)
+    if cluster_index is None:
+        cluster_index = ClusterSpikeIndex(ks.data['spike_clusters'], cluster_ids)
+    else:
+        cluster_index = cluster_index.select(cluster_ids)
+
+    wf_starts, wf_clusters = [], []
+    for cluster_idx, cluster_spikes in enumerate(cluster_index.split(np.asarray(ks.data['spike_times'], dtype=np.int64))):
+        spikes = rng.permutation(cluster_spikes)[:n_wf]
         # ignore spikes at the beginning or end of raw data
-        spikes = spikes[np.logical_and(spikes > wf_win[0], spikes < data.shape[0] - wf_win[-1])]
+        spikes = spikes[np.logical_and(spikes + wf_win[0] >= 0, spikes + wf_win[-1] <= sample_count)]
+        wf_starts.append(spikes + wf_win[0])
+        wf_clusters.append(np.full(len(spikes), cluster_idx))
+
+    wf_starts = np.concatenate(wf_starts)
+    wf_clusters = np.concatenate(wf_clusters)
+
+    # ---- sort the selected spikes of all clusters by time, and stream through the raw data ----
+    time_order = np.argsort(wf_starts, kind='stable')
+    wf_starts, wf_clusters = wf_starts[time_order], wf_clusters[time_order]
+
+    wf_sum = np.zeros((len(cluster_ids), wf_len, len(chan_map)))  # (cluster x sample x channel)
+    wf_sq_sum = np.zeros((len(cluster_ids), len(chan_map)))  # (cluster x channel)
+    wf_count = np.zeros(len(cluster_ids), dtype=int)
+
+    batch_size = max(1, int(chunk_size / wf_len))  # waveforms gathered at a time
+    chunk_bounds = np.searchsorted(wf_starts, np.arange(0, sample_count + chunk_size, chunk_size))
+    for s0, s1 in tqdm(list(zip(chunk_bounds[:-1], chunk_bounds[1:]))):
+        if s0 == s1:
+            continue
+        chunk_start = wf_starts[s0]
+        chunk = np.asarray(raw_data[:, chunk_start:wf_starts[s1 - 1] + wf_len][chan_map, :])  # (channel x sample)
+
+        for b0 in range(s0, s1, batch_size):
+            b1 = min(b0 + batch_size, s1)
+            sample_idx = (wf_starts[b0:b1] - chunk_start)[:, None] + np.arange(wf_len)
+            spike_wfs = chunk[:, sample_idx].transpose((1, 2, 0)).astype(float)  # (spike x sample x channel)
+
+            # accumulate per cluster
+            cluster_sort = np.argsort(wf_clusters[b0:b1], kind='stable')
+            clusters, first_idx = np.unique(wf_clusters[b0:b1][cluster_sort], return_index=True)
+            spike_wfs = spike_wfs[cluster_sort]
+            wf_sum[clusters] += np.add.reduceat(spike_wfs, first_idx, axis=0)
+            wf_sq_sum[clusters] += np.add.reduceat((spike_wfs ** 2).sum(axis=1), first_idx, axis=0)
+            wf_count[clusters] += np.diff(np.append(first_idx, len(cluster_sort)))
 
+    unit_wfs = {}
+    for cluster_idx, unit in enumerate(cluster_ids):
         unit_wfs[unit] = {}
-        if len(spikes) > 0:
-            # waveform at each spike: (sample x channel x spike)
-            spike_wfs = np.dstack([data[int(spk+wf_win[0]):int(spk+wf_win[-1]), chan_map] for spk in spikes])
-            spike_wfs = spike_wfs * bit_volts
-            unit_wfs[unit]['snr'] = [calculate_wf_snr(chn_wfs)
-                                     for chn_wfs in spike_wfs.transpose((1, 2, 0))]  # (channel x spike x sample)
-            unit_wfs[unit]['mean_wf'] = np.nanmean(spike_wfs, axis=2)
+        n = wf_count[cluster_idx]
+        if n > 0:
+            mean_wf = wf_sum[cluster_idx] / n  # (sample x channel)
+            unit_wfs[unit]['snr'] = calculate_wf_snr_from_sums(mean_wf, wf_sq_sum[cluster_idx], n)
+            unit_wfs[unit]['mean_wf'] = mean_wf * bit_volts
         else:  # if no spike found, return NaN of size (sample x channel x 1)
             unit_wfs[unit]['snr'] = np.full((1, len(chan_map)), np.nan)
             unit_wfs[unit]['mean_wf'] = np.full((len(range(*wf_win)), len(chan_map)), np.nan)
@@ -1620,6 +1895,27 @@ def calculate_wf_snr(W):
     return snr if not np.isinf(snr) else 0
 
 
+def calculate_wf_snr_from_sums(W_bar, W_sq_sum, n):
+    """
+    Per-channel SNR of spike waveforms (same as calculate_wf_snr) from accumulated sums,
+     i.e. without holding all the waveforms in memory
+
+    Input:
+    W_bar : mean waveform (samples x channels)
+    W_sq_sum : sum over spikes and samples of the squared waveforms (channels,)
+    n : number of spikes
+
+    Output:
+    snr : signal-to-noise ratio per channel (channels,)
+    """
+    A = W_bar.max(axis=0) - W_bar.min(axis=0)
+    # the residuals (W - W_bar) have zero mean - their variance is mean(W^2) - mean(W_bar^2)
+    e_var = (W_sq_sum - n * (W_bar ** 2).sum(axis=0)) / (n * W_bar.shape[0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        snr = A / (2 * np.sqrt(np.clip(e_var, 0, None)))
+    return np.where(np.isinf(snr), 0, snr)
+
+
 def extract_clustering_info(cluster_output_dir, cluster_method):
     creation_time = None
 
@@ -1684,6 +1980,41 @@ def read_SGLX_bin(sglx_bin_fp, chan_list):
     return data, sampling_rate
 
 
+def read_SGLX_bin_windows(sglx_bin_fp, chan_list, windows, chunk_size=1000000):
+    """
+    Read the gain-corrected data of a set of channels within a set of sample windows of a SpikeGLX .bin file
+     - all channels are read together, and only the requested sample ranges are read from the memory map,
+       chunk by chunk (gain correction applied per chunk), so memory use scales with the windows, not the recording
+    :param sglx_bin_fp: path to the SpikeGLX .bin file (with its .meta file alongside)
+    :param chan_list: list of (saved) channel indices
+    :param windows: list of (start, stop) sample indices - python slice semantics (e.g. stop = -1 or None)
+    :param chunk_size: number of samples read from the memory map at a time
+    :return: list of (channel x sample) arrays (uV for imec, mV for nidq), one per window; sampling rate
+    """
+    meta = readSGLX.readMeta(sglx_bin_fp)
+    sampling_rate = readSGLX.SampRate(meta)
+    raw_data = readSGLX.makeMemMapRaw(sglx_bin_fp, meta)
+
+    if meta['typeThis'] == 'imec':
+        # apply gain correction and convert to uV
+        gain_correct, scale = readSGLX.GainCorrectIM, 1e6
+    else:
+        # apply gain correction and convert to mV
+        gain_correct, scale = readSGLX.GainCorrectNI, 1e3
+
+    windows_data = []
+    for start, stop in windows:
+        start, stop, _ = slice(start, stop).indices(raw_data.shape[1])
+        data = np.empty((len(chan_list), max(stop - start, 0)))
+        for chunk_start in range(start, stop, chunk_size):
+            chunk_stop = min(chunk_start + chunk_size, stop)
+            data[:, chunk_start - start:chunk_stop - start] = scale * gain_correct(
+                raw_data[chan_list, chunk_start:chunk_stop], chan_list, meta)
+        windows_data.append(data)
+
+    return windows_data, sampling_rate
+
+
 # ====== Methods for reprocessing of ephys ingestion ======
 def extend_ephys_ingest(session_key):
     """
@@ -1837,6 +2168,8 @@ def archive_ingested_clustering_results(key, archive_trial_spike=False):
             log.info('Delete clustering data and associated analysis results')
             (ephys.Unit & key).delete()
             (EphysIngest.EphysFile & key).delete(force=True)
+            (psth.ProbeSpikeCountCube & key).delete()
+            (psth_foraging.UnitPeriodActivity & key).delete()
             (report.SessionLevelCDReport & key).delete()
             (report.ProbeLevelPhotostimEffectReport & key).delete()
             (report.ProbeLevelReport & key).delete()
@@ -1848,3 +2181,5 @@ def archive_ingested_clustering_results(key, archive_trial_spike=False):
     else:
         with dj.conn().transaction:
             copy_and_delete()
+
+    psth.clear_spike_count_cube_cache()
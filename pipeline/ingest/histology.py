@@ -93,7 +93,8 @@ class HistologyIngest(dj.Imported):
 
         # electrode configuration
         self.egroup = (ephys.ProbeInsertion * lab.ElectrodeConfig.ElectrodeGroup & key).fetch1('KEY')
-        self.shanks = np.unique((lab.ElectrodeConfig.Electrode * lab.ProbeType.Electrode & self.egroup).fetch('shank'))
+        self.e_config_hash = (lab.ElectrodeConfig & self.egroup).fetch1('electrode_config_hash')
+        self.shanks = np.unique(lab.get_electrodes(self.egroup['probe_type'], self.e_config_hash)['shank'])
 
         # behavior_file
         if not ((behavior_ingest.BehaviorIngest.BehaviorFile + behavior_ingest.BehaviorBpodIngest.BehaviorFile) & key):
@@ -189,8 +190,9 @@ class HistologyIngest(dj.Imported):
                 # probe CCF regions
                 ont_ids = np.where(np.isnan(hist.ont.id), 0, hist.ont.id)
 
-                probe_electrodes = (ephys.ProbeInsertion.proj() * lab.ProbeType.Electrode & self.egroup
-                                    & {'shank': shank_no}).fetch(as_dict=True, order_by='electrode asc')
+                probe_electrodes = lab.get_electrodes(self.egroup['probe_type'])
+                probe_electrodes = [dict(zip(probe_electrodes.dtype.names, e))
+                                    for e in probe_electrodes[probe_electrodes['shank'] == shank_no]]
 
                 if len(ont_ids) < len(probe_electrodes):
                     raise HistologyFileError('Expecting at minimum {} electrodes - found {}'.format(
@@ -199,32 +201,22 @@ class HistologyIngest(dj.Imported):
                 ont_ids = ont_ids[:len(probe_electrodes)]
                 pos_xyz = pos_xyz[:len(probe_electrodes), :]
 
-                recording_electrodes = (ephys.ProbeInsertion.proj() * lab.ElectrodeConfig.Electrode.proj()
-                                        * lab.ProbeType.Electrode.proj('shank')
-                                        & self.egroup & {'shank': shank_no}).fetch(
-                    'electrode', order_by='electrode asc')
+                recording_electrodes = lab.get_electrodes(self.egroup['probe_type'], self.e_config_hash)
+                recording_electrodes = recording_electrodes['electrode'][recording_electrodes['shank'] == shank_no]
 
-                recs = ({**electrode, **self.egroup, 'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
+                recs = [{**electrode, **self.egroup, 'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
                          'ccf_x': int(ccf_x), 'ccf_y': int(ccf_y), 'ccf_z': int(ccf_z),
                          'mri_x': mri_x, 'mri_y': mri_y, 'mri_z': mri_z}
                         for electrode, (ccf_x, ccf_y, ccf_z, mri_x, mri_y, mri_z), ont_id in
                         zip(probe_electrodes, pos_xyz, ont_ids)
-                        if ont_id > 0 and electrode['electrode'] in recording_electrodes)
+                        if ont_id > 0 and electrode['electrode'] in recording_electrodes]
 
                 # ideally ElectrodePosition.insert(...) but some are outside of CCF...
                 log.info('inserting channel ccf position')
                 histology.ElectrodeCCFPosition.insert1(self.egroup, ignore_extra_fields=True,
                                                        skip_duplicates=True)
 
-                for r in recs:
-                    log.debug('... adding probe/position: {}'.format(r))
-                    try:
-                        histology.ElectrodeCCFPosition.ElectrodePosition.insert1(
-                            r, ignore_extra_fields=True, allow_direct_insert=True)
-                    except Exception as e:  # XXX: no way to be more precise in dj
-                        # log.warning('... ERROR!: {}'.format(repr(e)))
-                        histology.ElectrodeCCFPosition.ElectrodePositionError.insert1(
-                            r, ignore_extra_fields=True, allow_direct_insert=True)
+                _insert_electrode_positions(recs, ignore_extra_fields=True, allow_direct_insert=True)
 
                 log.info('... ok.')
 
@@ -274,9 +266,8 @@ class HistologyIngest(dj.Imported):
                 pos_xyz = ccf_res * np.around(pos_xyz / ccf_res)
 
                 # get recording geometry,
-                probe_electrodes = (lab.ProbeType.Electrode
-                                    & (ephys.ProbeInsertion & self.egroup)
-                                    & {'shank': shank_no}).fetch(order_by='electrode asc')
+                probe_electrodes = lab.get_electrodes(self.egroup['probe_type'])
+                probe_electrodes = probe_electrodes[probe_electrodes['shank'] == shank_no]
 
                 rec_electrodes = np.array(
                     [chn_loc_data['channels']['lateral'],
@@ -285,9 +276,8 @@ class HistologyIngest(dj.Imported):
                 # adjusting for the lateral offset
                 # npx 1.0 probes has an alternating offset of 0um and 16um between the rows
                 # npx 2.0 probes do not have this offset (i.e. offset = 0um for all rows)
-                lateral_offset = np.abs(np.diff((lab.ProbeType.Electrode & self.egroup
-                                                 & {'shank_col': 1, 'shank': shank_no}
-                                                 & 'shank_row in (1, 2)').fetch('x_coord'))[0])
+                lateral_offset = np.abs(np.diff(probe_electrodes['x_coord'][
+                    (probe_electrodes['shank_col'] == 1) & np.isin(probe_electrodes['shank_row'], (1, 2))])[0])
                 if lateral_offset:
                     rec_electrodes[:, 0] = (lateral_offset * (np.floor(
                         rec_electrodes[:, 0] / lateral_offset)))
@@ -309,6 +299,7 @@ class HistologyIngest(dj.Imported):
                 histology.ElectrodeCCFPosition.insert1(
                     self.egroup, ignore_extra_fields=True, skip_duplicates=True)
 
+                recs = []
                 for z in zip(probe_electrodes[rec_to_elec_idx]['electrode'],
                              pos_xyz[:, 0], pos_xyz[:, 1], pos_xyz[:, 2]):
 
@@ -319,13 +310,9 @@ class HistologyIngest(dj.Imported):
                             # via nullable: 'mri_x': 0, 'mri_y': 0, 'mri_z': 0
 
                     log.debug('...... adding ElectrodePosition: {}'.format(rec))
+                    recs.append(rec)
 
-                    try:
-                        histology.ElectrodeCCFPosition.ElectrodePosition.insert1(rec)
-                    except Exception as e:  # XXX: no way to be more precise in dj
-                        log.warning('...... ElectrodePositionError: {}'.format(
-                            repr(e)))
-                        histology.ElectrodeCCFPosition.ElectrodePositionError.insert1(rec)
+                _insert_electrode_positions(recs)
 
         return True
 
@@ -566,6 +553,34 @@ class HistologyIngest(dj.Imported):
 # ================== HELPER FUNCTIONS ====================
 
 
+def _insert_electrode_positions(recs, **insert_args):
+    """
+    Insert ElectrodeCCFPosition.ElectrodePosition records
+    Electrodes at annotated CCF voxels (looked up in the CCF annotation volume) are inserted at once,
+     the others one at a time - falling back to ElectrodePositionError if outside of the CCF
+    If the batch insert fails, all electrodes are inserted one at a time
+    """
+    if not recs:
+        return
+
+    ccf_volume = ccf.get_annotation_volume(ccf.CCFLabel.CCF_R3_20UM_ID)
+    in_ccf = ccf_volume.is_annotated(*np.array([(r['ccf_x'], r['ccf_y'], r['ccf_z']) for r in recs]).T)
+
+    try:
+        histology.ElectrodeCCFPosition.ElectrodePosition.insert(
+            [r for r, r_in_ccf in zip(recs, in_ccf) if r_in_ccf], **insert_args)
+    except Exception as e:  # XXX: no way to be more precise in dj
+        log.warning('...... batch ElectrodePosition insert failed ({}) - inserting one at a time'.format(repr(e)))
+        in_ccf = np.zeros(len(recs), dtype=bool)
+
+    for r in (r for r, r_in_ccf in zip(recs, in_ccf) if not r_in_ccf):
+        try:
+            histology.ElectrodeCCFPosition.ElectrodePosition.insert1(r, **insert_args)
+        except Exception as e:  # XXX: no way to be more precise in dj
+            log.debug('...... ElectrodePositionError: {}'.format(repr(e)))
+            histology.ElectrodeCCFPosition.ElectrodePositionError.insert1(r, **insert_args)
+
+
 def archive_electrode_histology(insertion_key, note='', delete=False):
     """
     For the specified "insertion_key" copy from histology.ElectrodeCCFPosition and histology.LabeledProbeTrack
@@ -1,5 +1,6 @@
 
 import os
+import re
 import logging
 import pathlib
 from glob import glob
@@ -7,6 +8,7 @@ from datetime import datetime
 import uuid
 
 import numpy as np
+import pandas as pd
 import datajoint as dj
 
 from pipeline import lab
@@ -14,6 +16,7 @@ from pipeline import tracking
 from pipeline import experiment
 from pipeline.ingest import behavior as behavior_ingest
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from .. import get_schema_name
 
 schema = dj.schema(get_schema_name('ingest_tracking'))
@@ -42,6 +45,24 @@ def get_tracking_paths():
     return dj.config.get('custom', {}).get('tracking_data_paths', None)
 
 
+def get_tracking_load_threads():
+    """
+    retrieve the number of threads used to read the tracking files of a session in parallel
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'tracking.load_threads': 4
+        }
+        ...
+      }
+
+    default to 4
+    """
+    return int(dj.config.get('custom', {}).get('tracking.load_threads', 4))
+
+
 @schema
 class TrackingIngest(dj.Imported):
     definition = """
@@ -63,6 +84,21 @@ class TrackingIngest(dj.Imported):
                               'bottom': ('bottom', 'bottom_face'),
                               'body': ('body', 'side_body')}
 
+    tracking_part_tables = {'nose': tracking.Tracking.NoseTracking,
+                            'tongue': tracking.Tracking.TongueTracking,
+                            'jaw': tracking.Tracking.JawTracking,
+                            'paw_left': tracking.Tracking.LeftPawTracking,
+                            'paw_right': tracking.Tracking.RightPawTracking,
+                            'lickport': tracking.Tracking.LickPortTracking,
+                            'whisker': tracking.Tracking.WhiskerTracking}
+
+    tracking_field_mapper = {'paw_left': {'paw_left_x': 'left_paw_x',
+                                          'paw_left_y': 'left_paw_y',
+                                          'paw_left_likelihood': 'left_paw_likelihood'},
+                             'paw_right': {'paw_right_x': 'right_paw_x',
+                                           'paw_right_y': 'right_paw_y',
+                                           'paw_right_likelihood': 'right_paw_likelihood'}}
+
     def make(self, key, tracking_exists=False):
         '''
         TrackingIngest .make() function
@@ -84,6 +120,7 @@ class TrackingIngest(dj.Imported):
                               if session_rig == 'RRig-MTL'
                               else 'tracking_device in ("Camera 0", "Camera 1", "Camera 2")')
 
+        tracking_recs = defaultdict(list)  # {feature: [tracking records]} - for all devices and trials
         tracking_files = []
         for device in (tracking.TrackingDevice & camera_restriction).fetch(as_dict=True):
             tdev = device['tracking_device']
@@ -151,111 +188,82 @@ class TrackingIngest(dj.Imported):
 
             log.info('loading tracking data for {} trials'.format(n_tmap))
 
-            i = 0
-            for t in tmap:  # load tracking for trial
+            # index the session's tracking files by trial once - ex: dl59_side_1(-0000).csv
+            trial_files = _index_tracking_files(tracking_sess_dir, h2o, tpos, csv_file_ending)
+
+            trial_filepaths = {}
+            for t in tmap:
                 if tmap[t] not in trials:
                     log.warning('nonexistant trial {}.. skipping'.format(t))
                     continue
 
-                i += 1
+                tracking_trial_filepath = trial_files.get(str(t), [])
 
-                # ex: dl59_side_1(-0000).csv
-                tracking_trial_filename = '{}*_{}_{}{}.csv'.format(h2o, tpos, t, csv_file_ending)
-                tracking_trial_filepath = list(tracking_sess_dir.glob(tracking_trial_filename))
-
-                if not tracking_trial_filepath or len(tracking_trial_filepath) > 1:
+                if len(tracking_trial_filepath) != 1:
                     log.debug('file mismatch: file: {} trial: {} ({})'.format(
                         t, tmap[t], tracking_trial_filepath))
                     continue
 
-                if i % 50 == 0:
-                    log.info('item {}/{}, trial #{} ({:.2f}%)'
-                             .format(i, n_tmap, t, (i/n_tmap)*100))
-                else:
-                    log.debug('item {}/{}, trial #{} ({:.2f}%)'
-                              .format(i, n_tmap, t, (i/n_tmap)*100))
+                trial_filepaths[t] = tracking_trial_filepath[0]
 
-                tracking_trial_filepath = tracking_trial_filepath[-1]
+            def load_trial_tracking(tracking_trial_filepath):
                 try:
-                    trk = self.load_tracking(tracking_trial_filepath)
+                    return self.load_tracking(tracking_trial_filepath)
                 except Exception as e:
                     log.warning('Error loading .csv: {}\n{}'.format(
                         tracking_trial_filepath, str(e)))
                     raise e
 
-                recs = {}
-                rec_base = dict(key, trial=tmap[t], tracking_device=tdev)
-
-                for k in trk:
-                    if k == 'samples':
-                        recs['tracking'] = {
-                            **rec_base,
-                            'tracking_samples': len(trk['samples']['ts']),
-                        }
-                    else:
-                        rec = dict(rec_base)
-
-                        for attr in trk[k]:
-                            rec_key = '{}_{}'.format(k, attr)
-                            rec[rec_key] = np.array(trk[k][attr])
-
-                        recs[k] = rec
-
-                tracking.Tracking.insert1(
-                    recs['tracking'], allow_direct_insert=True)
-
-                if 'nose' in recs:
-                    tracking.Tracking.NoseTracking.insert1(
-                        recs['nose'], allow_direct_insert=True)
-
-                if 'tongue' in recs:
-                    tracking.Tracking.TongueTracking.insert1(
-                        recs['tongue'], allow_direct_insert=True)
+            # read the tracking files in parallel threads
+            with ThreadPoolExecutor(max_workers=get_tracking_load_threads()) as executor:
+                trial_trks = executor.map(load_trial_tracking, trial_filepaths.values())
 
-                if 'jaw' in recs:
-                    tracking.Tracking.JawTracking.insert1(
-                        recs['jaw'], allow_direct_insert=True)
+                i = 0
+                for (t, tracking_trial_filepath), trk in zip(trial_filepaths.items(), trial_trks):
+                    i += 1
 
-                if 'paw_left' in recs:
-                    fmap = {'paw_left_x': 'left_paw_x',  # remap field names
-                            'paw_left_y': 'left_paw_y',
-                            'paw_left_likelihood': 'left_paw_likelihood'}
-
-                    tracking.Tracking.LeftPawTracking.insert1({
-                        **{k: v for k, v in recs['paw_left'].items()
-                           if k not in fmap},
-                        **{fmap[k]: v for k, v in recs['paw_left'].items()
-                           if k in fmap}}, allow_direct_insert=True)
+                    if i % 50 == 0:
+                        log.info('item {}/{}, trial #{} ({:.2f}%)'
+                                 .format(i, n_tmap, t, (i/n_tmap)*100))
+                    else:
+                        log.debug('item {}/{}, trial #{} ({:.2f}%)'
+                                  .format(i, n_tmap, t, (i/n_tmap)*100))
 
-                if 'paw_right' in recs:
-                    fmap = {'paw_right_x': 'right_paw_x',  # remap field names
-                            'paw_right_y': 'right_paw_y',
-                            'paw_right_likelihood': 'right_paw_likelihood'}
+                    rec_base = dict(key, trial=tmap[t], tracking_device=tdev)
 
-                    tracking.Tracking.RightPawTracking.insert1({
-                        **{k: v for k, v in recs['paw_right'].items()
-                           if k not in fmap},
-                        **{fmap[k]: v for k, v in recs['paw_right'].items()
-                           if k in fmap}}, allow_direct_insert=True)
+                    for k in trk:
+                        if k == 'samples':
+                            tracking_recs['tracking'].append({
+                                **rec_base,
+                                'tracking_samples': len(trk['samples']['ts']),
+                            })
+                        else:
+                            rec = dict(rec_base)
+                            fmap = self.tracking_field_mapper.get(k, {})  # remap field names
 
-                if 'lickport' in recs:
-                    tracking.Tracking.LickPortTracking.insert1(
-                        recs['lickport'], allow_direct_insert=True)
+                            for attr in trk[k]:
+                                rec_key = '{}_{}'.format(k, attr)
+                                rec[fmap.get(rec_key, rec_key)] = trk[k][attr]
 
-                # special handling for whisker(s)
-                whisker_keys = [k for k in recs if 'whisker' in k]
-                tracking.Tracking.WhiskerTracking.insert([
-                    {**recs[k], 'whisker_name': k} for k in whisker_keys],
-                    allow_direct_insert=True)
+                            if 'whisker' in k:  # special handling for whisker(s)
+                                tracking_recs['whisker'].append({**rec, 'whisker_name': k})
+                            else:
+                                tracking_recs[k].append(rec)
 
-                tracking_files.append({
-                    **key, 'trial': tmap[t], 'tracking_device': tdev,
-                    'tracking_file': tracking_trial_filepath.relative_to(tracking_root_dir).as_posix()})
+                    tracking_files.append({
+                        **key, 'trial': tmap[t], 'tracking_device': tdev,
+                        'tracking_file': tracking_trial_filepath.relative_to(tracking_root_dir).as_posix()})
 
             log.info('... completed {}/{} items.'.format(i, n_tmap))
 
         log.info('\n---------------------')
         if tracking_files:
+            # one batched insert per table for the session
+            tracking.Tracking.insert(tracking_recs.pop('tracking'), allow_direct_insert=True)
+            for k, recs in tracking_recs.items():
+                if k in self.tracking_part_tables:
+                    self.tracking_part_tables[k].insert(recs, allow_direct_insert=True)
+
             if not tracking_exists:
                 self.insert1(key)
             self.TrackingFile.insert(tracking_files)
@@ -291,7 +299,7 @@ class TrackingIngest(dj.Imported):
         the special 'feature'/'attr' pair "samples"/"ts" is used to store
         the first column/sample timestamp for each row in the input file.
         '''
-        res = defaultdict(lambda: defaultdict(list))
+        res = defaultdict(dict)
 
         with open(trkpath, 'r') as f:
             f.readline()  # discard 1st line
@@ -299,21 +307,49 @@ class TrackingIngest(dj.Imported):
             parts = parts.rstrip().split(',')
             fields = fields.rstrip().split(',')
 
-            for l in f:
-                if l.strip():
-                    lv = l.rstrip().split(',')
-                    for i, v in enumerate(lv):
-                        v = float(v)
-                        if i == 0:
-                            res['samples']['ts'].append(v)
-                        else:
-                            res[parts[i]][fields[i]].append(v)
+            try:
+                values = pd.read_csv(f, header=None, dtype=float, float_precision='round_trip').values
+            except pd.errors.EmptyDataError:
+                return res
+
+        res['samples']['ts'] = values[:, 0]
+
+        columns = defaultdict(list)  # {(part, field): [column indices]}
+        for i, (part, field) in enumerate(zip(parts, fields)):
+            if i > 0:
+                columns[(part, field)].append(i)
+
+        for (part, field), i in columns.items():
+            # repeated (part, field) columns are interleaved row by row
+            res[part][field] = values[:, i[0]] if len(i) == 1 else values[:, i].flatten()
 
         return res
 
 
 # ======== Helpers for directory navigation ========
 
+def _index_tracking_files(tracking_sess_dir, h2o, tpos, csv_file_ending):
+    """
+    Scan the session tracking directory once and index the tracking files by trial
+     - equivalent to globbing '{h2o}*_{tpos}_{trial}{csv_file_ending}.csv' for each trial
+    :param tracking_sess_dir: the directory containing the session's tracking data
+    :param h2o: water restriction number
+    :param tpos: camera position (as in the file names)
+    :param csv_file_ending: '-*' for filenames containing '-0000', '' otherwise
+    :return: dictionary of {trial (str): [tracking file paths]}
+    """
+    fn_pattern = re.compile(r'{}.*_{}_(\d+){}\.csv$'.format(
+        re.escape(h2o), re.escape(tpos), '-.*' if csv_file_ending else ''), re.DOTALL)
+
+    trial_files = defaultdict(list)
+    for fp in tracking_sess_dir.glob('{}*_{}_*.csv'.format(h2o, tpos)):
+        match = fn_pattern.match(fp.name)
+        if match:
+            trial_files[match.group(1)].append(fp)
+
+    return trial_files
+
+
 def _get_same_day_session_order(session):
     """
     Given the session information, return the ordering of that session for that animal in the day
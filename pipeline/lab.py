@@ -369,6 +369,55 @@ class ElectrodeConfig(dj.Lookup):
         """
 
 
+# ---- Process-level cache of the probe electrodes ----
+
+_electrode_cache = {}
+
+
+def get_electrodes(probe_type, electrode_config_hash=None):
+    """
+    Return the electrodes (ordered by electrode) of a probe type - ProbeType.Electrode,
+     or of an electrode configuration of that probe type - ProbeType.Electrode * ElectrodeConfig.Electrode
+    Cached in this process - i.e. one query per probe type / electrode configuration
+    :param probe_type: probe type, e.g. 'neuropixels 1.0 - 3B'
+    :param electrode_config_hash: (optional) electrode_config_hash of the ElectrodeConfig
+    :return: record array of the electrodes
+    """
+    cache_key = (probe_type, electrode_config_hash)
+    if cache_key not in _electrode_cache:
+        if electrode_config_hash is None:
+            q_electrodes = ProbeType.Electrode & {'probe_type': probe_type}
+        else:
+            q_electrodes = (ProbeType.Electrode * ElectrodeConfig.Electrode
+                            & (ElectrodeConfig & {'probe_type': probe_type,
+                                                  'electrode_config_hash': electrode_config_hash}))
+        electrodes = q_electrodes.fetch(order_by='electrode')
+        if not len(electrodes):  # not (yet) created - do not cache
+            return electrodes
+        _electrode_cache[cache_key] = electrodes
+
+    return _electrode_cache[cache_key]
+
+
+def get_electrode_map(probe_type, electrode_config_hash=None):
+    """
+    Map the (shank, shank_col, shank_row) position (1-indexed) to the electrode key of
+     a probe type (ProbeType.Electrode key)
+     or of an electrode configuration (ElectrodeConfig.Electrode key) - see get_electrodes()
+    """
+    pk = ProbeType.Electrode.primary_key if electrode_config_hash is None else ElectrodeConfig.Electrode.primary_key
+    return {(e['shank'], e['shank_col'], e['shank_row']): {k: e[k].item() if isinstance(e[k], np.generic) else e[k]
+                                                           for k in pk}  # native types, as in fetch1('KEY')
+            for e in get_electrodes(probe_type, electrode_config_hash)}
+
+
+def clear_electrode_cache():
+    """
+    Clear the process-level electrode cache (e.g. after (re)creating ProbeType.Electrode)
+    """
+    _electrode_cache.clear()
+
+
 @schema
 class Probe(dj.Lookup):
     definition = """  # represent a physical probe
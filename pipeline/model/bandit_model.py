@@ -745,3 +745,281 @@ class BanditModel:
         if self.if_fit_mode:
             # Allow the final update of action prob after the last trial (for comparing with ephys)
             action = self.act()
+
+
+# =============================================================================
+#  Batch simulation: many agents of one forager, vectorized over the agent axis
+# =============================================================================
+
+BATCH_FORAGERS = ('Random', 'pMatching', 'LossCounting', 'RW1972_epsi', 'RW1972_softmax', 'LNP_softmax',
+                  'Bari2019', 'Hattori2019', 'RW1972_softmax_CK', 'LNP_softmax_CK', 'Bari2019_CK', 'Hattori2019_CK',
+                  'CANN', 'Synaptic')
+
+
+def generate_p_reward_rng(rng, n_trials, p_reward_pairs, block_size_base=global_block_size_mean,
+                          block_size_sd=global_block_size_sd):
+    '''
+    Same block structure as BanditModel.generate_p_reward(), but drawn from the random generator rng
+    Returns p_reward [2, n_trials + 1] and block sizes
+    '''
+    n_trials_now = 0
+    block_size = []
+    n_trials = n_trials + 1
+    p_reward = np.zeros([2, n_trials])
+
+    while n_trials_now < n_trials:
+        # At least one trial per block
+        n_trials_this_block = max(int(np.rint(rng.normal(block_size_base, block_size_sd))), 1)
+        n_trials_this_block = min(n_trials_this_block, n_trials - n_trials_now)
+        block_size.append(n_trials_this_block)
+
+        # If we had equal p_reward in the last block, we should not let it happen again immediately
+        if n_trials_now > 0 and not(np.diff(p_reward_this_block)):
+            pair_idx = rng.choice(len(p_reward_pairs) - 1)
+        else:
+            pair_idx = rng.choice(len(p_reward_pairs))
+        p_reward_this_block = np.array([p_reward_pairs[pair_idx]])
+
+        # To ensure flipping of p_reward during transition (Marton)
+        if len(block_size) % 2:
+            p_reward_this_block = np.flip(p_reward_this_block)
+
+        p_reward[:, n_trials_now: n_trials_now + n_trials_this_block] = p_reward_this_block.T
+        n_trials_now += n_trials_this_block
+
+    return p_reward, np.array(block_size)
+
+
+class BanditModelBatch:
+    '''
+    Run N agents of one forager together in the generative mode, as array operations over the agent axis.
+    Each agent is a separate BanditModel(forager, **its parameters).simulate(): it depends only on its own parameters
+    and random seed (all its random numbers are drawn up front from its own generator), not on the other agents.
+
+    Parameters follow BanditModel and can be scalars or arrays [n_agents]. Outputs are the BanditModel
+    attributes with a leading agent axis: choice_history [N, 1, n_trials + 1], reward_history, reward_available,
+    q_estimation, choice_prob (and choice_kernel, loss_count, w where applicable) [N, K, n_trials + 1], p_reward.
+    '''
+
+    def __init__(self, forager, n_agents, n_trials=1000, if_baited=True, seeds=None,
+                 p_reward=None,   # [2, n_trials + 1] or [n_agents, 2, n_trials + 1]; None to generate blocks per agent
+                 p_reward_sum=0.45, p_reward_pairs=None, **paras):
+
+        assert forager in BATCH_FORAGERS, f'No batch simulation for forager {forager}'
+        self.forager = forager
+        self.n_agents = n_agents
+        self.n_trials = n_trials
+        self.K = 2
+        self.if_baited = if_baited
+        self.seeds = seeds if seeds is not None else np.random.SeedSequence().spawn(n_agents)
+        self.p_reward_override = p_reward
+        self.p_reward_pairs = (np.array([[.4, .05], [.3857, .0643], [.3375, .1125], [.225, .225]]) / 0.45 * p_reward_sum
+                               if p_reward_pairs is None else p_reward_pairs)
+
+        # Parameters as arrays [n_agents]
+        self.paras = {name: np.broadcast_to(np.asarray(value, dtype=float), n_agents).copy()
+                      for name, value in paras.items() if value is not None}
+
+        # Bias terms (same as BanditModel)
+        biasL = self._para('biasL', 0)
+        if forager in ['Random', 'pMatching', 'RW1972_epsi']:
+            self.bias_terms = np.stack([biasL, -biasL], axis=1)
+        else:
+            self.bias_terms = np.stack([biasL, np.zeros(n_agents)], axis=1)
+
+        # Forager-dependent (same as BanditModel)
+        if 'LNP_softmax' in forager:
+            if 'tau2' not in self.paras:
+                self.taus, self.w_taus = [self._para('tau1')], [np.ones(n_agents)]
+            else:
+                self.taus = [self._para('tau1'), self._para('tau2')]
+                self.w_taus = [self._para('w_tau1'), 1 - self._para('w_tau1')]
+        elif 'RW1972' in forager:
+            self.learn_rates = [self._para('learn_rate')] * 2
+            self.forget_rates = [np.zeros(n_agents)] * 2
+        elif 'Bari2019' in forager:
+            self.learn_rates = [self._para('learn_rate')] * 2
+            self.forget_rates = [self._para('forget_rate')] * 2
+        elif 'Hattori2019' in forager:
+            self.learn_rates = [self._para('learn_rate_unrew'), self._para('learn_rate_rew')]
+            self.forget_rates = [self._para('forget_rate', 0), np.zeros(n_agents)]
+        elif forager in ['CANN', 'Synaptic']:
+            self.learn_rates = [self._para('learn_rate')] * 2
+
+    def _para(self, name, default=None):
+        if name in self.paras:
+            return self.paras[name]
+        assert default is not None, f'{self.forager} needs {name}'
+        return np.full(self.n_agents, float(default))
+
+    def _draw_random_numbers(self):
+        '''
+        Draw every random number of each agent from its own generator
+        '''
+        N, T, K = self.n_agents, self.n_trials, self.K
+        self.p_reward = np.zeros([N, K, T + 1])
+        self.block_size = []
+        self._u_bait = np.zeros([N, T + 1, K])   # Reward baiting
+        self._u_choice = np.zeros([N, T])          # choose_ps()
+        self._u_explore = np.zeros([N, T])         # Epsilon-greedy exploration
+        self._u_tie = np.zeros([N, T, K])          # Random tie break
+        self._first_choice = np.zeros(N, dtype=int)
+        self._loss_thresholds = np.zeros([N, T + 1])   # LossCounting thresholds (a new one after each switch)
+
+        for aa, seed in enumerate(self.seeds):
+            rng = np.random.default_rng(seed)
+            if self.p_reward_override is None:
+                self.p_reward[aa], block_size = generate_p_reward_rng(rng, T, self.p_reward_pairs)
+                self.block_size.append(block_size)
+            self._u_bait[aa] = rng.random([T + 1, K])
+            self._u_choice[aa] = rng.random(T)
+            self._u_explore[aa] = rng.random(T)
+            self._u_tie[aa] = rng.random([T, K])
+            self._first_choice[aa] = rng.integers(K)
+            self._loss_thresholds[aa] = rng.standard_normal(T + 1)
+
+        if self.p_reward_override is not None:
+            self.p_reward[:] = self.p_reward_override
+        if self.forager == 'LossCounting':
+            self._loss_thresholds = (self._para('loss_count_threshold_mean')[:, None]
+                                     + self._para('loss_count_threshold_std', 0)[:, None] * self._loss_thresholds)
+
+    @staticmethod
+    def choose_ps(ps, u):
+        '''
+        Vectorized util.choose_ps(): ps [N, K], u [N] uniform random numbers; returns choices [N]
+        '''
+        cum_ps = np.cumsum(ps / np.sum(ps, axis=1, keepdims=True), axis=1)
+        return np.minimum(np.sum(cum_ps < u[:, None], axis=1), ps.shape[1] - 1)
+
+    def act(self, t):
+        N, K = self.n_agents, self.K
+
+        if self.forager == 'Random':
+            return self.choose_ps(1 / K + self.bias_terms, self._u_choice[:, t])
+
+        if self.forager == 'pMatching':
+            return self.choose_ps(self.p_reward[:, :, t], self._u_choice[:, t])
+
+        if self.forager == 'LossCounting':
+            if t == 0:
+                return self._first_choice.copy()
+            last_choice = self.choice_history[:, 0, t - 1]
+            switch = self.loss_count[:, 0, t] >= self._loss_thresholds[np.arange(N), self._n_switches]
+            # A flag of "switch happens here"
+            self.loss_count[switch, 0, t] = - self.loss_count[switch, 0, t]
+            self._n_switches += switch   # Draw a new threshold after a switch
+            return np.where(switch, LEFT + RIGHT - last_choice, last_choice)
+
+        if self.forager == 'RW1972_epsi':
+            q = self.q_estimation[:, :, t]
+            greedy = np.argmax(np.where(q == np.max(q, axis=1, keepdims=True), self._u_tie[:, t], -1), axis=1)
+            random_choice = self.choose_ps(1 / K + self.bias_terms, self._u_choice[:, t])
+            return np.where(self._u_explore[:, t] < self._para('epsilon'), random_choice, greedy)
+
+        # Probabilistic (could have choice kernel)
+        X = self.q_estimation[:, :, t] / self._para('softmax_temperature')[:, None]
+        if '_CK' in self.forager:
+            X = X + self.choice_kernel[:, :, t] / self._para('choice_softmax_temperature')[:, None]
+        X = X + self.bias_terms
+
+        with np.errstate(over='ignore', invalid='ignore'):
+            prob = np.exp(X) / np.sum(np.exp(X), axis=1, keepdims=True)
+        # To prevent explosion of EXP (same as util.softmax)
+        greedy = np.max(X, axis=1) > 700
+        if np.any(greedy):
+            winner = np.argmax(np.where(X == np.max(X, axis=1, keepdims=True), self._u_tie[:, t], -1), axis=1)
+            prob[greedy] = np.eye(K)[winner[greedy]]
+
+        self.choice_prob[:, :, t] = prob
+        return self.choose_ps(prob, self._u_choice[:, t])
+
+    def step(self, t, choice, reward):
+        '''
+        Update latent variables from trial t to t + 1
+        '''
+        agents = np.arange(self.n_agents)
+
+        if self.forager == 'LossCounting':
+            switched = self.loss_count[:, 0, t] < 0   # A switch just happened
+            self.loss_count[switched, 0, t] = - self.loss_count[switched, 0, t]
+            self.loss_count[:, 0, t + 1] = np.where(switched, 0, self.loss_count[:, 0, t]) + (reward == 0)
+
+        elif 'LNP_softmax' in self.forager:
+            # Exponential filters of the income (same as BanditModel.history_filter, normalized over the full session)
+            for state, tau, normalization in zip(self._lnp_states, self.taus, self._lnp_normalizations):
+                state *= np.exp(-1 / tau)[:, None]
+                state += self.reward_history[:, :, t] / normalization[:, None]
+            self.q_estimation[:, :, t + 1] = sum(w_tau[:, None] * state for state, w_tau in zip(self._lnp_states, self.w_taus))
+
+        elif self.forager == 'Synaptic':
+            learn_rate, forget_rate = self.learn_rates[1], self._para('forget_rate')
+            I0, rho = self._para('I0'), self._para('rho')
+            q_chosen = self.q_estimation[agents, choice, t]
+            self.w[:, :, t + 1] = (1 - forget_rate[:, None]) * self.w[:, :, t]
+            self.w[agents, choice, t + 1] = ((1 - forget_rate) * self.w[agents, choice, t]
+                                             + learn_rate * (reward - q_chosen) * q_chosen)
+            w = self.w[:, :, t + 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                denominator = w[:, 0] * w[:, 1] - (1 + rho / 2) * (w[:, 0] + w[:, 1]) + 1 + rho
+                self.q_estimation[:, :, t + 1] = np.clip(I0[:, None] * (1 - w[:, ::-1]) / denominator[:, None], 0, 1)
+
+        elif self.forager not in ['Random', 'pMatching']:   # RW-like and CANN
+            learn_rate_this = np.where(reward != 0, self.learn_rates[1], self.learn_rates[0])
+            q_chosen = self.q_estimation[agents, choice, t]
+            if self.forager == 'CANN':   # Decay over ITI = 1
+                decay = np.exp(-1 / self._para('tau_cann'))
+                self.q_estimation[:, :, t + 1] = self.q_estimation[:, :, t] * decay[:, None]
+                self.q_estimation[agents, choice, t + 1] = (q_chosen + learn_rate_this * (reward - q_chosen)) * decay
+            else:
+                self.q_estimation[:, :, t + 1] = (1 - self.forget_rates[0][:, None]) * self.q_estimation[:, :, t]
+                self.q_estimation[agents, choice, t + 1] = ((1 - self.forget_rates[1]) * q_chosen
+                                                            + learn_rate_this * (reward - q_chosen))
+
+        if '_CK' in self.forager:
+            choice_vector = np.eye(self.K)[choice]
+            self.choice_kernel[:, :, t + 1] = self.choice_kernel[:, :, t] + self._para('choice_step_size')[:, None] * \
+                (choice_vector - self.choice_kernel[:, :, t])
+
+    def simulate(self):
+        N, T, K = self.n_agents, self.n_trials, self.K
+        agents = np.arange(N)
+        self._draw_random_numbers()
+
+        # Same initialization as BanditModel.reset()
+        self.choice_history = np.zeros([N, 1, T + 1], dtype=int)
+        self.reward_history = np.zeros([N, K, T + 1])
+        self.reward_available = np.zeros([N, K, T + 1])
+        self.reward_available[:, :, 0] = (self._u_bait[:, 0] < self.p_reward[:, :, 0]).astype(int)
+
+        self.q_estimation = np.full([N, K, T + 1], np.nan)
+        self.q_estimation[:, :, 0] = 0
+        self.choice_prob = np.full([N, K, T + 1], np.nan)
+        self.choice_prob[:, :, 0] = 1 / K
+
+        if self.forager == 'LossCounting':
+            self.loss_count = np.zeros([N, 1, T + 1])
+            self._n_switches = np.zeros(N, dtype=int)
+        elif 'LNP_softmax' in self.forager:
+            self._lnp_states = [np.zeros([N, K]) for _ in self.taus]
+            self._lnp_normalizations = [np.sum(np.exp(-np.arange(T + 1)[None, :] / tau[:, None]), axis=1)
+                                        for tau in self.taus]
+        elif self.forager == 'Synaptic':
+            self.w = np.full([N, K, T + 1], np.nan)
+            self.w[:, :, 0] = 0.1
+        if '_CK' in self.forager:
+            self.choice_kernel = np.zeros([N, K, T + 1])
+
+        for t in range(T):
+            choice = self.act(t)
+            self.choice_history[:, 0, t] = choice
+
+            # Collect reward and make the state transition (same as BanditModel.step() in the generative mode)
+            reward = self.reward_available[agents, choice, t]
+            self.reward_history[agents, choice, t] = reward
+            reward_available_after_choice = self.reward_available[:, :, t].copy()
+            reward_available_after_choice[agents, choice] = 0
+            self.reward_available[:, :, t + 1] = np.logical_or(reward_available_after_choice * self.if_baited,
+                                                               self._u_bait[:, t + 1] < self.p_reward[:, :, t + 1]).astype(int)
+
+            self.step(t, choice, reward)
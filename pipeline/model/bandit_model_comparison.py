@@ -12,6 +12,96 @@ from .fitting_functions import fit_bandit, cross_validate_bandit
 # from utils.plot_fitting import plot_model_comparison_predictive_choice_prob, plot_model_comparison_result
 # from IPython.display import display
 
+# Original definition from the Dynamic-Foraging repo, using the format: [forager, [para_names], [lower bounds], [higher bounds], desc(optional)]
+MODELS = [
+    # No bias
+    ['LossCounting', ['loss_count_threshold_mean', 'loss_count_threshold_std'],
+     [0, 0], [40, 10], 'LossCounting: mean, std, no bias'],
+
+    ['RW1972_epsi', ['learn_rate', 'epsilon'],
+     [0, 0], [1, 1], 'SuttonBarto: epsilon, no bias'],
+
+    ['RW1972_softmax', ['learn_rate', 'softmax_temperature'],
+     [0, 1e-2], [1, 15], 'SuttonBarto: softmax, no bias'],
+
+    ['LNP_softmax', ['tau1', 'softmax_temperature'],
+     [1e-3, 1e-2], [100, 15], 'Sugrue2004, Corrado2005: one tau, no bias'],
+
+    ['LNP_softmax', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature'],
+     [1e-3, 1e-1, 0, 1e-2], [15, 40, 1, 15], 'Corrado2005, Iigaya2019: two taus, no bias'],
+
+    ['Bari2019', ['learn_rate', 'forget_rate', 'softmax_temperature'],
+     [0, 0, 1e-2], [1, 1, 15], 'RL: chosen, unchosen, softmax, no bias'],
+
+    ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature'],
+     [0, 0, 1e-2], [1, 1, 15], 'RL: rew, unrew, softmax, no bias'],
+
+    ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature'],
+     [0, 0, 0, 1e-2], [1, 1, 1, 15], 'RL: rew, unrew, unchosen, softmax, no bias'],
+
+    # With bias
+    ['RW1972_epsi', ['learn_rate', 'epsilon', 'biasL'],
+     [0, 0, -0.5], [1, 1, 0.5], 'SuttonBarto: epsilon'],
+
+    ['RW1972_softmax', ['learn_rate', 'softmax_temperature', 'biasL'],
+     [0, 1e-2, -5], [1, 15, 5], 'SuttonBarto: softmax'],
+
+    ['LNP_softmax', ['tau1', 'softmax_temperature', 'biasL'],
+     [1e-3, 1e-2, -5], [100, 15, 5], 'Sugrue2004, Corrado2005: one tau'],
+
+    ['LNP_softmax', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature', 'biasL'],
+     [1e-3, 1e-1, 0, 1e-2, -5], [15, 40, 1, 15, 5], 'Corrado2005, Iigaya2019: two taus'],
+
+    ['Bari2019', ['learn_rate', 'forget_rate', 'softmax_temperature', 'biasL'],
+     [0, 0, 1e-2, -5], [1, 1, 15, 5], 'RL: chosen, unchosen, softmax'],
+
+    ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature', 'biasL'],
+     [0, 0, 1e-2, -5], [1, 1, 15, 5], 'RL: rew, unrew, softmax'],
+
+    ['Hattori2019', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL'],
+     [0, 0, 0, 1e-2, -5], [1, 1, 1, 15, 5], '(full Hattori) RL: rew, unrew, unchosen, softmax'],
+
+    # With bias and choice kernel 
+    ['RW1972_softmax_CK', ['learn_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
+     [0, 1e-2, -5, 0, 1e-2], [1, 15, 5, 1, 20], 'SuttonBarto: softmax, choice kernel'],
+
+    ['LNP_softmax_CK', ['tau1', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
+     [1e-3, 1e-2, -5, 0, 1e-2], [100, 15, 5, 1, 20], 'Sugrue2004, Corrado2005: one tau, choice kernel'],
+
+    ['LNP_softmax_CK', ['tau1', 'tau2', 'w_tau1', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
+     [1e-3, 1e-1, 0, 1e-2, -5, 0, 1e-2], [15, 40, 1, 15, 5, 1, 20], 'Corrado2005, Iigaya2019: two taus, choice kernel'],
+
+    ['Bari2019_CK', ['learn_rate', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
+     [0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 15, 5, 1, 20], 'RL: chosen, unchosen, softmax, choice kernel'],
+
+    ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
+     [0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 15, 5, 1, 20], 'RL: rew, unrew, softmax, choice kernel'],
+
+    ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
+     [0, 0, 0, 1e-2, -5, 0, 1e-2], [1, 1, 1, 15, 5, 1, 20], 'Hattori + choice kernel'],
+
+    ['Hattori2019_CK', ['learn_rate_rew', 'learn_rate_unrew', 'forget_rate', 'softmax_temperature', 'biasL', 'choice_step_size', 'choice_softmax_temperature'],
+     [0, 0, 0, 1e-2, -5, 1, 1e-2], [1, 1, 1, 15, 5, 1, 20], 'choice_step_size fixed at 1 --> Bari 2019: only the last choice matters'],
+
+    ['CANN', ['learn_rate', 'tau_cann', 'softmax_temperature', 'biasL'],
+     [0, 0, 1e-2, -5], [1, 1000, 15, 5], "Ulises' CANN model, ITI decay, with bias"],
+
+    ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
+     [0, 0, 0, 0, 1e-2, -5], [1, 1, 10, 1, 15, 5], "Ulises' synaptic model"],
+
+    ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
+     [0, 0, 0, -100, 1e-2, -5], [1, 1, 10, 100, 15, 5], "Ulises' synaptic model (unconstrained \\rho)"],
+
+    ['Synaptic', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
+     [0, 0, 0, -1e6, 1e-2, -5], [1, 1, 1e6, 1e6, 15, 5], "Ulises' synaptic model (really unconstrained I_0 and \\rho)"],
+
+    # ['Synaptic_W>0', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
+    #  [0, 0, 0, -100, 1e-2, -5], [1, 1, 10, 100, 15, 5], "Ulises' synaptic model (W > 0, partially constrained I_0 and \\rho)"],
+
+    # ['Synaptic_W>0', ['learn_rate', 'forget_rate', 'I0', 'rho', 'softmax_temperature', 'biasL'],
+    #  [0, 0, 0, -1e6, 1e-2, -5], [1, 1, 10, 1e6, 15, 5], "Ulises' synaptic model (W > 0, unconstrained I_0 and \\rho)"],
+]
+
 
 class BanditModelComparison:
     
@@ -87,7 +177,10 @@ class BanditModelComparison:
             self.plot_predictive_choice()
         return
     
-    def cross_validate(self, k_fold = 2, fit_method = 'DE', fit_settings = {'DE_pop_size': 16}, pool = '', if_verbose = True):
+    def cross_validate(self, k_fold = 2, fit_method = 'DE', fit_settings = {'DE_pop_size': 16}, pool = '', fold_executor = None, seed = None, if_verbose = True):
+        """
+        fold_executor, seed: see cross_validate_bandit (fit folds in parallel; deterministic per-fold seeds)
+        """
         
         self.prediction_accuracy_CV = pd.DataFrame()
         
@@ -110,7 +203,8 @@ class BanditModelComparison:
             prediction_accuracy_test, prediction_accuracy_fit, prediction_accuracy_test_bias_only \
             = cross_validate_bandit(forager, fit_names, fit_bounds, 
                                     self.fit_choice_history, self.fit_reward_history, self.fit_iti, self.session_num, 
-                                    k_fold = k_fold, **fit_settings, pool = pool, if_verbose = if_verbose) #plot_predictive is not None)
+                                    k_fold = k_fold, **fit_settings, pool = pool, fold_executor = fold_executor, seed = seed, 
+                                    if_verbose = if_verbose) #plot_predictive is not None)
             
             if if_verbose: print('  \n%g-fold CV: Test acc.= %s, Fit acc. = %s (done in %.3g secs)' % (k_fold, prediction_accuracy_test, prediction_accuracy_fit, time.time()-start) )
             
@@ -6,9 +6,11 @@ Created on Thu Mar 19 16:30:26 2020
 import numpy as np
 import scipy.optimize as optimize
 import multiprocessing as mp
+from contextlib import contextmanager
 # from tqdm import tqdm  # For progress bar. HH
 
 from .bandit_model import BanditModel
+from .likelihood import FAST_FORAGERS, predictive_choice_prob as fast_predictive_choice_prob, predictive_choice_prob_population
 global fit_history
 
 def negLL_func(fit_value, *argss):
@@ -41,11 +43,15 @@ def negLL_func(fit_value, *argss):
         reward_this = reward_history[:, session_num == ss]
         
         # Run **PREDICTIVE** simulation    
-        bandit = BanditModel(**kwargs_all, fit_choice_history = choice_this, fit_reward_history = reward_this, fit_iti = iti)  # Into the fitting mode
-        bandit.simulate()
+        if forager in FAST_FORAGERS:
+            predictive_choice_prob = fast_predictive_choice_prob(choice_history = choice_this, reward_history = reward_this, iti = iti, **kwargs_all)
+        else:
+            bandit = BanditModel(**kwargs_all, fit_choice_history = choice_this, fit_reward_history = reward_this, fit_iti = iti)  # Into the fitting mode
+            bandit.simulate()
+            predictive_choice_prob = bandit.predictive_choice_prob
         
         # Compute negative likelihood
-        predictive_choice_prob = bandit.predictive_choice_prob[:, :-1]  # Get all predictive choice probability [K, num_trials], exclude the final update after the last trial
+        predictive_choice_prob = predictive_choice_prob[:, :-1]  # Get all predictive choice probability [K, num_trials], exclude the final update after the last trial
         likelihood_each_trial = predictive_choice_prob [choice_this[0,:], range(len(choice_this[0]))]  # Get the actual likelihood for each trial
         
         # Deal with numerical precision
@@ -57,7 +63,7 @@ def negLL_func(fit_value, *argss):
     
     likelihood_all_trial = np.array(likelihood_all_trial)
     
-    if fit_set == []: # Use all trials
+    if len(fit_set) == 0: # Use all trials
         negLL = - sum(np.log(likelihood_all_trial))
     else:   # Only return likelihoods in the fit_set
         negLL = - sum(np.log(likelihood_all_trial[fit_set]))
@@ -68,6 +74,57 @@ def negLL_func(fit_value, *argss):
     
     return negLL
 
+def negLL_func_population(fit_values, *argss):
+    '''
+    Compute negative likelihoods of a whole population of parameter sets at once (for DE with vectorized = True)
+    fit_values: [n_paras, n_population] (or [n_paras]); returns negLL: [n_population]
+    '''
+    forager, fit_names, choice_history, reward_history, iti, session_num, para_fixed, fit_set = argss
+    fit_values = np.reshape(fit_values, (len(fit_names), -1))
+    
+    if forager not in FAST_FORAGERS:  # No population version, evaluate one by one
+        return np.array([negLL_func(fit_value, *argss) for fit_value in fit_values.T])
+    
+    kwargs_all = {'forager': forager, **para_fixed, **dict(zip(fit_names, fit_values))}
+    
+    # Handle data from different sessions
+    if session_num is None:
+        session_num = np.zeros_like(choice_history)[0]  # Regard as one session
+    
+    unique_session = np.unique(session_num)
+    likelihood_all_trial = []
+    
+    # -- For each session --
+    for ss in unique_session:
+        # Data in this session
+        choice_this = choice_history[:, session_num == ss]
+        reward_this = reward_history[:, session_num == ss]
+        
+        # Run **PREDICTIVE** simulation of all parameter sets together
+        predictive_choice_prob = predictive_choice_prob_population(choice_history = choice_this, reward_history = reward_this, iti = iti, 
+                                                                   **kwargs_all)[:, :, :-1]  # [n_population, K, num_trials]
+        likelihood_each_trial = predictive_choice_prob[:, choice_this[0,:], range(len(choice_this[0]))]  # [n_population, num_trials]
+        
+        # Deal with numerical precision (same as negLL_func)
+        likelihood_each_trial[(likelihood_each_trial <= 0) & (likelihood_each_trial > -1e-5)] = 1e-16
+        likelihood_each_trial[likelihood_each_trial > 1] = 1
+        
+        likelihood_all_trial.append(likelihood_each_trial)
+    
+    likelihood_all_trial = np.hstack(likelihood_all_trial)
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if len(fit_set) == 0: # Use all trials
+            negLL = - np.sum(np.log(likelihood_all_trial), axis=1)
+        else:   # Only return likelihoods in the fit_set
+            negLL = - np.sum(np.log(likelihood_all_trial[:, fit_set]), axis=1)
+    
+    # Put constraint hack here!!
+    if 'tau2' in kwargs_all:
+        negLL[np.broadcast_to(kwargs_all['tau2'] < kwargs_all['tau1'], negLL.shape)] = np.inf
+    
+    return negLL
+
 def callback_history(x, **kargs):
     '''
     Store the intermediate DE results. I have to use global variable as a workaround. Any better ideas?
@@ -78,13 +135,39 @@ def callback_history(x, **kargs):
     return
 
 
-def fit_each_init(forager, fit_names, fit_bounds, choice_history, reward_history, iti, session_num, fit_method, callback):
+def warm_start_population(warm_start, fit_bounds, n_population, warm_start_fraction = 0.5, jitter = 0.05):
     '''
-    For local optimizers, fit using ONE certain initial condition    
+    Initial DE population (or initial points of local optimizers) [n_population, n_paras] seeded from previous fits
+    warm_start: [n_fits, n_paras] previously fitted parameters (NaN if a fit doesn't have this parameter)
+    warm_start_fraction: fraction of the population seeded from warm_start (rows are cycled; repeated rows are jittered
+                         by jitter * bound range; NaNs are drawn uniformly); the rest is drawn by latin hypercube within bounds
     '''
-    x0 = []
-    for lb,ub in zip(fit_bounds[0], fit_bounds[1]):
-        x0.append(np.random.uniform(lb,ub))
+    lb, ub = np.array(fit_bounds[0], dtype=float), np.array(fit_bounds[1], dtype=float)
+    warm_start = np.atleast_2d(np.asarray(warm_start, dtype=float))
+    n_seeded = min(int(round(warm_start_fraction * n_population)), n_population) if warm_start.size else 0
+    n_random = n_population - n_seeded
+    
+    # Seeded part
+    seeded = warm_start[np.arange(n_seeded) % max(len(warm_start), 1)]
+    is_repeated = (np.arange(n_seeded) >= len(warm_start))[:, None]
+    seeded = seeded + is_repeated * np.random.normal(0, jitter, seeded.shape) * (ub - lb)
+    seeded = np.where(np.isnan(seeded), lb + np.random.uniform(size=seeded.shape) * (ub - lb), seeded)
+    
+    # Random part (latin hypercube, same as DE's default init)
+    segments = np.argsort(np.random.uniform(size=(n_random, len(lb))), axis=0)
+    random_part = lb + (segments + np.random.uniform(size=(n_random, len(lb)))) / max(n_random, 1) * (ub - lb)
+    
+    return np.clip(np.vstack([seeded, random_part]), lb, ub)
+
+
+def fit_each_init(forager, fit_names, fit_bounds, choice_history, reward_history, iti, session_num, fit_method, callback, x0 = None):
+    '''
+    For local optimizers, fit using ONE certain initial condition (random if x0 is None)
+    '''
+    if x0 is None:
+        x0 = []
+        for lb,ub in zip(fit_bounds[0], fit_bounds[1]):
+            x0.append(np.random.uniform(lb,ub))
         
     # Append the initial point
     if callback != None: callback_history(x0)
@@ -97,10 +180,16 @@ def fit_each_init(forager, fit_names, fit_bounds, choice_history, reward_history
 def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, 
                iti = None, session_num = None, 
                if_predictive = False, if_generative = False,  # Whether compute predictive or generative choice sequence
-               if_history = False, fit_method = 'DE', DE_pop_size = 16, n_x0s = 1, pool = ''):
+               if_history = False, fit_method = 'DE', DE_pop_size = 16, DE_vectorized = False, n_x0s = 1, pool = '',
+               warm_start = None, warm_start_fraction = 0.5):
     '''
     Main fitting func and compute BIC etc.
+    DE_vectorized: evaluate the whole DE population at once in one process (negLL_func_population), instead of using pool
+    warm_start: [n_fits, n_paras] previously fitted parameters that seed warm_start_fraction of the initial DE population
+                (or of the n_x0s initial points of local optimizers). See warm_start_population()
     '''
+    if_warm_start = warm_start is not None and len(warm_start) and warm_start_fraction > 0
+    
     if if_history: 
         global fit_history
         fit_history = []
@@ -111,12 +200,16 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history,
     if fit_method == 'DE':
         
         # Use DE's own parallel method
-        fitting_result = optimize.differential_evolution(func = negLL_func, args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, []),
+        fitting_result = optimize.differential_evolution(func = negLL_func_population if DE_vectorized else negLL_func, 
+                                                         args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, []),
                                                          bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
                                                          mutation=(0.5, 1), recombination = 0.7, popsize = DE_pop_size, strategy = 'best1bin', 
                                                          disp = False, 
-                                                         workers = 1 if pool == '' else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
-                                                         updating = 'immediate' if pool == '' else 'deferred',
+                                                         workers = 1 if pool == '' or DE_vectorized else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
+                                                         updating = 'immediate' if pool == '' and not DE_vectorized else 'deferred',
+                                                         vectorized = DE_vectorized,
+                                                         init = warm_start_population(warm_start, fit_bounds, max(5, DE_pop_size * len(fit_names)), warm_start_fraction)
+                                                                if if_warm_start else 'latinhypercube',
                                                          callback = callback_history if if_history else None,)
         if if_history:
             fit_history.append(fitting_result.x.copy())  # Add the final result
@@ -126,6 +219,7 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history,
         
         # Do parallel initialization
         fitting_parallel_results = []
+        x0s = warm_start_population(warm_start, fit_bounds, n_x0s, warm_start_fraction) if if_warm_start else [None] * n_x0s
         
         if pool != '':  # Go parallel
             pool_results = []
@@ -134,7 +228,7 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history,
             for nn in range(n_x0s):
                 # Assign jobs
                 pool_results.append(pool.apply_async(fit_each_init, args = (forager, fit_names, fit_bounds, choice_history, reward_history, iti, session_num, fit_method, 
-                                                                            None)))   # We can have multiple histories only in serial mode
+                                                                            None, x0s[nn])))   # We can have multiple histories only in serial mode
             for rr in pool_results:
                 # Get data    
                 fitting_parallel_results.append(rr.get())
@@ -145,7 +239,7 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history,
                 if if_history: fit_history = []  # Clear this history
                 
                 result = fit_each_init(forager, fit_names, fit_bounds, choice_history, reward_history, iti, session_num, fit_method,
-                                       callback = callback_history if if_history else None)
+                                       callback = callback_history if if_history else None, x0 = x0s[nn])
                 
                 fitting_parallel_results.append(result)
                 if if_history: 
@@ -228,43 +322,87 @@ def fit_bandit(forager, fit_names, fit_bounds, choice_history, reward_history,
     return fitting_result
             
 
-import random
+@contextmanager
+def _seeded_global_rng(seed):
+    '''
+    Seed the global np.random (used for the random tie breaks in the likelihood and in BanditModel) within the block,
+    and restore its previous state afterwards
+    '''
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        np.random.set_state(state)
+
+
+def _fit_fold(forager, fit_names, fit_bounds, choice_history, reward_history, iti, session_num, fit_set, 
+              DE_pop_size, DE_vectorized, pool, seed):
+    '''
+    Fit one cross-validation fold using DE and return the fitted parameters
+    (At module level so that it can be sent to a process executor)
+    '''
+    with _seeded_global_rng(seed):  # For random tie breaks in the likelihood
+        fitting_result = optimize.differential_evolution(func = negLL_func_population if DE_vectorized else negLL_func, 
+                                                         args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, fit_set),
+                                                         bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
+                                                         mutation=(0.5, 1), recombination = 0.7, popsize = DE_pop_size, strategy = 'best1bin', 
+                                                         disp = False, 
+                                                         workers = 1 if pool == '' or DE_vectorized else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
+                                                         updating = 'immediate' if pool == '' and not DE_vectorized else 'deferred',
+                                                         vectorized = DE_vectorized,
+                                                         seed = seed,
+                                                         callback = None,)
+    return fitting_result.x
+
 
 def cross_validate_bandit(forager, fit_names, fit_bounds, choice_history, reward_history, iti = None, session_num = None, k_fold = 2, 
-                          DE_pop_size = 16, pool = '', if_verbose = True):
+                          DE_pop_size = 16, DE_vectorized = False, pool = '', fold_executor = None, seed = None, if_verbose = True):
     '''
     k-fold cross-validation
+    fold_executor: a concurrent.futures executor (e.g. ProcessPoolExecutor(k_fold)) to fit the folds in parallel; 
+                   None to fit them one after another. Folds sent to the executor don't use pool for DE.
+    seed: seeds the trial split and each fold's DE and predictive simulation (one seed per fold, spawned from this one), 
+          so that the same seed gives the same result whether the folds run serially (pool = '') or in fold_executor.
+          The global np.random state is restored after each use.
     '''
+    # Deterministic seeds for the split and for each fold
+    split_seed, *fold_seeds = [int(ss.generate_state(1)[0]) for ss in np.random.SeedSequence(seed).spawn(k_fold + 1)]
     
     # Split the data into k_fold parts
     n_trials = np.shape(choice_history)[1]
-    trial_numbers_shuffled = np.arange(n_trials)
-    random.shuffle(trial_numbers_shuffled)
+    trial_numbers_shuffled = np.random.RandomState(split_seed).permutation(n_trials)
+    
+    test_sets, fit_sets = [], []
+    for kk in range(k_fold):
+        test_begin = int(kk * np.floor(n_trials/k_fold))
+        test_end = int((n_trials) if (kk == k_fold - 1) else (kk+1) * np.floor(n_trials/k_fold))
+        test_sets.append(trial_numbers_shuffled[test_begin:test_end])
+        fit_sets.append(np.hstack((trial_numbers_shuffled[:test_begin], trial_numbers_shuffled[test_end:])))
+    
+    # == Fit data using each fit_set ==
+    fold_args = [(forager, fit_names, fit_bounds, choice_history, reward_history, iti, session_num, fit_set_this, 
+                  DE_pop_size, DE_vectorized, pool if fold_executor is None else '', fold_seed) 
+                 for fit_set_this, fold_seed in zip(fit_sets, fold_seeds)]
+    
+    if fold_executor is None:
+        fold_fitted_x = []
+        for kk, args in enumerate(fold_args):
+            if if_verbose: print('%g/%g...'%(kk+1, k_fold), end = '')
+            fold_fitted_x.append(_fit_fold(*args))
+    else:
+        if if_verbose: print('%g folds in parallel...'%(k_fold), end = '')
+        fold_fitted_x = list(fold_executor.map(_fit_fold, *zip(*fold_args)))  # Results in the order of folds
     
     prediction_accuracy_test = []
     prediction_accuracy_fit = []
     prediction_accuracy_test_bias_only = []
     
-    for kk in range(k_fold):
-        
-        test_begin = int(kk * np.floor(n_trials/k_fold))
-        test_end = int((n_trials) if (kk == k_fold - 1) else (kk+1) * np.floor(n_trials/k_fold))
-        test_set_this = trial_numbers_shuffled[test_begin:test_end]
-        fit_set_this = np.hstack((trial_numbers_shuffled[:test_begin], trial_numbers_shuffled[test_end:]))
-        
-        # == Fit data using fit_set_this ==
-        if if_verbose: print('%g/%g...'%(kk+1, k_fold), end = '')
-        fitting_result = optimize.differential_evolution(func = negLL_func, args = (forager, fit_names, choice_history, reward_history, iti, session_num, {}, fit_set_this),
-                                                         bounds = optimize.Bounds(fit_bounds[0], fit_bounds[1]), 
-                                                         mutation=(0.5, 1), recombination = 0.7, popsize = DE_pop_size, strategy = 'best1bin', 
-                                                         disp = False, 
-                                                         workers = 1 if pool == '' else int(mp.cpu_count()),   # For DE, use pool to control if_parallel, although we don't use pool for DE
-                                                         updating = 'immediate' if pool == '' else 'deferred',
-                                                         callback = None,)
+    for test_set_this, fit_set_this, fitted_x, fold_seed in zip(test_sets, fit_sets, fold_fitted_x, fold_seeds):
             
         # == Rerun predictive choice sequence and get the prediction accuracy of the test_set_this ==
         kwargs_all = {}
-        for (nn, vv) in zip(fit_names, fitting_result.x):  # Use the fitted data
+        for (nn, vv) in zip(fit_names, fitted_x):  # Use the fitted data
             kwargs_all = {**kwargs_all, nn:vv}
         
         # Handle data from different sessions
@@ -273,7 +411,6 @@ def cross_validate_bandit(forager, fit_names, fit_bounds, choice_history, reward
         
         unique_session = np.unique(session_num)
         predictive_choice_prob = []
-        fitting_result.trial_numbers = []
         
         # -- For each session --
         for ss in unique_session:
@@ -281,9 +418,10 @@ def cross_validate_bandit(forager, fit_names, fit_bounds, choice_history, reward
             choice_this = choice_history[:, session_num == ss]
             reward_this = reward_history[:, session_num == ss]
             
-            # Run PREDICTIVE simulation    
+            # Run PREDICTIVE simulation (random tie breaks seeded by this fold's seed)
             bandit = BanditModel(forager = forager, **kwargs_all, fit_choice_history = choice_this, fit_reward_history = reward_this, fit_iti = iti)  # Into the fitting mode
-            bandit.simulate()
+            with _seeded_global_rng(fold_seed):
+                bandit.simulate()
             predictive_choice_prob.extend(bandit.predictive_choice_prob[:, :-1])   # Exclude the final update after the last trial
             
         # Get prediction accuracy of the test_set and fitting_set
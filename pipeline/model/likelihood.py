@@ -0,0 +1,347 @@
+"""
+Likelihood engine for fitting bandit models
+
+Computes the same predictive choice probabilities as BanditModel.simulate() in the fitting mode, but without
+constructing a BanditModel or dispatching act() / step() on every trial:
+    - linear updates with constant coefficients (LNP history filters, choice kernels, RW1972 values on the
+      trials where an arm is chosen) are evaluated in closed form with scipy.signal.lfilter;
+    - the other linear updates (Bari2019, Hattori2019, CANN) run as a scalar recurrence over preallocated arrays;
+    - LossCounting is a cumulative sum of losses that resets at every switch;
+    - Synaptic (nonlinear) runs as a scalar loop.
+"""
+
+import numpy as np
+from scipy.signal import lfilter
+from scipy.stats import norm
+
+FAST_FORAGERS = ('LossCounting', 'RW1972_epsi', 'RW1972_softmax', 'LNP_softmax', 'Bari2019', 'Hattori2019',
+                 'RW1972_softmax_CK', 'LNP_softmax_CK', 'Bari2019_CK', 'Hattori2019_CK',
+                 'CANN', 'Synaptic')
+
+
+def linear_recurrence(a, b):
+    '''
+    Solve q[0] = 0, q[t + 1] = a[t] * q[t] + b[t]
+    Returns q with length len(b) + 1
+    '''
+    n = len(b)
+    q = np.zeros(n + 1)
+
+    # Steps that leave q untouched (e.g. the unchosen arm without forgetting) are skipped
+    active = np.flatnonzero((a != 1) | (b != 0))
+    if not len(active):
+        return q
+
+    a_active, b_active = a[active], b[active]
+    if np.all(a_active == a_active[0]):   # Constant coefficient --> closed form
+        q_active = lfilter([1.], [1., -a_active[0]], b_active)
+    else:
+        q_active, qq = [], 0.
+        for aa, bb in zip(a_active.tolist(), b_active.tolist()):
+            qq = aa * qq + bb
+            q_active.append(qq)
+        q_active = np.array(q_active)
+
+    # Hold the value of the last active step
+    last_active = np.searchsorted(active, np.arange(n), side='right')
+    q[1:] = np.r_[0., q_active][last_active]
+    return q
+
+
+def softmax_prob(X):
+    '''
+    Column-wise version of util.softmax() on the already-scaled decision variable X [K, n]
+    '''
+    with np.errstate(over='ignore', invalid='ignore'):
+        prob = np.exp(X) / np.sum(np.exp(X), axis=0)
+
+    # To prevent explosion of EXP (same as util.softmax)
+    for tt in np.flatnonzero(np.max(X, axis=0) > 700):
+        prob[:, tt] = 0
+        prob[np.random.choice(np.flatnonzero(X[:, tt] == np.max(X[:, tt]))), tt] = 1
+    return prob
+
+
+def _bias_terms(forager, K, biasL, biasR):
+    if forager == 'RW1972_epsi':
+        return np.array([biasL, -biasL]) if K == 2 else np.array([biasL, -(biasL + biasR), biasR])
+    return np.array([biasL, 0]) if K == 2 else np.array([biasL, 0, biasR])
+
+
+def _rectify(x):
+    return 0 if x <= 0 else 1 if x >= 1 else x
+
+
+def _synaptic_values(choice, reward, learn_rate, forget_rate, I0, rho):
+    '''
+    Ulises' mean-field synaptic model (same as BanditModel.step_synaptic), returns q [2, n_trials + 1]
+    '''
+    q = np.zeros([2, len(choice) + 1])
+    learn_rate, forget_rate, I0, rho = float(learn_rate), float(forget_rate), float(I0), float(rho)
+    w, u = [0.1, 0.1], [0., 0.]
+
+    for tt, (cc, rr) in enumerate(zip(choice.tolist(), reward.tolist())):
+        w[cc] = (1 - forget_rate) * w[cc] + learn_rate * (rr - u[cc]) * u[cc]
+        w[1 - cc] = (1 - forget_rate) * w[1 - cc]
+
+        denominator = w[0] * w[1] - (1 + rho / 2) * (w[0] + w[1]) + 1 + rho
+        for side in (0, 1):
+            numerator = I0 * (1 - w[1 - side])
+            u[side] = _rectify(numerator / denominator if denominator != 0
+                               else np.float64(numerator) / denominator)
+        q[:, tt + 1] = u
+
+    return q
+
+
+def predictive_choice_prob(forager, choice_history, reward_history, iti=None,
+                           biasL=0, biasR=0, epsilon=None, softmax_temperature=None,
+                           tau1=None, tau2=None, w_tau1=None,
+                           choice_step_size=None, choice_softmax_temperature=None,
+                           learn_rate=None, learn_rate_rew=None, learn_rate_unrew=None, forget_rate=None,
+                           loss_count_threshold_mean=None, loss_count_threshold_std=0,
+                           tau_cann=None, rho=None, I0=None, **kwargs):
+    '''
+    Predictive choice probability [K, n_trials + 1] of one session, which equals
+        BanditModel(forager, **paras, fit_choice_history=choice_history, fit_reward_history=reward_history,
+                    fit_iti=iti).simulate().predictive_choice_prob
+    for foragers in FAST_FORAGERS. Parameters follow BanditModel; other BanditModel arguments are ignored.
+    '''
+    choice = np.asarray(choice_history)[0].astype(int)
+    reward_history = np.asarray(reward_history, dtype=float)
+    K, n_trials = reward_history.shape
+    reward = reward_history[choice, np.arange(n_trials)]
+    chosen = choice == np.arange(K)[:, None]   # [K, n_trials]
+
+    # -- LossCounting --
+    if forager == 'LossCounting':
+        prob = np.full([K, n_trials + 1], 1 / K)
+
+        # Loss count after trial t = number of losses since the last switch (switch trial included)
+        switched = np.r_[False, choice[1:] != choice[:-1]]
+        cum_loss = np.r_[0, np.cumsum(reward == 0)]
+        run_start = np.maximum.accumulate(np.where(switched, np.arange(n_trials), 0))
+        loss_count = (cum_loss[1:] - cum_loss[run_start]).astype(float)
+
+        prob_switch = norm.cdf(loss_count, loss_count_threshold_mean - 1e-6, loss_count_threshold_std + 1e-16)
+        prob[:, 1:] = prob_switch / (K - 1)
+        prob[choice, np.arange(1, n_trials + 1)] = 1 - prob_switch
+        return prob
+
+    # -- Values --
+    if 'LNP_softmax' in forager:
+        taus, w_taus = ([tau1], [1]) if tau2 is None else ([tau1, tau2], [w_tau1, 1 - w_tau1])
+        q = np.zeros([K, n_trials + 1])
+        for tau, w_tau in zip(taus, w_taus):
+            # Normalized exponential filter over the full session (same as BanditModel.history_filter)
+            normalization = np.sum(np.exp(-np.arange(n_trials + 1) / tau))
+            q[:, 1:] += w_tau * lfilter([1 / normalization], [1, -np.exp(-1 / tau)], reward_history, axis=1)
+
+    elif forager == 'CANN':
+        decay = np.exp(-np.asarray(iti, dtype=float)[:n_trials] / tau_cann)   # ITI[t]: between t and t + 1
+        q = np.vstack([linear_recurrence(np.where(chosen[k], (1 - learn_rate) * decay, decay),
+                                         np.where(chosen[k], learn_rate * reward * decay, 0))
+                       for k in range(K)])
+
+    elif forager == 'Synaptic':
+        q = _synaptic_values(choice, reward, learn_rate, forget_rate, I0, rho)
+
+    else:   # RW-like
+        if 'RW1972' in forager:
+            learn_rates, forget_rates = [learn_rate, learn_rate], [0, 0]
+        elif 'Bari2019' in forager:
+            learn_rates, forget_rates = [learn_rate, learn_rate], [forget_rate, forget_rate]
+        elif 'Hattori2019' in forager:
+            learn_rates, forget_rates = [learn_rate_unrew, learn_rate_rew], [forget_rate or 0, 0]
+        else:
+            raise NotImplementedError(f'No fast likelihood for forager {forager}')
+
+        # Chosen: Q(n+1) = (1 - forget_rate_chosen - step_size) * Q(n) + step_size * Reward
+        # Unchosen: Q(n+1) = (1 - forget_rate_unchosen) * Q(n)
+        learn_rate_this = np.where(reward != 0, learn_rates[1], learn_rates[0])
+        q = np.vstack([linear_recurrence(np.where(chosen[k], 1 - forget_rates[1] - learn_rate_this, 1 - forget_rates[0]),
+                                         np.where(chosen[k], learn_rate_this * reward, 0))
+                       for k in range(K)])
+
+    bias_terms = _bias_terms(forager, K, biasL, biasR)
+
+    # -- Epsilon-greedy --
+    if forager == 'RW1972_epsi':
+        prob = np.tile((epsilon * (1 / K + bias_terms))[:, None], n_trials + 1)
+        is_max = q == np.max(q, axis=0)
+        greedy = np.argmax(is_max, axis=0)
+        for tt in np.flatnonzero(np.sum(is_max, axis=0) > 1):   # Random tie break
+            greedy[tt] = np.random.choice(np.flatnonzero(is_max[:, tt]))
+        prob[greedy, np.arange(n_trials + 1)] = 1 - epsilon + epsilon * (1 / K + bias_terms[greedy])
+        return prob
+
+    # -- Softmax (with choice kernel) --
+    X = q / softmax_temperature
+    if '_CK' in forager:
+        choice_kernel = np.zeros([K, n_trials + 1])
+        choice_kernel[:, 1:] = lfilter([choice_step_size], [1, -(1 - choice_step_size)], chosen.astype(float), axis=1)
+        X = X + choice_kernel / choice_softmax_temperature
+
+    return softmax_prob(X + bias_terms[:, None])
+
+
+# =============================================================================
+#  Population version: evaluate many parameter sets (e.g. a DE population) at once
+# =============================================================================
+
+def linear_recurrence_population(a, b):
+    '''
+    Solve q[..., 0] = 0, q[..., t + 1] = a[..., t] * q[..., t] + b[..., t] for all leading dimensions at once
+    Returns q [..., len(t) + 1]
+    '''
+    a, b = np.broadcast_arrays(a, b)
+    a = np.ascontiguousarray(np.moveaxis(a, -1, 0))   # Time first, so that every step is a contiguous slice
+    b = np.ascontiguousarray(np.moveaxis(b, -1, 0))
+
+    q = np.zeros((a.shape[0] + 1, ) + a.shape[1:])
+    for tt in range(a.shape[0]):
+        np.multiply(a[tt], q[tt], out=q[tt + 1])
+        q[tt + 1] += b[tt]
+
+    return np.moveaxis(q, 0, -1)
+
+
+def _synaptic_values_population(choice, reward, learn_rate, forget_rate, I0, rho):
+    '''
+    Population version of _synaptic_values(), parameters [n_sets, 1], returns q [n_sets, 2, n_trials + 1]
+    '''
+    n_sets = len(learn_rate)
+    q = np.zeros([n_sets, 2, len(choice) + 1])
+    w = np.full([n_sets, 2], 0.1)
+    keep = 1 - forget_rate[:, 0]
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for tt, (cc, rr) in enumerate(zip(choice.tolist(), reward.tolist())):
+            u = q[:, cc, tt]
+            w[:, cc] = keep * w[:, cc] + learn_rate[:, 0] * (rr - u) * u
+            w[:, 1 - cc] = keep * w[:, 1 - cc]
+
+            denominator = w[:, 0] * w[:, 1] - (1 + rho[:, 0] / 2) * (w[:, 0] + w[:, 1]) + 1 + rho[:, 0]
+            # np.clip keeps NaN, same as _rectify()
+            q[:, :, tt + 1] = np.clip(I0 * (1 - w[:, ::-1]) / denominator[:, None], 0, 1)
+
+    return q
+
+
+def predictive_choice_prob_population(forager, choice_history, reward_history, iti=None,
+                                      biasL=0, biasR=0, epsilon=None, softmax_temperature=None,
+                                      tau1=None, tau2=None, w_tau1=None,
+                                      choice_step_size=None, choice_softmax_temperature=None,
+                                      learn_rate=None, learn_rate_rew=None, learn_rate_unrew=None, forget_rate=None,
+                                      loss_count_threshold_mean=None, loss_count_threshold_std=0,
+                                      tau_cann=None, rho=None, I0=None, **kwargs):
+    '''
+    Population version of predictive_choice_prob()
+    Each parameter is either a scalar or an array [n_sets]; all parameter sets are stepped together through the trials
+    Returns predictive choice probability [n_sets, K, n_trials + 1]
+    Random tie breaks draw from np.random in the same order as calling predictive_choice_prob() for each set in turn
+    '''
+    choice = np.asarray(choice_history)[0].astype(int)
+    reward_history = np.asarray(reward_history, dtype=float)
+    K, n_trials = reward_history.shape
+    reward = reward_history[choice, np.arange(n_trials)]
+    chosen = choice == np.arange(K)[:, None]   # [K, n_trials]
+
+    paras = dict(biasL=biasL, biasR=biasR, epsilon=epsilon, softmax_temperature=softmax_temperature,
+                 tau1=tau1, tau2=tau2, w_tau1=w_tau1,
+                 choice_step_size=choice_step_size, choice_softmax_temperature=choice_softmax_temperature,
+                 learn_rate=learn_rate, learn_rate_rew=learn_rate_rew, learn_rate_unrew=learn_rate_unrew,
+                 forget_rate=forget_rate, loss_count_threshold_mean=loss_count_threshold_mean,
+                 loss_count_threshold_std=loss_count_threshold_std, tau_cann=tau_cann, rho=rho, I0=I0)
+    paras = {name: np.atleast_1d(np.asarray(value, dtype=float)) for name, value in paras.items() if value is not None}
+    n_sets = max(len(value) for value in paras.values())
+    # Parameters as [n_sets, 1] columns
+    paras = {name: np.broadcast_to(value, n_sets)[:, None] for name, value in paras.items()}
+    p = paras.get
+
+    # -- LossCounting --
+    if forager == 'LossCounting':
+        prob = np.full([n_sets, K, n_trials + 1], 1 / K)
+
+        switched = np.r_[False, choice[1:] != choice[:-1]]
+        cum_loss = np.r_[0, np.cumsum(reward == 0)]
+        run_start = np.maximum.accumulate(np.where(switched, np.arange(n_trials), 0))
+        loss_count = (cum_loss[1:] - cum_loss[run_start]).astype(float)
+
+        prob_switch = norm.cdf(loss_count, p('loss_count_threshold_mean') - 1e-6,
+                               p('loss_count_threshold_std') + 1e-16)   # [n_sets, n_trials]
+        prob[:, :, 1:] = prob_switch[:, None, :] / (K - 1)
+        prob[:, choice, np.arange(1, n_trials + 1)] = 1 - prob_switch
+        return prob
+
+    # -- Values [n_sets, K, n_trials + 1] --
+    if 'LNP_softmax' in forager:
+        taus, w_taus = ([p('tau1')], [np.ones([n_sets, 1])]) if tau2 is None else ([p('tau1'), p('tau2')], [p('w_tau1'), 1 - p('w_tau1')])
+        q = 0
+        for tau, w_tau in zip(taus, w_taus):
+            normalization = np.sum(np.exp(-np.arange(n_trials + 1) / tau), axis=1, keepdims=True)
+            q = q + w_tau[:, :, None] * linear_recurrence_population(
+                np.exp(-1 / tau)[:, :, None], reward_history / normalization[:, :, None])
+
+    elif forager == 'CANN':
+        decay = np.exp(-np.asarray(iti, dtype=float)[:n_trials] / p('tau_cann'))[:, None, :]   # [n_sets, 1, n_trials]
+        learn_rate = p('learn_rate')[:, :, None]
+        q = linear_recurrence_population(np.where(chosen, (1 - learn_rate) * decay, decay),
+                                         np.where(chosen, learn_rate * reward * decay, 0))
+
+    elif forager == 'Synaptic':
+        q = _synaptic_values_population(choice, reward, p('learn_rate'), p('forget_rate'), p('I0'), p('rho'))
+
+    else:   # RW-like
+        if 'RW1972' in forager:
+            learn_rates, forget_rates = [p('learn_rate'), p('learn_rate')], [0, 0]
+        elif 'Bari2019' in forager:
+            learn_rates, forget_rates = [p('learn_rate'), p('learn_rate')], [p('forget_rate'), p('forget_rate')]
+        elif 'Hattori2019' in forager:
+            learn_rates = [p('learn_rate_unrew'), p('learn_rate_rew')]
+            forget_rates = [p('forget_rate', np.zeros([n_sets, 1])), 0]
+        else:
+            raise NotImplementedError(f'No fast likelihood for forager {forager}')
+
+        learn_rate_this = np.where(reward != 0, learn_rates[1], learn_rates[0])[:, None, :]   # [n_sets, 1, n_trials]
+        forget_unchosen, forget_chosen = [np.reshape(ff, (-1, 1, 1)) for ff in np.broadcast_arrays(*forget_rates)]
+        q = linear_recurrence_population(np.where(chosen, 1 - forget_chosen - learn_rate_this, 1 - forget_unchosen),
+                                         np.where(chosen, learn_rate_this * reward, 0))
+
+    if forager == 'RW1972_epsi':
+        bias_terms = np.hstack([p('biasL'), -p('biasL')]) if K == 2 else \
+            np.hstack([p('biasL'), -(p('biasL') + p('biasR')), p('biasR')])
+    else:
+        bias_terms = np.hstack([p('biasL'), np.zeros([n_sets, 1])]) if K == 2 else \
+            np.hstack([p('biasL'), np.zeros([n_sets, 1]), p('biasR')])
+    bias_terms = bias_terms[:, :, None]   # [n_sets, K, 1]
+
+    # -- Epsilon-greedy --
+    if forager == 'RW1972_epsi':
+        epsilon = p('epsilon')[:, :, None]
+        prob = np.broadcast_to(epsilon * (1 / K + bias_terms), q.shape).copy()
+        is_max = q == np.max(q, axis=1, keepdims=True)
+        greedy = np.argmax(is_max, axis=1)
+        for ss, tt in np.argwhere(np.sum(is_max, axis=1) > 1):   # Random tie break (same draws as set by set)
+            greedy[ss, tt] = np.random.choice(np.flatnonzero(is_max[ss, :, tt]))
+        greedy = greedy[:, None, :]   # [n_sets, 1, n_trials + 1]
+        np.put_along_axis(prob, greedy, 1 - epsilon + epsilon * (1 / K + np.take_along_axis(
+            np.broadcast_to(bias_terms, q.shape), greedy, axis=1)), axis=1)
+        return prob
+
+    # -- Softmax (with choice kernel) --
+    X = q / p('softmax_temperature')[:, :, None]
+    if '_CK' in forager:
+        choice_step_size = p('choice_step_size')[:, :, None]
+        choice_kernel = linear_recurrence_population(1 - choice_step_size, choice_step_size * chosen)
+        X = X + choice_kernel / p('choice_softmax_temperature')[:, :, None]
+    X = X + bias_terms
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        prob = np.exp(X) / np.sum(np.exp(X), axis=1, keepdims=True)
+
+    # To prevent explosion of EXP (same as util.softmax)
+    for ss, tt in np.argwhere(np.max(X, axis=1) > 700):
+        prob[ss, :, tt] = 0
+        prob[ss, np.random.choice(np.flatnonzero(X[ss, :, tt] == np.max(X[ss, :, tt]))), tt] = 1
+    return prob
@@ -83,6 +83,7 @@ def plot_all_traces(session_key, unit_key,
     :param trial_offset: index of trial to plot from (if a decimal between 0 and 1, indicates the proportion of total trial to plot from)
     :param trial_limit: number of trial to plot
     """
+    ephys.check_trial_spikes(unit_key)  # reads ephys.Unit.TrialSpikes
 
     if tracking_feature not in _tracked_nose_features + _tracked_tongue_features + _tracked_jaw_features:
         print(f'Unknown tracking type: {tracking_feature}\nAvailable tracking types are: {_tracked_nose_features + _tracked_tongue_features + _tracked_jaw_features}')
@@ -210,6 +211,7 @@ def plot_tracking(session_key, unit_key,
     :param trial_offset: index of trial to plot from (if a decimal between 0 and 1, indicates the proportion of total trial to plot from)
     :param trial_limit: number of trial to plot
     """
+    ephys.check_trial_spikes(unit_key)  # reads ephys.Unit.TrialSpikes
 
     if tracking_feature not in _tracked_nose_features + _tracked_tongue_features + _tracked_jaw_features:
         print(f'Unknown tracking type: {tracking_feature}\nAvailable tracking types are: {_tracked_nose_features + _tracked_tongue_features + _tracked_jaw_features}')
@@ -294,6 +296,7 @@ def plot_breathing(session_key, unit_key, trial_offset=0, trial_limit=3, xlim=(0
     :param trial_offset: index of trial to plot from (if a decimal between 0 and 1, indicates the proportion of total trial to plot from)
     :param trial_limit: number of trial to plot
     """
+    ephys.check_trial_spikes(unit_key)  # reads ephys.Unit.TrialSpikes
 
     if not experiment.Breathing & session_key:
         print('No breathing data')
@@ -347,6 +350,7 @@ def plot_whisking(session_key, unit_key, trial_offset=0, trial_limit=10, xlim=(0
     :param trial_offset: index of trial to plot from (if a decimal between 0 and 1, indicates the proportion of total trial to plot from)
     :param trial_limit: number of trial to plot
     """
+    ephys.check_trial_spikes(unit_key)  # reads ephys.Unit.TrialSpikes
     
     num_frame = 1471
     traces = tracking.Tracking.JawTracking & session_key & {'tracking_device': 'Camera 4'}
@@ -32,6 +32,7 @@ class JawTuning(dj.Computed):
     key_source = experiment.Session & ephys.Unit & tracking.Tracking & 'rig = "RRig-MTL"'
     
     def make(self, key):
+        ephys.check_trial_spikes(key)  # reads ephys.Unit.TrialSpikes
         num_frame = 1470
         # get traces and phase
         good_units=ephys.Unit * ephys.ClusterMetric * ephys.UnitStat & key & 'presence_ratio > 0.9' & 'amplitude_cutoff < 0.15' & 'avg_firing_rate > 0.2' & 'isi_violation < 10' & 'unit_amp > 150'
@@ -111,6 +112,7 @@ class BreathingTuning(dj.Computed):
     key_source = experiment.Session & experiment.Breathing & ephys.Unit & 'rig = "RRig-MTL"'
     
     def make(self, key):
+        ephys.check_trial_spikes(key)  # reads ephys.Unit.TrialSpikes
     
         # get traces and phase
         good_units=ephys.Unit * ephys.ClusterMetric * ephys.UnitStat & key & 'presence_ratio > 0.9' & 'amplitude_cutoff < 0.15' & 'avg_firing_rate > 0.2' & 'isi_violation < 10' & 'unit_amp > 150'
@@ -179,6 +181,7 @@ class WhiskerTuning(dj.Computed):
     key_source = experiment.Session & v_oralfacial_analysis.WhiskerSVD & ephys.Unit & 'rig = "RRig-MTL"'
     
     def make(self, key):
+        ephys.check_trial_spikes(key)  # reads ephys.Unit.TrialSpikes
         num_frame = 1471
         # get traces and phase
         good_units=ephys.Unit * ephys.ClusterMetric * ephys.UnitStat & key & 'presence_ratio > 0.9' & 'amplitude_cutoff < 0.15' & 'avg_firing_rate > 0.2' & 'isi_violation < 10' & 'unit_amp > 150'
@@ -254,6 +257,7 @@ class GLMFit(dj.Computed):
     key_source = experiment.Session & v_tracking.TongueTracking3DBot & experiment.Breathing & v_oralfacial_analysis.WhiskerSVD & ephys.Unit & 'rig = "RRig-MTL"'
     
     def make(self, key):
+        ephys.check_trial_spikes(key)  # reads ephys.Unit.TrialSpikes
         num_frame = 1471
         good_units=ephys.Unit * ephys.ClusterMetric * ephys.UnitStat & key & 'presence_ratio > 0.9' & 'amplitude_cutoff < 0.15' & 'avg_firing_rate > 0.2' & 'isi_violation < 10' & 'unit_amp > 150'
         unit_keys=good_units.fetch('KEY')
@@ -535,6 +539,7 @@ class GLMFitNoLick(dj.Computed):
     key_source = experiment.Session & v_tracking.TongueTracking3DBot & experiment.Breathing & v_oralfacial_analysis.WhiskerSVD & ephys.Unit & 'rig = "RRig-MTL"'
     
     def make(self, key):
+        ephys.check_trial_spikes(key)  # reads ephys.Unit.TrialSpikes
         good_units=ephys.Unit * ephys.ClusterMetric * ephys.UnitStat & key & 'presence_ratio > 0.9' & 'amplitude_cutoff < 0.15' & 'avg_firing_rate > 0.2' & 'isi_violation < 10' & 'unit_amp > 150'
         unit_keys=good_units.fetch('KEY')
         bin_width = 0.017
@@ -851,6 +856,7 @@ class DirectionTuning(dj.Computed):
     key_source = experiment.Session & v_oralfacial_analysis.ContactLick & ephys.Unit & 'rig = "RRig-MTL"'
     
     def make(self, key):
+        ephys.check_trial_spikes(key)  # reads ephys.Unit.TrialSpikes
         good_units=ephys.Unit * ephys.ClusterMetric * ephys.UnitStat & key & 'presence_ratio > 0.9' & 'amplitude_cutoff < 0.15' & 'avg_firing_rate > 0.2' & 'isi_violation < 10' & 'unit_amp > 150'
         unit_keys=good_units.fetch('KEY')
 
@@ -129,6 +129,7 @@ def plot_tracking(session_key, unit_key,
     :param trial_offset: index of trial to plot from (if a decimal between 0 and 1, indicates the proportion of total trial to plot from)
     :param trial_limit: number of trial to plot
     """
+    ephys.check_trial_spikes(unit_key)  # reads ephys.Unit.TrialSpikes
 
     if tracking_feature not in _tracked_nose_features + _tracked_tongue_features + _tracked_jaw_features:
         print(f'Unknown tracking type: {tracking_feature}\nAvailable tracking types are: {_tracked_nose_features + _tracked_tongue_features + _tracked_jaw_features}')
@@ -196,6 +197,7 @@ def plot_tracking(session_key, unit_key,
 
 
 def plot_unit_jaw_phase_dist(session_key, unit_key, bin_counts=20, axs=None):
+    ephys.check_trial_spikes(unit_key)  # reads ephys.Unit.TrialSpikes
     trk = (tracking.Tracking.JawTracking * tracking.Tracking.TongueTracking
            * experiment.BehaviorTrial & _side_cam & session_key & experiment.ActionEvent & ephys.Unit.TrialSpikes)
     tracking_fs = float((tracking.TrackingDevice & tracking.Tracking & _side_cam & session_key).fetch1('sampling_rate'))
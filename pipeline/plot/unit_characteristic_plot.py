@@ -260,8 +260,8 @@ def plot_unit_bilateral_photostim_effect(probe_insertion, clustering_method=None
             x, y = (ephys.Unit & unit).fetch1('unit_posx', 'unit_posy')
 
         # obtain unit psth per trial, for all nostim and bistim trials
-        nostim_trials = ephys.Unit.TrialSpikes & unit & psth.TrialCondition.get_trials(no_stim_cond['trial_condition_name'])
-        bistim_trials = ephys.Unit.TrialSpikes & unit & psth.TrialCondition.get_trials(bi_stim_cond['trial_condition_name'])
+        nostim_trials = psth.TrialCondition.get_session_trials(no_stim_cond['trial_condition_name'], unit)
+        bistim_trials = psth.TrialCondition.get_session_trials(bi_stim_cond['trial_condition_name'], unit)
 
         nostim_psths, nostim_edge = psth.compute_unit_psth(unit, nostim_trials.fetch('KEY'), per_trial=True)
         bistim_psths, bistim_edge = psth.compute_unit_psth(unit, bistim_trials.fetch('KEY'), per_trial=True)
@@ -406,10 +406,15 @@ def plot_driftmap(probe_insertion, clustering_method=None, shank_no=1):
     annotated_electrodes = (lab.ElectrodeConfig.Electrode * lab.ProbeType.Electrode
                             * ephys.ProbeInsertion
                             * histology.ElectrodeCCFPosition.ElectrodePosition
-                            * ccf.CCFAnnotation * ccf.CCFBrainRegion.proj(..., annotation='region_name')
                             & probe_insertion & {'shank': shank_no})
-    pos_y, ccf_y, color_code = annotated_electrodes.fetch(
-        'y_coord', 'ccf_y', 'color_code', order_by='y_coord DESC')
+    pos_y, ccf_x, ccf_y, ccf_z = annotated_electrodes.fetch(
+        'y_coord', 'ccf_x', 'ccf_y', 'ccf_z', order_by='y_coord DESC')
+
+    ccf_volume = ccf.get_annotation_volume()
+    region_indices = ccf_volume.region_indices(ccf_x, ccf_y, ccf_z)
+    is_annotated = region_indices >= 0
+    pos_y, ccf_y = pos_y[is_annotated], ccf_y[is_annotated]
+    color_code = ccf_volume.color_codes[region_indices[is_annotated]]
 
     # CCF position of most ventral recording site
     last_electrode_site = np.array((histology.InterpolatedShankTrack.DeepestElectrodePoint
@@ -276,23 +276,23 @@ def plot_unit_psth_choice_outcome(unit_key={'subject_id': 473361, 'session': 47,
 
         # align_trial_offset is added on the get_trials, which effectively
         # makes the psth conditioned on the previous {align_trial_offset} trials
-        ipsi_hit_trials = psth_foraging.TrialCondition.get_trials(f'{ipsi}_hit{no_early_lick}', offset) & unit_key
+        ipsi_hit_trials = psth_foraging.TrialCondition.get_session_trials(f'{ipsi}_hit{no_early_lick}', unit_key, offset)
         ipsi_hit_unit_psth = psth_foraging.compute_unit_psth_and_raster(unit_key, ipsi_hit_trials, align_type)
 
-        contra_hit_trials = psth_foraging.TrialCondition.get_trials(f'{contra}_hit{no_early_lick}', offset) & unit_key
+        contra_hit_trials = psth_foraging.TrialCondition.get_session_trials(f'{contra}_hit{no_early_lick}', unit_key, offset)
         contra_hit_unit_psth = psth_foraging.compute_unit_psth_and_raster(unit_key, contra_hit_trials, align_type)
 
-        ipsi_miss_trials = psth_foraging.TrialCondition.get_trials(f'{ipsi}_miss{no_early_lick}', offset) & unit_key
+        ipsi_miss_trials = psth_foraging.TrialCondition.get_session_trials(f'{ipsi}_miss{no_early_lick}', unit_key, offset)
         ipsi_miss_unit_psth = psth_foraging.compute_unit_psth_and_raster(unit_key, ipsi_miss_trials, align_type)
 
-        contra_miss_trials = psth_foraging.TrialCondition.get_trials(f'{contra}_miss{no_early_lick}', offset) & unit_key
+        contra_miss_trials = psth_foraging.TrialCondition.get_session_trials(f'{contra}_miss{no_early_lick}', unit_key, offset)
         contra_miss_unit_psth = psth_foraging.compute_unit_psth_and_raster(unit_key, contra_miss_trials, align_type)
 
         # --- plot psths (all 4 in one plot) ---
         ax_psth = axs[1 if if_raster else 0, ax_i]
         period_starts_hit = _get_ephys_trial_event_times(align_types,
                                                          align_to=align_type,
-                                                         trial_keys=psth_foraging.TrialCondition.get_trials(f'LR_hit{no_early_lick}') & unit_key,
+                                                         trial_keys=psth_foraging.TrialCondition.get_session_trials(f'LR_hit{no_early_lick}', unit_key),
                                                          # cannot use *_hit_trials because it could have been offset
                                                          )
         # _, period_starts_miss = _get_ephys_trial_event_times([trialstart, 'go', 'choice', 'trialend'],
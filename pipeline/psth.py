@@ -1,5 +1,6 @@
 import logging
 import hashlib
+import pathlib
 
 from functools import partial
 from inspect import getmembers
@@ -7,12 +8,13 @@ from itertools import repeat
 import numpy as np
 import datajoint as dj
 import scipy.stats as sc_stats
+from scipy.ndimage import gaussian_filter1d
 
 from . import (lab, experiment, ephys)
 [lab, experiment, ephys]  # NOQA
 
 from . import get_schema_name, dict_to_hash
-from .util import _get_units_hemisphere
+from .util import _get_units_hemisphere, get_session_trial_set
 
 schema = dj.schema(get_schema_name('psth'))
 log = logging.getLogger(__name__)
@@ -171,6 +173,18 @@ class TrialCondition(dj.Lookup):
     def get_trials(cls, trial_condition_name):
         return cls.get_func({'trial_condition_name': trial_condition_name})()
 
+    @classmethod
+    def get_session_trials(cls, trial_condition_name, session_key):
+        """
+        Trials of "trial_condition_name" within the session of "session_key" (e.g. a unit key),
+        as a restriction of experiment.BehaviorTrial - resolved once per session and cached
+        (see util.get_session_trial_set)
+        """
+        trials = get_session_trial_set(cls, trial_condition_name, session_key)
+        session_key = {k: session_key[k] for k in experiment.Session.primary_key}
+        return (experiment.BehaviorTrial & session_key
+                & ('trial in ({})'.format(','.join(map(str, trials))) if len(trials) else 'FALSE'))
+
     @classmethod
     def get_cond_name_from_keywords(cls, keywords):
         matched_cond_names = []
@@ -249,6 +263,45 @@ class TrialCondition(dj.Lookup):
                  - [{k: v} for k, v in _stim_key.items()]).proj())
 
 
+@schema
+class ProbeSpikeCountCube(dj.Computed):
+    definition = """
+    # Spike counts of all units x trials of a probe insertion in fine time bins relative to go-cue (see SpikeCountCube)
+    -> ephys.ProbeInsertion
+    -> ephys.ClusteringMethod
+    ---
+    clustering_fingerprint: char(32)  # hash of the unit ids and clustering time the cube was built from
+    cube_xmin: double       # (s) start of the fine bins, relative to go-cue
+    cube_xmax: double       # (s) end of the fine bins, relative to go-cue
+    fine_bin_size: double   # (s)
+    units: longblob         # (unit,) unit ids
+    seg_units: longblob     # (segment,) index into units of each (unit, trial) segment
+    seg_trials: longblob    # (segment,) trial number of each (unit, trial) segment
+    seg_offsets: longblob   # (segment + 1,) spike_bins[seg_offsets[i]:seg_offsets[i+1]] are the spikes of segment i
+    spike_bins: longblob    # fine-bin index of each spike, ascending within a segment
+    """
+
+    cube_params = {'xmin': -3, 'xmax': 3, 'fine_bin_size': 0.001}
+
+    @property
+    def key_source(self):
+        return (ephys.ProbeInsertion * ephys.ClusteringMethod & ephys.Unit).proj()
+
+    def make(self, key):
+        cube = SpikeCountCube.from_trial_spikes(ephys.fetch_trial_spikes(ephys.Unit & key), **self.cube_params)
+        self.insert1({**key, 'clustering_fingerprint': get_clustering_fingerprint(key), 'cube_xmin': cube.xmin, 'cube_xmax': cube.xmax, 'fine_bin_size': cube.fine_bin_size,
+                      'units': cube.units, 'seg_units': cube.seg_units.astype(np.uint32),
+                      'seg_trials': cube.seg_trials.astype(np.uint32), 'seg_offsets': cube.offsets,
+                      'spike_bins': cube.spike_bins})
+        clear_spike_count_cube_cache()
+
+    @classmethod
+    def get_cube(cls, key):
+        cube = (cls & key).fetch1()
+        return SpikeCountCube(cube['units'], cube['seg_units'], cube['seg_trials'], cube['seg_offsets'],
+                              cube['spike_bins'], cube['cube_xmin'], cube['cube_xmax'], cube['fine_bin_size'])
+
+
 @schema
 class UnitPsth(dj.Computed):
     definition = """
@@ -292,6 +345,71 @@ class UnitPsth(dj.Computed):
                       'unit_psth': np.array([psth, edges]),
                       'trial_count': len(trials)})
 
+    @classmethod
+    def populate_by_probe(cls, *restrictions):
+        """
+        Probe-batched alternative to UnitPsth.populate(), computing the same rows as make():
+         for each probe insertion, the spike count cube of all units (ProbeSpikeCountCube, or built from
+         the trial spikes if not populated) and the trials of each trial condition are fetched once,
+         and all the UnitPsth rows of the probe are inserted at once
+        :param restrictions: restrictions on the key_source (e.g. a session or probe insertion key)
+        """
+        todo = (cls().key_source & dj.AndList(restrictions)) - cls
+        probe_keys = (ephys.ProbeInsertion & todo).fetch('KEY')
+
+        xmin, xmax, bin_size = cls.psth_params.values()
+        binning = np.arange(xmin, xmax, bin_size)
+
+        for probe_idx, probe_key in enumerate(probe_keys):
+            log.info('UnitPsth.populate_by_probe(): probe {}/{}: {}'.format(probe_idx + 1, len(probe_keys), probe_key))
+
+            keys = (todo & probe_key).fetch('KEY')
+            has_quality = bool(ephys.ProbeInsertionQuality & probe_key)
+
+            cond_trials, trial_counts = {}, {}
+            for trial_condition_name in sorted(set(k['trial_condition_name'] for k in keys)):
+                # expand TrialCondition to trials,
+                trials = TrialCondition.get_trials(trial_condition_name)
+                if has_quality:
+                    trials &= ephys.ProbeInsertionQuality.GoodTrial
+                trial_counts[trial_condition_name] = len(trials)
+                if has_quality:
+                    cond_trials[trial_condition_name] = (
+                            TrialCondition.get_session_trials(trial_condition_name, probe_key)
+                            & ephys.ProbeInsertionQuality.GoodTrial).fetch('trial')
+                else:
+                    cond_trials[trial_condition_name] = get_session_trial_set(
+                        TrialCondition, trial_condition_name, probe_key)
+
+            rows = []
+            for clustering_method in sorted(set(k['clustering_method'] for k in keys)):
+                cube_key = {**probe_key, 'clustering_method': clustering_method}
+                cube = get_spike_count_cube(cube_key)
+                if cube is None:
+                    cube = SpikeCountCube.from_trial_spikes(ephys.fetch_trial_spikes(ephys.Unit & cube_key),
+                                                            xmin=xmin, xmax=xmax,
+                                                            fine_bin_size=ProbeSpikeCountCube.cube_params['fine_bin_size'])
+                unit_index = {u: i for i, u in enumerate(cube.units)}
+
+                for trial_condition_name, trials in cond_trials.items():
+                    segs = cube.select(trials=trials)
+                    cond_psths = cube.unit_counts(binning, segs)
+                    unit_trial_counts = np.bincount(cube.seg_units[segs], minlength=len(cube.units))
+
+                    for key in (k for k in keys if k['trial_condition_name'] == trial_condition_name
+                                and k['clustering_method'] == clustering_method):
+                        i = unit_index.get(key['unit'])
+                        if i is None or not unit_trial_counts[i]:
+                            log.warning('no spikes found for key {} - null psth'.format(key))
+                            rows.append({**key, 'unit_psth': None, 'trial_count': None})
+                        else:
+                            psth = cond_psths[i] / unit_trial_counts[i] / bin_size
+                            rows.append({**key, 'unit_psth': np.array([psth, binning[1:]]),
+                                         'trial_count': trial_counts[trial_condition_name]})
+
+            with dj.conn().transaction:
+                cls.insert(rows, allow_direct_insert=True)
+
     @classmethod
     def get_plotting_data(cls, unit_key, condition_key):
         """
@@ -314,8 +432,7 @@ class UnitPsth(dj.Computed):
         if unit_psth is None:
             raise Exception('No spikes found for this unit and trial-condition')
 
-        spikes, trials = (ephys.Unit.TrialSpikes & trials & unit_key).fetch(
-            'spike_times', 'trial', order_by='trial asc')
+        [(_, trials, spikes)] = ephys.fetch_trial_spikes(unit_key, trials)
 
         raster = [np.concatenate(spikes),
                   np.concatenate([[t] * len(s)
@@ -368,20 +485,22 @@ class PeriodSelectivity(dj.Computed):
         hemi = _get_units_hemisphere(key)
 
         # retrieving the spikes of interest,
-        spikes_q = ((ephys.Unit.TrialSpikes & key)
-                    * (experiment.BehaviorTrial
-                       & {'task': 'audio delay',
-                          'early_lick': 'no early',
-                          'outcome': 'hit',
-                          'free_water': 0,
-                          'auto_water': 0})
+        trials_q = ((experiment.BehaviorTrial & key
+                     & {'task': 'audio delay',
+                        'early_lick': 'no early',
+                        'outcome': 'hit',
+                        'free_water': 0,
+                        'auto_water': 0})
                     & (experiment.TrialEvent & 'trial_event_type = "delay"' & 'duration = 1.2')
                     - experiment.PhotostimEvent)
+        [(_, spike_trials, trial_spikes)] = ephys.fetch_trial_spikes(ephys.Unit & key, trials_q)
 
-        if not spikes_q:  # no spikes found
+        if not len(spike_trials):  # no spikes found
             self.insert1({**key, 'period_selectivity': 'non-selective'})
             return
 
+        trial_instructions = dict(zip(*trials_q.fetch('trial', 'trial_instruction')))
+
         # retrieving event times
         start_event, start_tshift, end_event, end_tshift = (experiment.Period & key).fetch1(
             'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift')
@@ -396,7 +515,8 @@ class PeriodSelectivity(dj.Computed):
 
         # compute spike rate during the period-of-interest for each trial
         freq_i, freq_c = [], []
-        for trial, trial_instruct, spike_times in zip(*spikes_q.fetch('trial', 'trial_instruction', 'spike_times')):
+        for trial, spike_times in zip(spike_trials, trial_spikes):
+            trial_instruct = trial_instructions[trial]
             start_time = start_event_q[trial] - cue_event_q[trial]
             stop_time = end_event_q[trial] - cue_event_q[trial]
             spk_rate = np.logical_and(spike_times >= start_time, spike_times < stop_time).sum() / (stop_time - start_time)
@@ -427,6 +547,108 @@ class PeriodSelectivity(dj.Computed):
                       'ipsi_firing_rate': freq_i_m,
                       'contra_firing_rate': freq_c_m})
 
+    @classmethod
+    def populate_by_probe(cls, *restrictions):
+        """
+        Probe-batched alternative to PeriodSelectivity.populate(), computing the same rows as make():
+         for each probe insertion, the trial spikes of all units and the boundaries of all periods
+         are fetched once, the spikes of every (unit, trial, period) are counted in one vectorized pass,
+         and the t-tests are computed for all units at once
+        :param restrictions: restrictions on the key_source (e.g. a session or probe insertion key)
+        """
+        todo = (cls.key_source & dj.AndList(restrictions)) - cls
+        probe_keys = (ephys.ProbeInsertion & todo).fetch('KEY')
+
+        for probe_idx, probe_key in enumerate(probe_keys):
+            log.info('PeriodSelectivity.populate_by_probe(): probe {}/{}: {}'.format(
+                probe_idx + 1, len(probe_keys), probe_key))
+
+            keys = (todo & probe_key).fetch('KEY')
+            session_key = (experiment.Session & probe_key).fetch1('KEY')
+            hemi = _get_units_hemisphere(probe_key)
+
+            # retrieving the spikes of interest,
+            trials_q = (experiment.BehaviorTrial & session_key
+                        & {'task': 'audio delay',
+                           'early_lick': 'no early',
+                           'outcome': 'hit',
+                           'free_water': 0,
+                           'auto_water': 0}
+                        & (experiment.TrialEvent & 'trial_event_type = "delay"' & 'duration = 1.2')
+                        - experiment.PhotostimEvent)
+            trial_instructions = dict(zip(*trials_q.fetch('trial', 'trial_instruction')))
+
+            unit_trial_spikes = ephys.fetch_trial_spikes(ephys.Unit & keys, trials_q)
+            unit_index = {(k['clustering_method'], k['unit']): i for i, (k, _, _) in enumerate(unit_trial_spikes)}
+
+            seg_units = np.repeat(np.arange(len(unit_trial_spikes)), [len(t) for _, t, _ in unit_trial_spikes])
+            seg_trials = np.concatenate([t for _, t, _ in unit_trial_spikes] + [[]]).astype(int)
+            spike_segs = np.repeat(np.arange(len(seg_trials)),
+                                   [len(s) for _, _, spikes in unit_trial_spikes for s in spikes])
+            spike_times = np.concatenate([np.concatenate(spikes) for _, _, spikes in unit_trial_spikes
+                                          if len(spikes)] + [[]])
+            # per unit: group 0 - ipsi-trials, group 1 - contra-trials
+            seg_groups = seg_units * 2 + np.array([trial_instructions[t] != hemi for t in seg_trials], dtype=int)
+            group_count = np.bincount(seg_groups, minlength=len(unit_trial_spikes) * 2).reshape(-1, 2)
+
+            # retrieving event times (last event per trial, as in make())
+            cue_event_q = dict(zip(*(experiment.TrialEvent & session_key & {'trial_event_type': 'go'}).fetch(
+                'trial', 'trial_event_time', order_by='trial, trial_event_id')))
+
+            rows = []
+            for period in sorted(set(k['period'] for k in keys)):
+                start_event, start_tshift, end_event, end_tshift = (experiment.Period & {'period': period}).fetch1(
+                    'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift')
+                start_event_q = dict(zip(*(experiment.TrialEvent & session_key
+                                           & {'trial_event_type': start_event}).proj(
+                    start_event_time=f'trial_event_time + {start_tshift}').fetch(
+                    'trial', 'start_event_time', order_by='trial, trial_event_id')))
+                end_event_q = dict(zip(*(experiment.TrialEvent & session_key
+                                         & {'trial_event_type': end_event}).proj(
+                    end_event_time=f'trial_event_time + {end_tshift}').fetch(
+                    'trial', 'end_event_time', order_by='trial, trial_event_id')))
+
+                # compute spike rate during the period-of-interest for each (unit, trial)
+                seg_start = np.array([float(start_event_q[t]) - float(cue_event_q[t]) for t in seg_trials])
+                seg_stop = np.array([float(end_event_q[t]) - float(cue_event_q[t]) for t in seg_trials])
+                is_in_period = np.logical_and(spike_times >= seg_start[spike_segs], spike_times < seg_stop[spike_segs])
+                seg_rates = np.bincount(spike_segs[is_in_period], minlength=len(seg_trials)) / (seg_stop - seg_start)
+
+                # and testing for selectivity - equal variance t-test, as sc_stats.ttest_ind()
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    freq_m = np.bincount(seg_groups, weights=seg_rates,
+                                         minlength=group_count.size).reshape(-1, 2) / group_count
+                    freq_var = np.bincount(seg_groups, weights=(seg_rates - freq_m.ravel()[seg_groups]) ** 2,
+                                           minlength=group_count.size).reshape(-1, 2) / (group_count - 1)
+                    n_i, n_c = group_count[:, 0], group_count[:, 1]
+                    dof = n_i + n_c - 2.0
+                    pooled_var = ((n_i - 1) * freq_var[:, 0] + (n_c - 1) * freq_var[:, 1]) / dof
+                    t_stat = (freq_m[:, 0] - freq_m[:, 1]) / np.sqrt(pooled_var * (1.0 / n_i + 1.0 / n_c))
+                    pvals = 2 * sc_stats.t.sf(np.abs(t_stat), dof)
+
+                for key in (k for k in keys if k['period'] == period):
+                    i = unit_index.get((key['clustering_method'], key['unit']))
+                    if i is None or not group_count[i].sum():  # no spikes found
+                        rows.append({**key, 'p_value': 1, 'period_selectivity': 'non-selective',
+                                     'ipsi_firing_rate': 0, 'contra_firing_rate': 0})
+                        continue
+
+                    freq_i_m, freq_c_m = freq_m[i]
+                    pval = 1 if np.isnan(pvals[i]) else pvals[i]
+                    if pval > cls.alpha:
+                        pref = 'non-selective'
+                    else:
+                        pref = ('ipsi-selective' if freq_i_m > freq_c_m
+                                else 'contra-selective')
+
+                    rows.append({**key, 'p_value': pval,
+                                 'period_selectivity': pref,
+                                 'ipsi_firing_rate': freq_i_m,
+                                 'contra_firing_rate': freq_c_m})
+
+            with dj.conn().transaction:
+                cls.insert(rows, allow_direct_insert=True)
+
 
 @schema
 class UnitSelectivity(dj.Computed):
@@ -471,35 +693,369 @@ class UnitSelectivity(dj.Computed):
         self.insert1({**key, 'unit_selectivity': pref})
 
 
-def compute_unit_psth(unit_key, trial_keys, per_trial=False):
+# ======== Spike count cube ========
+
+class SpikeCountCube:
+    """
+    Spike counts of a set of units x trials in fine time bins (relative to go-cue), stored compactly:
+     one segment per (unit, trial), holding the sorted fine-bin indices of the segment's spikes (CSR).
+    The cumulative spike count of a segment at any fine-bin edge is a sorted search,
+     so PSTHs of any coarser bin size, window or smoothing are derived without re-binning the spikes
+    """
+
+    def __init__(self, units, seg_units, seg_trials, offsets, spike_bins, xmin, xmax, fine_bin_size):
+        """
+        :param units: (unit,) unit ids
+        :param seg_units: (segment,) index into "units" of each segment
+        :param seg_trials: (segment,) trial number of each segment - segments are sorted by (unit, trial)
+        :param offsets: (segment + 1,) spike_bins[offsets[i]:offsets[i+1]] are the spikes of segment i
+        :param spike_bins: fine-bin index of each spike (ascending within a segment)
+        :param xmin, xmax: (s) time window of the fine bins
+        :param fine_bin_size: (s)
+        """
+        self.units = np.asarray(units, dtype=int)
+        self.seg_units = np.asarray(seg_units, dtype=int)
+        self.seg_trials = np.asarray(seg_trials, dtype=int)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.spike_bins = np.asarray(spike_bins)
+        self.xmin, self.xmax, self.fine_bin_size = float(xmin), float(xmax), float(fine_bin_size)
+        self.n_fine = int(round((self.xmax - self.xmin) / self.fine_bin_size))
+        # globally ascending search keys: segment * n_fine + fine-bin
+        self._keys = (np.repeat(np.arange(len(self.seg_trials), dtype=np.int64), np.diff(self.offsets)) * self.n_fine
+                      + self.spike_bins.astype(np.int64))
+
+    @classmethod
+    def from_trial_spikes(cls, unit_trial_spikes, xmin, xmax, fine_bin_size):
+        """
+        Build the cube from the output of ephys.fetch_trial_spikes()
+        """
+        n_fine = int(round((xmax - xmin) / fine_bin_size))
+        fine_edges = xmin + np.arange(n_fine + 1) * fine_bin_size
+
+        units = [k['unit'] for k, _, _ in unit_trial_spikes]
+        seg_units = np.repeat(np.arange(len(units)), [len(trials) for _, trials, _ in unit_trial_spikes])
+        seg_trials = np.concatenate([trials for _, trials, _ in unit_trial_spikes] + [[]]).astype(int)
+        seg_spike_counts = [len(s) for _, _, spikes in unit_trial_spikes for s in spikes]
+        spike_times = np.concatenate([np.concatenate(spikes) for _, _, spikes in unit_trial_spikes
+                                      if len(spikes)] + [[]])
+
+        spike_segs = np.repeat(np.arange(len(seg_trials), dtype=np.int64), seg_spike_counts)
+        spike_bins = np.searchsorted(fine_edges, spike_times, side='right') - 1
+        in_window = (spike_bins >= 0) & (spike_bins < n_fine)
+        keys = np.sort(spike_segs[in_window] * n_fine + spike_bins[in_window])
+        offsets = np.searchsorted(keys, np.arange(len(seg_trials) + 1, dtype=np.int64) * n_fine)
+
+        spike_bins = (keys % n_fine).astype(np.uint16 if n_fine <= np.iinfo(np.uint16).max else np.uint32)
+        return cls(units, seg_units, seg_trials, offsets, spike_bins, xmin, xmax, fine_bin_size)
+
+    def select(self, unit=None, trials=None):
+        """
+        Indices of the segments of "unit" (unit id), restricted to "trials" (trial numbers)
+        """
+        segs = np.arange(len(self.seg_trials))
+        if unit is not None:
+            segs = segs[self.units[self.seg_units] == unit]
+        if trials is not None:
+            segs = segs[np.isin(self.seg_trials[segs], trials)]
+        return segs
+
+    def _edge_index(self, edges, snap=False):
+        """
+        Fine-bin index of each of the "edges" (s) - edges must be on the fine bins within the window,
+         unless "snap" (round to the nearest fine bin, clipped to the window)
+        """
+        idx = (np.asarray(edges, dtype=float) - self.xmin) / self.fine_bin_size
+        rounded = np.round(idx)
+        if snap:
+            return np.clip(rounded, 0, self.n_fine).astype(np.int64)
+        if not np.allclose(idx, rounded, rtol=0, atol=1e-6):
+            raise ValueError('Edges are not aligned to the {} s bins of the spike count cube'.format(
+                self.fine_bin_size))
+        if len(rounded) and (rounded.min() < 0 or rounded.max() > self.n_fine):
+            raise ValueError('Edges outside of the spike count cube window ({}, {})'.format(self.xmin, self.xmax))
+        return rounded.astype(np.int64)
+
+    def is_aligned(self, edges):
+        """
+        True if all the "edges" (s) are on the fine bins within the window (i.e. usable for counts() and psth())
+        """
+        idx = (np.asarray(edges, dtype=float) - self.xmin) / self.fine_bin_size
+        return bool(np.allclose(idx, np.round(idx), rtol=0, atol=1e-6)
+                    and (not len(idx) or (np.round(idx).min() >= 0 and np.round(idx).max() <= self.n_fine)))
+
+    def _cumulative_counts(self, edge_idx, segs):
+        return (np.searchsorted(self._keys, segs[:, None] * self.n_fine + edge_idx[None, :])
+                - self.offsets[segs][:, None])
+
+    def cumulative_counts(self, edges, segs=None):
+        """
+        (segment x edge) number of spikes before each of the "edges"
+        """
+        segs = np.arange(len(self.seg_trials)) if segs is None else np.asarray(segs, dtype=np.int64)
+        return self._cumulative_counts(self._edge_index(edges), segs)
+
+    def counts(self, edges, segs=None):
+        """
+        (segment x bin) spike counts in the bins [edges[i], edges[i+1])
+        """
+        return np.diff(self.cumulative_counts(edges, segs), axis=1)
+
+    def unit_counts(self, edges, segs=None):
+        """
+        (unit x bin) spike counts in the bins [edges[i], edges[i+1]), summed over the segments of each unit
+         - a single pass over the spikes of "segs", independent of the number of segments
+        """
+        edge_idx = self._edge_index(edges)
+        bin_count = len(edge_idx) - 1
+
+        spike_segs = self._keys // self.n_fine
+        spike_bins = np.searchsorted(edge_idx, self.spike_bins, side='right') - 1
+        is_counted = (spike_bins >= 0) & (spike_bins < bin_count)
+        if segs is not None:
+            is_selected = np.zeros(len(self.seg_trials), dtype=bool)
+            is_selected[segs] = True
+            is_counted &= is_selected[spike_segs]
+
+        return np.bincount(self.seg_units[spike_segs[is_counted]] * bin_count + spike_bins[is_counted],
+                           minlength=len(self.units) * bin_count).reshape(-1, bin_count)
+
+    def psth(self, segs, bin_size, window, smoothing=None, per_trial=False):
+        """
+        Firing rate (spk/s) of the segments "segs" in the bins np.arange(*window, bin_size)
+        :param smoothing: None, ('boxcar', width) or ('gaussian', sigma) - width/sigma in seconds
+            boxcar: spike count within +/- width/2 of each bin center, divided by the window length
+            gaussian: binned rates smoothed with a gaussian kernel
+        :return: (rates, edges) - rates: (segment x bin) if per_trial, else trial-averaged (bin,)
+        """
+        segs = np.asarray(segs, dtype=np.int64)
+        edges = np.arange(window[0], window[1], bin_size)
+
+        if smoothing is None or smoothing[0] == 'gaussian':
+            rates = self.counts(edges, segs) / bin_size
+            if smoothing is not None:
+                rates = gaussian_filter1d(rates.astype(float), smoothing[1] / bin_size, axis=1, mode='nearest')
+        elif smoothing[0] == 'boxcar':
+            centers = (edges[:-1] + edges[1:]) / 2
+            lo = self._edge_index(centers - smoothing[1] / 2, snap=True)
+            hi = self._edge_index(centers + smoothing[1] / 2, snap=True)
+            rates = ((self._cumulative_counts(hi, segs) - self._cumulative_counts(lo, segs))
+                     / ((hi - lo) * self.fine_bin_size))
+        else:
+            raise ValueError('Unknown smoothing: {}'.format(smoothing[0]))
+
+        return (rates if per_trial else rates.mean(axis=0)), edges
+
+
+_spike_count_cubes = {}
+
+
+def get_clustering_fingerprint(key):
+    """
+    Hash of the unit ids and clustering time(s) of the probe insertion and clustering method of "key"
+     - changes whenever the clustering results are archived and re-ingested
+    """
+    cube_key = {k: key[k] for k in ProbeSpikeCountCube.primary_key}
+    units = (ephys.Unit & cube_key).fetch('unit', order_by='unit')
+    clustering_times = sorted(set((ephys.ClusteringLabel & cube_key).fetch('clustering_time')))
+    return dict_to_hash({'units': units.tolist(), 'clustering_times': [str(t) for t in clustering_times]})
+
+
+def get_spike_count_cube(key):
+    """
+    Return the stored SpikeCountCube of the probe insertion and clustering method of "key" (e.g. a unit key),
+     or None if ProbeSpikeCountCube is not populated for it or was built from a different set of clustering results.
+    The result for the last probe is kept in memory, so that per-unit calls over the same probe query it only once
+     (see clear_spike_count_cube_cache)
+    """
+    cube_key = {k: key[k] for k in ProbeSpikeCountCube.primary_key}
+    cube_hash = dict_to_hash(cube_key)
+    if cube_hash not in _spike_count_cubes:
+        _spike_count_cubes.clear()
+        cube = None
+        stored_fingerprint = (ProbeSpikeCountCube & cube_key).fetch('clustering_fingerprint')
+        if len(stored_fingerprint):
+            if stored_fingerprint[0] == get_clustering_fingerprint(cube_key):
+                cube = ProbeSpikeCountCube.get_cube(cube_key)
+            else:
+                log.warning('ProbeSpikeCountCube of {} is out of date with the clustering results - '
+                            'ignored'.format(cube_key))
+        _spike_count_cubes[cube_hash] = cube
+    return _spike_count_cubes[cube_hash]
+
+
+def clear_spike_count_cube_cache():
+    """
+    Drop the in-memory SpikeCountCube - to be called when ProbeSpikeCountCube entries are inserted or deleted
+    """
+    _spike_count_cubes.clear()
+
+
+def compute_unit_psth(unit_key, trial_keys, per_trial=False, bin_size=None, window=None, smoothing=None):
     """
     Compute unit-level psth for the specified unit and trial-set - return (time,)
     If per_trial == True, compute trial-level psth - return ((trial x time), time_vec)
+    Derived from the ProbeSpikeCountCube of the unit's probe if populated, otherwise from the trial spikes
     :param unit_key: key of a single unit to compute the PSTH for
     :param trial_keys: list of all the trial keys to compute the PSTH over
+    :param bin_size: (s) default to UnitPsth.psth_params['binsize']
+    :param window: (xmin, xmax) in seconds, default to UnitPsth.psth_params
+    :param smoothing: None, ('boxcar', width) or ('gaussian', sigma) - see SpikeCountCube.psth()
     """
     trials = experiment.BehaviorTrial & trial_keys
 
     if ephys.ProbeInsertionQuality & unit_key:
         trials &= ephys.ProbeInsertionQuality.GoodTrial
 
-    q = (ephys.Unit.TrialSpikes & unit_key & trials)
-    if not q:
+    xmin, xmax, default_bin_size = UnitPsth.psth_params.values()
+    bin_size = bin_size or default_bin_size
+    window = window or (xmin, xmax)
+
+    edges = np.arange(window[0], window[1], bin_size)
+
+    cube = get_spike_count_cube(unit_key)
+    if cube is not None and unit_key['unit'] in cube.units and cube.is_aligned(edges):
+        segs = cube.select(unit_key['unit'], (experiment.SessionTrial & unit_key & trials).fetch('trial'))
+        if not len(segs):
+            return None, None
+        psth, edges = cube.psth(segs, bin_size, window, smoothing=smoothing, per_trial=per_trial)
+        return psth, edges[1:]
+
+    unit_trial_spikes = ephys.fetch_trial_spikes(unit_key, trials)
+    if not unit_trial_spikes or not len(unit_trial_spikes[0][-1]):
         return None, None
 
-    xmin, xmax, bin_size = UnitPsth.psth_params.values()
-    binning = np.arange(xmin, xmax, bin_size)
+    _, _, spikes = unit_trial_spikes[0]
+    psth = _spike_times_psth(spikes, edges, bin_size, smoothing=smoothing, per_trial=per_trial)
+    return psth, edges[1:]
 
-    spikes = q.fetch('spike_times')
 
-    if per_trial:
-        trial_psth = np.vstack(np.histogram(spike, bins=binning)[0] / bin_size for spike in spikes)
-        return trial_psth, binning[1:]
+def _spike_times_psth(spikes, edges, bin_size, smoothing=None, per_trial=False):
+    """
+    Same as SpikeCountCube.psth(), from the spike times (s) of each trial - for any bin edges
+    """
+    if smoothing is None or smoothing[0] == 'gaussian':
+        rates = np.vstack([np.histogram(spike, bins=edges)[0] for spike in spikes]) / bin_size
+        if smoothing is not None:
+            rates = gaussian_filter1d(rates.astype(float), smoothing[1] / bin_size, axis=1, mode='nearest')
+    elif smoothing[0] == 'boxcar':
+        centers = (edges[:-1] + edges[1:]) / 2
+        rates = np.vstack([np.searchsorted(np.sort(spike), centers + smoothing[1] / 2)
+                           - np.searchsorted(np.sort(spike), centers - smoothing[1] / 2)
+                           for spike in spikes]) / smoothing[1]
     else:
-        spikes = np.concatenate(spikes)
-        psth, edges = np.histogram(spikes, bins=binning)
-        psth = psth / len(q) / bin_size
-        return psth, edges[1:]
+        raise ValueError('Unknown smoothing: {}'.format(smoothing[0]))
+
+    return rates if per_trial else rates.mean(axis=0)
+
+
+def get_population_cache_dir():
+    """
+    retrieve the local directory where population activity tensors are cached as memory-mapped files
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'psth.population_cache_dir': '/path/string'
+        }
+        ...
+      }
+
+    default to None (no caching)
+    """
+    cache_dir = dj.config.get('custom', {}).get('psth.population_cache_dir')
+    return pathlib.Path(cache_dir) if cache_dir else None
+
+
+def compute_population_activity(units, trial_condition_names, bin_size=None, window=None):
+    """
+    Population activity tensors (unit x trial x time) of the specified units (from a single session),
+     for each of the specified trial conditions - built from one fetch of the trial spikes of all units.
+    Trials not good for a unit's probe (ProbeInsertionQuality.GoodTrial), or without trial spikes for a unit,
+     are NaN for that unit.
+    If "psth.population_cache_dir" is configured, the tensors are cached there and returned as memory-mapped arrays
+     (call clear_population_activity_cache() after re-ingesting the units)
+    :param units: list of unit_keys or a query of the ephys.Unit table
+    :param trial_condition_names: list of TrialCondition names
+    :param bin_size: (s) default to UnitPsth.psth_params['binsize']
+    :param window: (xmin, xmax) in seconds, default to UnitPsth.psth_params
+    :return: dictionary of the form:
+      {
+         'units': unit_keys (order of the unit axis),
+         'time': psth time-stamps (same as compute_unit_psth()),
+         'trials': {trial_condition_name: trial numbers (order of the trial axis)},
+         'psth': {trial_condition_name: (unit x trial x time) firing rates}
+      }
+    """
+    unit_keys, unit_uids = (ephys.Unit & units).fetch('KEY', 'unit_uid', order_by='insertion_number, unit')
+    session_key = (experiment.Session & unit_keys).fetch('KEY')
+    if len(session_key) != 1:
+        raise Exception('Units from {} sessions found'.format(len(session_key)))
+    session_key = session_key[0]
+
+    xmin, xmax, default_bin_size = UnitPsth.psth_params.values()
+    bin_size = bin_size or default_bin_size
+    window = window or (xmin, xmax)
+    edges = np.arange(window[0], window[1], bin_size)
+
+    # trials of each condition - excluding the bad trials for units of probes with ProbeInsertionQuality
+    cond_trials = {name: get_session_trial_set(TrialCondition, name, session_key)
+                   for name in trial_condition_names}
+    quality_probes = set((ephys.ProbeInsertionQuality & session_key).fetch('insertion_number'))
+    good_trials = (experiment.SessionTrial & session_key
+                   & ephys.ProbeInsertionQuality.GoodTrial).fetch('trial') if quality_probes else []
+
+    cache_dir = get_population_cache_dir()
+    cache_fps = {}
+    if cache_dir is not None:
+        units_hash = dict_to_hash({'units': list(zip(unit_keys, unit_uids)), 'good_trials': list(good_trials),
+                                   'bin_size': bin_size, 'window': window})
+        cache_fps = {name: cache_dir / 'population_{}_{}.npy'.format(units_hash, dict_to_hash(
+            {'trial_condition_name': name, 'trials': list(cond_trials[name])})) for name in trial_condition_names}
+
+    tensors, tensor_trials = {}, {}
+    cube = None
+    for name in trial_condition_names:
+        cache_fp = cache_fps.get(name)
+        if cache_fp is not None and cache_fp.exists():
+            tensors[name] = np.load(cache_fp, mmap_mode='r')
+            tensor_trials[name] = np.load(cache_fp.with_suffix('.trials.npy'))
+            continue
+
+        if cube is None:  # one fetch of the trial spikes of all units, for all conditions
+            cube = SpikeCountCube.from_trial_spikes(
+                ephys.fetch_trial_spikes(unit_keys), xmin=min(window[0], xmin), xmax=max(window[1], xmax),
+                fine_bin_size=ProbeSpikeCountCube.cube_params['fine_bin_size'])
+            unit_has_quality = np.array([k['insertion_number'] in quality_probes for k in unit_keys], dtype=bool)
+            seg_is_good = ~unit_has_quality[cube.seg_units] | np.isin(cube.seg_trials, good_trials)
+
+        segs = cube.select(trials=cond_trials[name])
+        segs = segs[seg_is_good[segs]]
+        trials = np.unique(cube.seg_trials[segs])
+
+        tensor = np.full((len(unit_keys), len(trials), len(edges) - 1), np.nan)
+        tensor[cube.seg_units[segs], np.searchsorted(trials, cube.seg_trials[segs])] = cube.counts(
+            edges, segs) / bin_size
+
+        if cache_fp is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            np.save(cache_fp.with_suffix('.trials.npy'), trials)
+            np.save(cache_fp, tensor)
+            tensor = np.load(cache_fp, mmap_mode='r')
+
+        tensors[name], tensor_trials[name] = tensor, trials
+
+    return dict(units=list(unit_keys), time=edges[1:], trials=tensor_trials, psth=tensors)
+
+
+def clear_population_activity_cache():
+    """
+    Remove the population activity tensors cached in "psth.population_cache_dir"
+    """
+    cache_dir = get_population_cache_dir()
+    if cache_dir is not None:
+        for fp in cache_dir.glob('population_*.npy'):
+            fp.unlink()
 
 
 def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
@@ -527,6 +1083,23 @@ def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
     return cd_vec / np.linalg.norm(cd_vec)
 
 
+def project_trial_psth(psth_per_trial, cd_vec):
+    """
+    Project per-trial unit psth onto the coding direction, ignoring missing (NaN) entries
+    Each (trial, time) projection uses the units present there, with the coding direction
+    renormalized over those units; NaN where no unit is present
+    :param psth_per_trial: unit# x trial# x time
+    :param cd_vec: coding direction unit-vector, length unit#
+    :return: trial# x time
+    """
+    present = ~np.isnan(psth_per_trial)
+    weights = np.where(present, cd_vec[:, None, None], 0)
+    norm = np.sqrt((weights ** 2).sum(axis=0))
+    proj = np.einsum('utk,utk->tk', np.where(present, psth_per_trial, 0), weights)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(present.any(axis=0), proj / norm * np.linalg.norm(cd_vec), np.nan)
+
+
 def compute_CD_projected_psth(units, time_period=None):
     """
     Routine for Coding Direction computation on all the units in the specified unit_keys
@@ -545,36 +1118,26 @@ def compute_CD_projected_psth(units, time_period=None):
         raise Exception('Units from multiple sessions found')
 
     # -- the computation part
-    # get units and trials - ensuring they have trial-spikes
-    contra_trials = (TrialCondition().get_trials(
-        'good_noearlylick_right_hit' if unit_hemi == 'left' else 'good_noearlylick_left_hit')
-                     & session_key & ephys.Unit.TrialSpikes).fetch('KEY')
-    ipsi_trials = (TrialCondition().get_trials(
-        'good_noearlylick_left_hit' if unit_hemi == 'left' else 'good_noearlylick_right_hit')
-                     & session_key & ephys.Unit.TrialSpikes).fetch('KEY')
-
-    # get per-trial unit psth for all units - unit# x (trial# x time)
-    contra_trial_psths, contra_edges = zip(*(compute_unit_psth(unit, contra_trials, per_trial=True)
-                                             for unit in units))
-    ipsi_trial_psths, ipsi_edges = zip(*(compute_unit_psth(unit, ipsi_trials, per_trial=True)
-                                         for unit in units))
+    # get per-trial unit psth for all units - unit# x trial# x time
+    contra_cond = 'good_noearlylick_right_hit' if unit_hemi == 'left' else 'good_noearlylick_left_hit'
+    ipsi_cond = 'good_noearlylick_left_hit' if unit_hemi == 'left' else 'good_noearlylick_right_hit'
+    population = compute_population_activity(units, [contra_cond, ipsi_cond])
+    contra_psth_per_trial = population['psth'][contra_cond]
+    ipsi_psth_per_trial = population['psth'][ipsi_cond]
+
+    # get time vector, shared by all units
+    time_stamps = population['time']
 
     # compute trial-ave unit psth
-    contra_psths = zip((p.mean(axis=0) for p in contra_trial_psths), contra_edges)
-    ipsi_psths = zip((p.mean(axis=0) for p in ipsi_trial_psths), ipsi_edges)
+    contra_psths = zip(np.nanmean(contra_psth_per_trial, axis=1), repeat(time_stamps))
+    ipsi_psths = zip(np.nanmean(ipsi_psth_per_trial, axis=1), repeat(time_stamps))
 
     # compute coding direction
     cd_vec = compute_coding_direction(contra_psths, ipsi_psths, time_period=time_period)
 
-    # get time vector, relying on all units PSTH shares the same time vector
-    time_stamps = contra_edges[0]
-
-    # get coding projection per trial - trial# x unit# x time
-    contra_psth_per_trial = np.dstack(contra_trial_psths)
-    ipsi_psth_per_trial = np.dstack(ipsi_trial_psths)
-
-    proj_contra_trial = np.vstack(np.dot(tr_u, cd_vec) for tr_u in contra_psth_per_trial)  # trial# x time
-    proj_ipsi_trial = np.vstack(np.dot(tr_u, cd_vec) for tr_u in ipsi_psth_per_trial)    # trial# x time
+    # get coding projection per trial - trial# x time
+    proj_contra_trial = project_trial_psth(contra_psth_per_trial, cd_vec)
+    proj_ipsi_trial = project_trial_psth(ipsi_psth_per_trial, cd_vec)
 
     return cd_vec, proj_contra_trial, proj_ipsi_trial, time_stamps, unit_hemi
 
@@ -5,13 +5,14 @@ import numpy as np
 import datajoint as dj
 import pandas as pd
 import statsmodels.api as sm
+import scipy.stats as sc_stats
 
 from . import (lab, experiment, ephys)
 [lab, experiment, ephys]  # NOQA
 
 from . import get_schema_name, dict_to_hash
 from pipeline import foraging_model
-from pipeline.util import _get_unit_independent_variable
+from pipeline.util import _get_unit_independent_variable, get_session_trial_set
 
 schema = dj.schema(get_schema_name('psth_foraging'))
 log = logging.getLogger(__name__)
@@ -242,6 +243,18 @@ class TrialCondition(dj.Lookup):
     def get_trials(cls, trial_condition_name, trial_offset=0):
         return cls.get_func({'trial_condition_name': trial_condition_name}, trial_offset)()
 
+    @classmethod
+    def get_session_trials(cls, trial_condition_name, session_key, trial_offset=0):
+        """
+        Same as get_trials(), but within the session of "session_key" (e.g. a unit key),
+        as a restriction of experiment.BehaviorTrial - resolved once per session and cached
+        (see util.get_session_trial_set)
+        """
+        trials = get_session_trial_set(cls, trial_condition_name, session_key, trial_offset)
+        session_key = {k: session_key[k] for k in experiment.Session.primary_key}
+        return (experiment.BehaviorTrial & session_key
+                & ('trial in ({})'.format(','.join(map(str, trials))) if len(trials) else 'FALSE'))
+
     @classmethod
     def get_cond_name_from_keywords(cls, keywords):
         matched_cond_names = []
@@ -386,6 +399,45 @@ class AlignType(dj.Lookup):
     ]
 
 
+@schema
+class UnitPeriodActivity(dj.Computed):
+    """
+    Per-trial spike counts and firing rates of all units of a probe insertion, for every PeriodForaging period
+    (see compute_unit_period_activity)
+    """
+    definition = """
+    -> ephys.ProbeInsertion
+    """
+
+    class Unit(dj.Part):
+        definition = """
+        -> master
+        -> ephys.Unit
+        -> experiment.PeriodForaging
+        ---
+        trials:             longblob    # trial numbers
+        spike_counts:       longblob    # spike count of each trial within the period
+        durations:          longblob    # (s) duration of the period in each trial
+        firing_rates:       longblob    # (spk/s) spike_counts / durations
+        """
+
+    key_source = ephys.ProbeInsertion & ephys.Unit & (experiment.BehaviorTrial & 'task LIKE "foraging%"')
+
+    def make(self, key):
+        unit_keys = (ephys.Unit & key).fetch('KEY')
+        periods = experiment.PeriodForaging.fetch('period')
+        period_activity = compute_units_period_activity(unit_keys, periods)
+
+        self.insert1(key)
+        self.Unit.insert({**unit_key, 'period': period,
+                          'trials': activity['trial'],
+                          'spike_counts': activity['spike_counts'],
+                          'durations': activity['durations'],
+                          'firing_rates': activity['firing_rates']}
+                         for period in periods
+                         for unit_key, activity in zip(unit_keys, period_activity[period]) if activity is not None)
+
+
 @schema
 class IndependentVariable(dj.Lookup):
     """
@@ -555,9 +607,139 @@ class UnitPeriodLinearFit(dj.Computed):
                                 't': model_fit.tvalues[para]
                                 })
 
+    @classmethod
+    def populate_by_probe(cls, *restrictions):
+        """
+        Probe-batched alternative to UnitPeriodLinearFit.populate(), computing the same rows as make():
+         all units of a probe insertion share the design matrix of each linear model,
+         so the fits of all units are solved at once (see fit_multi_target_ols) and inserted in bulk.
+        Units with non-finite firing rates, and models whose design matrix is non-finite or has a constant column,
+         are left to make() (statsmodels)
+        :param restrictions: restrictions on the key_source (e.g. a session or probe insertion key)
+        """
+        todo = (cls.key_source & dj.AndList(restrictions)) - cls
+        probe_keys = (ephys.ProbeInsertion & todo).fetch('KEY')
+
+        for probe_idx, probe_key in enumerate(probe_keys):
+            log.info('UnitPeriodLinearFit.populate_by_probe(): probe {}/{}: {}'.format(
+                probe_idx + 1, len(probe_keys), probe_key))
+
+            keys = (todo & probe_key).fetch('KEY')
+            has_zaber = bool(ephys.TrialEvent & probe_key & 'trial_event_type = "zaberready"')
+
+            rows, param_rows = [], []
+            for period, behavior_model in sorted(set((k['period'], k['behavior_model']) for k in keys)):
+                group_keys = [k for k in keys if k['period'] == period and k['behavior_model'] == behavior_model]
+
+                # Parse period
+                if period in ['delay'] and not has_zaber:
+                    period = period + '_bitcode'  # Manually correction of bitcodestart to zaberready, if necessary
+
+                # Parse behavioral model_id
+                if behavior_model.isnumeric():
+                    model_id = int(behavior_model)
+                else:
+                    model_id = (foraging_model.FittedSessionModelComparison.BestModel &
+                                probe_key & 'model_comparison_idx=0').fetch1(behavior_model)
+
+                # Get data - shared by all units of the probe, except for the firing rates
+                unit_keys = (ephys.Unit & group_keys).fetch('KEY')
+                unit_ids = [(k['clustering_method'], k['unit']) for k in unit_keys]
+                if UnitPeriodActivity & probe_key:
+                    period_activity = {(c, u): {'trial': t, 'firing_rates': r} for c, u, t, r in zip(
+                        *(UnitPeriodActivity.Unit & unit_keys & {'period': period}).fetch(
+                            'clustering_method', 'unit', 'trials', 'firing_rates'))}
+                    period_activity = [period_activity.get(unit_id) for unit_id in unit_ids]
+                else:
+                    period_activity = compute_units_period_activity(unit_keys, [period])[period]
+                if all(activity is None for activity in period_activity):
+                    continue
+                all_iv = _get_unit_independent_variable(probe_key, model_id=model_id)
+
+                trial = all_iv.trial  # Without ignored trials
+                activity_trials = next(a['trial'] for a in period_activity if a is not None)
+                trial_with_ephys = trial <= max(activity_trials)
+                trial = trial[trial_with_ephys]  # Truncate behavior trial to max ephys length
+                all_iv = all_iv[trial_with_ephys]  # Also truncate all ivs
+
+                # Align ephys trial and model trial, for each unit
+                is_fitted = [a is not None and np.isfinite(a['firing_rates'][trial - 1]).all()
+                             for a in period_activity]
+                if not any(is_fitted):
+                    continue
+                y = np.column_stack([a['firing_rates'][trial - 1]
+                                     for a, f in zip(period_activity, is_fitted) if f])  # trial x unit
+                fitted_units = [unit_id for unit_id, f in zip(unit_ids, is_fitted) if f]
+
+                for multi_linear_model, if_intercept in zip(*(LinearModel & group_keys).fetch(
+                        'multi_linear_model', 'if_intercept')):
+                    independent_variables = (LinearModel.X & {'multi_linear_model': multi_linear_model}).fetch('var_name')
+                    x = all_iv[independent_variables].astype(float).values
+                    if not len(x) or not np.isfinite(x).all() or (np.ptp(x, axis=0) == 0).any():
+                        log.warning('Design matrix of {} not supported - left to make()'.format(multi_linear_model))
+                        continue
+
+                    fit = fit_multi_target_ols(y, x, if_intercept)
+                    var_offset = 1 if if_intercept else 0
+
+                    for key in (k for k in group_keys if k['multi_linear_model'] == multi_linear_model
+                                and (k['clustering_method'], k['unit']) in fitted_units):
+                        u = fitted_units.index((key['clustering_method'], key['unit']))
+                        rows.append({**key,
+                                     'model_r2': fit['rsquared'][u],
+                                     'model_r2_adj': fit['rsquared_adj'][u],
+                                     'model_p': fit['f_pvalue'][u],
+                                     'actual_behavior_model': model_id})
+                        param_rows.extend({**key,
+                                           'var_name': para,
+                                           'beta': fit['params'][v + var_offset, u],
+                                           'std_err': fit['bse'][v + var_offset, u],
+                                           'p': fit['pvalues'][v + var_offset, u],
+                                           't': fit['tvalues'][v + var_offset, u]}
+                                          for v, para in enumerate(independent_variables))
+
+            with dj.conn().transaction:
+                cls.insert(rows, allow_direct_insert=True)
+                cls.Param.insert(param_rows, allow_direct_insert=True)
+
 
 # ============= Helpers =============
 
+def fit_multi_target_ols(y, x, if_intercept):
+    """
+    Ordinary least squares of all columns of "y" on the same design matrix "x", with one factorization -
+     same numbers as statsmodels OLS(y[:, i], sm.add_constant(x) if if_intercept else x).fit() for each column i
+    @param y: (trial x target)
+    @param x: (trial x variable), without constant column
+    @param if_intercept: whether to add an intercept (as the first parameter)
+    @return: dict of 'params', 'bse', 'tvalues', 'pvalues' (parameter x target)
+             and 'rsquared', 'rsquared_adj', 'f_pvalue' (target,)
+    """
+    x = np.column_stack([np.ones(len(x)), x]) if if_intercept else np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    nobs, k_constant = len(y), int(bool(if_intercept))
+
+    pinv_x = np.linalg.pinv(x, rcond=1e-15)
+    rank = np.linalg.matrix_rank(x)
+    df_resid, df_model = nobs - rank, rank - k_constant
+
+    params = pinv_x @ y
+    ssr = ((y - x @ params) ** 2).sum(axis=0)
+    tss = ((y - y.mean(axis=0)) ** 2).sum(axis=0) if k_constant else (y ** 2).sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bse = np.sqrt(np.outer(np.diag(pinv_x @ pinv_x.T), ssr / df_resid))
+        tvalues = params / bse
+        rsquared = 1 - ssr / tss
+        fvalue = ((tss - ssr) / df_model) / (ssr / df_resid)
+
+    return {'params': params, 'bse': bse, 'tvalues': tvalues,
+            'pvalues': 2 * sc_stats.t.sf(np.abs(tvalues), df_resid),
+            'rsquared': rsquared,
+            'rsquared_adj': 1 - (nobs - k_constant) / df_resid * (1 - rsquared),
+            'f_pvalue': sc_stats.f.sf(fvalue, df_model, df_resid)}
+
+
 def compute_unit_psth_and_raster(unit_key, trial_keys, align_type='go_cue', bin_size=0.04):
     """
     Align spikes of specified unit and trial-set to specified align_event_type,
@@ -580,105 +762,185 @@ def compute_unit_psth_and_raster(unit_key, trial_keys, align_type='go_cue', bin_
       }
     """
     
+    [unit_psth] = compute_units_psth_and_raster([unit_key], trial_keys, align_type=align_type, bin_size=bin_size)
+    return unit_psth
+
+
+_unit_spike_times = {}
+
+
+def _fetch_sorted_spike_times(unit_keys):
+    """
+    Session-wise spike times (sorted) of the specified units, fetched in one query
+    The spike times of the last requested units are kept in memory, so that repeated calls for
+     the same unit(s) (e.g. one per trial condition and align type in a unit report) fetch them only once
+    """
+    unit_hashes = [dict_to_hash({k: key[k] for k in ephys.Unit.primary_key}) for key in unit_keys]
+    missing = [key for key, h in zip(unit_keys, unit_hashes) if h not in _unit_spike_times]
+
+    spike_times = {h: _unit_spike_times[h] for h in unit_hashes if h in _unit_spike_times}
+    if missing:
+        for key, spikes in zip(*(ephys.Unit & missing).fetch('KEY', 'spike_times')):
+            if np.any(np.diff(spikes) < 0):
+                spikes = np.sort(spikes)
+            spike_times[dict_to_hash(key)] = spikes
+
+    _unit_spike_times.clear()
+    _unit_spike_times.update(spike_times)
+    return [spike_times.get(h) for h in unit_hashes]
+
+
+def compute_units_psth_and_raster(unit_keys, trial_keys, align_type='go_cue', bin_size=0.04):
+    """
+    Same as compute_unit_psth_and_raster(), for many units (of the same session) at once:
+     the align events are fetched once, and the spikes of each unit within the psth window of every event
+     are located with a sorted search on its spike times
+    @return: list of the dictionaries of compute_unit_psth_and_raster(), one per unit (None if no spikes/events)
+    """
     q_align_type = AlignType & {'align_type_name': align_type}
-    
-    # -- Get global times for spike and event --
-    q_spike = ephys.Unit & unit_key  # Using ephys.Unit, not ephys.Unit.TrialSpikes
+
+    # -- Get global times for event --
     q_event = ephys.TrialEvent & trial_keys & q_align_type   # Using ephys.TrialEvent, not experiment.TrialEvent
-    
-    if not q_spike or not q_event:
-        return None
+    if not q_event:
+        return [None] * len(unit_keys)
 
-    # Session-wise spike times (relative to the first sTrig, i.e. 'bitcodestart'. see line 212 of ingest.ephys)
-    spikes = q_spike.fetch1('spike_times')
-    
     # Session-wise event times (relative to session start)
     events, trials = q_event.fetch('trial_event_time', 'trial', order_by='trial asc')
     # Make event times also relative to the first sTrig
     events -= (ephys.TrialEvent & trial_keys.proj(_='trial') & {'trial_event_type': 'bitcodestart', 'trial': 1}).fetch1('trial_event_time')
     events = events.astype(float)
-    
+
     # Manual correction of trialstart, if necessary
     events += q_align_type.fetch('time_offset').astype(float)
-    
-    # -- Align spike times to each event --
+
     win = q_align_type.fetch1('psth_win')
-    spikes_aligned = []
-    for e_t in events:
-        s_t = spikes[(e_t + win[0] <= spikes) & (spikes < e_t + win[1])]
-        spikes_aligned.append(s_t - e_t)
-    
-    # -- Compute psth --
     binning = np.arange(win[0], win[1], bin_size)
-    
-    # psth (bins x 1)
-    all_spikes = np.concatenate(spikes_aligned)
-    psth, edges = np.histogram(all_spikes, bins=binning)
-    psth = psth / len(q_event) / bin_size
-    
-    # psth per trial (trial x bins)
-    psth_per_trial = np.vstack([np.histogram(trial_spike, bins=binning)[0] / bin_size for trial_spike in spikes_aligned])
+    bin_count = len(binning) - 1
+
+    unit_psths = []
+    # Session-wise spike times (relative to the first sTrig, i.e. 'bitcodestart'. see line 212 of ingest.ephys)
+    for spikes in _fetch_sorted_spike_times(unit_keys):
+        if spikes is None:
+            unit_psths.append(None)
+            continue
+
+        # -- Align spike times to each event: spikes[start:stop] are within [e_t + win[0], e_t + win[1]) --
+        starts = np.searchsorted(spikes, events + win[0], side='left')
+        stops = np.searchsorted(spikes, events + win[1], side='left')
+        counts = stops - starts
+        spike_idx = np.repeat(stops - counts.cumsum(), counts) + np.arange(counts.sum())
+        all_spikes = spikes[spike_idx] - np.repeat(events, counts)
+        spikes_aligned = np.split(all_spikes, counts.cumsum()[:-1])
+
+        # -- Compute psth --
+        # psth (bins x 1)
+        psth, _ = np.histogram(all_spikes, bins=binning)
+        psth = psth / len(events) / bin_size
 
-    # raster (all spike time, all trial number)
-    raster = [all_spikes,
-              np.concatenate([[t] * len(s)
-                              for s, t in zip(spikes_aligned, trials)])]
+        # psth per trial (trial x bins), same binning as np.histogram: [edge_i, edge_i+1), last bin closed
+        spike_bins = np.searchsorted(binning, all_spikes, side='right') - 1
+        spike_bins[all_spikes == binning[-1]] = bin_count - 1
+        in_bins = (spike_bins >= 0) & (spike_bins < bin_count)
+        spike_events = np.repeat(np.arange(len(events)), counts)
+        psth_per_trial = np.bincount(spike_events[in_bins] * bin_count + spike_bins[in_bins],
+                                     minlength=len(events) * bin_count).reshape(-1, bin_count) / bin_size
 
-    return dict(bins=binning[1:], trials=trials, spikes_aligned=spikes_aligned,
-                psth=psth, psth_per_trial=psth_per_trial, raster=raster)
+        # raster (all spike time, all trial number)
+        raster = [all_spikes, np.repeat(trials, counts)]
+
+        unit_psths.append(dict(bins=binning[1:], trials=trials, spikes_aligned=spikes_aligned,
+                               psth=psth, psth_per_trial=psth_per_trial, raster=raster))
+
+    return unit_psths
 
 
 def compute_unit_period_activity(unit_key, period):
     """
     Given unit and period, compute average firing rate over trials
-    I tried to put this in a table, but it's too slow... (too many elements)
+    Read from UnitPeriodActivity if populated, otherwise computed by compute_units_period_activity()
     @param unit_key:
     @param period: -> experiment.PeriodForaging, or arbitrary list in the same format
     @return: DataFrame(trial, spike_count, duration, firing_rate)
     """
+    if isinstance(period, str):
+        q_activity = UnitPeriodActivity.Unit & unit_key & {'period': period}
+        if q_activity:
+            trials, spike_counts, durations, firing_rates = q_activity.fetch1(
+                'trials', 'spike_counts', 'durations', 'firing_rates')
+            return {'trial': trials, 'spike_counts': spike_counts,
+                    'durations': durations, 'firing_rates': firing_rates}
+
+    [activity] = compute_units_period_activity([unit_key], [period])[period if isinstance(period, str) else 0]
+    return activity
 
-    q_spike = ephys.Unit & unit_key
-    q_event = ephys.TrialEvent & unit_key
-    if not q_spike or not q_event:
-        return None
+
+def compute_units_period_activity(unit_keys, periods):
+    """
+    Vectorized engine of compute_unit_period_activity(), for many units (of the same session) and periods:
+     the event times of the session are fetched once per period, and the spikes of each unit
+     within the period of every trial are counted with a sorted search on its spike times
+    @param unit_keys: list of unit keys
+    @param periods: list of periods (-> experiment.PeriodForaging, or arbitrary list in the same format)
+    @return: {period (or its index, if not a period name): [dict(trial, spike_counts, durations, firing_rates)
+              - one per unit, None if no spikes/events]}
+    """
+    period_ids = [period if isinstance(period, str) else idx for idx, period in enumerate(periods)]
+
+    q_event = ephys.TrialEvent & unit_keys
+    if not q_event:
+        return {period_id: [None] * len(unit_keys) for period_id in period_ids}
 
     # for (the very few) sessions without zaber feedback signal, use 'bitcodestart' with manual correction
-    if period == 'delay' and \
-            not q_event & 'trial_event_type = "zaberready"':
-        period = 'delay_bitcode'
-
-    # -- Fetch global session times of given period, for each trial --
-    try:
-        (start_event_type, start_trial_shift, start_time_shift,
-         end_event_type, end_trial_shift, end_time_shift) = (experiment.PeriodForaging & {'period': period}
-                  ).fetch1('start_event_type', 'start_trial_shift', 'start_time_shift',
-                           'end_event_type', 'end_trial_shift', 'end_time_shift')
-    except:
-        (start_event_type, start_trial_shift, start_time_shift,
-         end_event_type, end_trial_shift, end_time_shift) = period
-    
-    start = {k['trial']: float(k['start_event_time'])
-             for k in (q_event & {'trial_event_type': start_event_type}).proj(
-            start_event_time=f'trial_event_time + {start_time_shift}').fetch(as_dict=True)}
-    end = {k['trial']: float(k['end_event_time'])
-             for k in (q_event & {'trial_event_type': end_event_type}).proj(
-            end_event_time=f'trial_event_time + {end_time_shift}').fetch(as_dict=True)}
-
-    # Handle edge effects due to trial shift
-    trials = np.array(list(start.keys()))
-    actual_trials = trials[(trials <= max(trials) - end_trial_shift) &
-                           (trials >= min(trials) - start_trial_shift)]
-
-    # -- Fetch and count spikes --
-    spikes = q_spike.fetch1('spike_times')
-    spike_counts, durations = [], []
-
-    for trial in actual_trials:
-        t_s = start[trial + start_trial_shift]
-        t_e = end[trial + end_trial_shift]
-
-        spike_counts.append(((t_s <= spikes) & (spikes < t_e)).sum())  # Much faster than sum(... & ...) (python sum on np array)!!
-        durations.append(t_e - t_s)
-
-    return {'trial': actual_trials, 'spike_counts': np.array(spike_counts),
-            'durations': np.array(durations), 'firing_rates': np.array(spike_counts) / np.array(durations)}
+    has_zaber = bool(q_event & 'trial_event_type = "zaberready"')
+
+    # -- Fetch global session times of given event type and time shift, for each trial --
+    event_times = {}
+
+    def get_event_times(event_type, time_shift):
+        if (event_type, time_shift) not in event_times:
+            trials, times = (q_event & {'trial_event_type': event_type}).proj(
+                event_time=f'trial_event_time + {time_shift}').fetch(
+                'trial', 'event_time', order_by='trial, trial_event_id')
+            event_times[(event_type, time_shift)] = dict(zip(trials, (float(t) for t in times)))
+        return event_times[(event_type, time_shift)]
+
+    unit_spikes = _fetch_sorted_spike_times(unit_keys)
+
+    period_activity = {}
+    for period_id, period in zip(period_ids, periods):
+        if period == 'delay' and not has_zaber:
+            period = 'delay_bitcode'
+
+        if isinstance(period, str):
+            (start_event_type, start_trial_shift, start_time_shift,
+             end_event_type, end_trial_shift, end_time_shift) = (experiment.PeriodForaging & {'period': period}
+                      ).fetch1('start_event_type', 'start_trial_shift', 'start_time_shift',
+                               'end_event_type', 'end_trial_shift', 'end_time_shift')
+        else:
+            (start_event_type, start_trial_shift, start_time_shift,
+             end_event_type, end_trial_shift, end_time_shift) = period
+
+        start = get_event_times(start_event_type, start_time_shift)
+        end = get_event_times(end_event_type, end_time_shift)
+
+        # Handle edge effects due to trial shift
+        trials = np.array(list(start.keys()))
+        actual_trials = trials[(trials <= max(trials) - end_trial_shift) &
+                               (trials >= min(trials) - start_trial_shift)]
+
+        t_s = np.array([start[trial + start_trial_shift] for trial in actual_trials], dtype=float)
+        t_e = np.array([end[trial + end_trial_shift] for trial in actual_trials], dtype=float)
+        durations = t_e - t_s
+
+        # -- Count spikes: number of spikes in [t_s, t_e) of each trial --
+        period_activity[period_id] = []
+        for spikes in unit_spikes:
+            if spikes is None:
+                period_activity[period_id].append(None)
+                continue
+            spike_counts = np.maximum(np.searchsorted(spikes, t_e, side='left')
+                                      - np.searchsorted(spikes, t_s, side='left'), 0)
+            period_activity[period_id].append({'trial': actual_trials, 'spike_counts': spike_counts,
+                                               'durations': durations, 'firing_rates': spike_counts / durations})
+
+    return period_activity
@@ -462,6 +462,9 @@ def populate_psth(populate_settings={'reserve_jobs': True, 'display_progress': T
     psth.UnitSelectivity.populate(**populate_settings)
 
     # Foraging task
+    log.info('psth_foraging.UnitPeriodActivity.populate()')
+    psth_foraging.UnitPeriodActivity.populate(**populate_settings)
+
     log.info('psth_foraging.UnitPeriodLinearFit.populate()')
     psth_foraging.UnitPeriodLinearFit.populate(**populate_settings)
 
@@ -1,6 +1,12 @@
+import logging
+import pathlib
 import numpy as np
+import pandas as pd
 import datajoint as dj
 from . import (lab, experiment, ephys, foraging_model, foraging_analysis)
+from . import dict_to_hash
+
+log = logging.getLogger(__name__)
 
 
 def _get_units_hemisphere(units):
@@ -64,56 +70,105 @@ def _get_clustering_method(probe_insertion):
 def _get_unit_independent_variable(unit_key, model_id, var_name=None):
     """
     Get independent variable over trial for a specified unit (ignored trials are skipped)
+    The DataFrame depends only on the session, model and hemisphere of the unit,
+     and is built once per process (see build_session_independent_variables)
     @param unit_key:
     @param model_id:
     @param var_name
     @return: DataFrame (trial, variables)
     """
-
     hemi = _get_units_hemisphere(unit_key)
-    contra, ipsi = ['right', 'left'] if hemi == 'left' else ['left', 'right']
+    session_key = {k: unit_key[k] for k in experiment.Session.primary_key}
+    cache_key = (dict_to_hash(session_key), model_id, hemi)
+
+    if cache_key not in _independent_variable_frames:
+        build_session_independent_variables(session_key, model_ids=[model_id])
+
+    df = _independent_variable_frames[cache_key]
+    return df.copy() if var_name is None else df[['trial', var_name]].copy()
+
 
-    # Get latent variables from model fitting
-    q_latent_variable = (foraging_model.FittedSessionModel.TrialLatentVariable
-                         & unit_key
-                         & {'model_id': model_id})
+# ---- Session-level cache of independent-variable frames ----
+
+_independent_variable_frames = {}
+
+
+def build_session_independent_variables(session_key, model_ids=None):
+    """
+    Build the independent-variable DataFrames of _get_unit_independent_variable() for a session,
+     for the specified (default: all fitted) models and both hemispheres, from one fetch of the latent variables
+     and one fetch of the choices and outcomes - and cache them for the rest of the process
+    (call clear_independent_variable_cache() after re-fitting the models of the session)
+    @param session_key:
+    @param model_ids: list of model_id
+    """
+    session_key = {k: session_key[k] for k in experiment.Session.primary_key}
+    session_hash = dict_to_hash(session_key)
 
-    # Flatten latent variables to generate columns like 'left_action_value', 'right_choice_prob'
+    q_latent_variable = foraging_model.FittedSessionModel.TrialLatentVariable & session_key
+    if model_ids is not None:
+        q_latent_variable &= [{'model_id': model_id} for model_id in model_ids]
     latent_variables = q_latent_variable.heading.secondary_attributes
-    q_latent_variable_all = dj.U('trial') & q_latent_variable
-    for lv in latent_variables:
-        for prefix, side in zip(['left_', 'right_', 'contra_', 'ipsi_'],
-                                ['left', 'right', contra, ipsi]):
-            # Better way here?
-            q_latent_variable_all *= eval(f"(q_latent_variable & {{'water_port': '{side}'}}).proj({prefix}{lv}='{lv}', {prefix}='water_port')")
-
-    # Add relative and total value
-    q_latent_variable_all = q_latent_variable_all.proj(...,
-                                                       relative_action_value_lr='right_action_value - left_action_value',
-                                                       relative_action_value_ic='contra_action_value - ipsi_action_value',
-                                                       total_action_value='contra_action_value + ipsi_action_value')
-
-    # Add choice
-    q_independent_variable = (q_latent_variable_all * experiment.WaterPortChoice).proj(...,
-                                                                                       choice='water_port',
-                                                                                       choice_lr='water_port="right"',
-                                                                                       choice_ic=f'water_port="{contra}"')
-
-    # Add reward
-    q_independent_variable = (q_independent_variable * experiment.BehaviorTrial.proj('outcome')).proj(...,
-                                                                                                       reward='outcome="hit"'
-                                                                                                       )
-
-    df = q_independent_variable.fetch(format='frame', order_by='trial').reset_index()
-    
-    # Compute RPE
-    df['rpe'] = np.nan
-    df.loc[0, 'rpe'] = df.reward[0]
-    for side in ['left', 'right']:
-        _idx = df[(df.choice == side) & (df.trial > 1)].index
-        df.loc[_idx, 'rpe'] = df.reward.iloc[_idx] - df[f'{side}_action_value'].iloc[_idx - 1].values
-
-    return df if var_name is None else df[['trial', var_name]]
+
+    lv_df = q_latent_variable.fetch(format='frame', order_by='model_id, trial').reset_index()
+    choice_df = (experiment.WaterPortChoice * experiment.BehaviorTrial.proj('outcome') & session_key).fetch(
+        format='frame', order_by='trial').reset_index()[['trial', 'water_port', 'outcome']]
+
+    model_ids = model_ids if model_ids is not None else sorted(set(lv_df.model_id))
+    for model_id in model_ids:
+        model_lv_df = lv_df[lv_df.model_id == model_id]
+
+        for hemi in ('left', 'right'):
+            contra, ipsi = ['right', 'left'] if hemi == 'left' else ['left', 'right']
+
+            # Flatten latent variables to generate columns like 'left_action_value', 'right_choice_prob'
+            df = pd.DataFrame(index=pd.Index(np.unique(model_lv_df.trial), name='trial'))
+            for prefix, side in zip(['left_', 'right_', 'contra_', 'ipsi_'],
+                                    ['left', 'right', contra, ipsi]):
+                side_df = model_lv_df[model_lv_df.water_port == side].set_index('trial')[latent_variables]
+                df = df.join(side_df.add_prefix(prefix), how='inner')
+                df[prefix] = side
+
+            # Add relative and total value
+            df['relative_action_value_lr'] = df.right_action_value - df.left_action_value
+            df['relative_action_value_ic'] = df.contra_action_value - df.ipsi_action_value
+            df['total_action_value'] = df.contra_action_value + df.ipsi_action_value
+
+            # Add choice and reward
+            df = df.join(choice_df.set_index('trial'), how='inner').rename(columns={'water_port': 'choice'})
+            df['choice_lr'] = (df.choice == 'right').astype(int).where(df.choice.notna())
+            df['choice_ic'] = (df.choice == contra).astype(int).where(df.choice.notna())
+            df['reward'] = (df.outcome == 'hit').astype(int)
+
+            df = df.reset_index().assign(**session_key, model_id=model_id)
+            df = df[['subject_id', 'session', 'model_id'] + [c for c in df.columns
+                                                             if c not in ('subject_id', 'session', 'model_id')]]
+
+            # Compute RPE - reward minus the action value of the chosen side on the previous trial (row)
+            df['rpe'] = np.nan
+            if len(df):
+                for side in ['left', 'right']:
+                    is_side = ((df.choice == side) & (df.trial > 1)).values
+                    df.loc[is_side, 'rpe'] = (df.reward.values
+                                              - np.roll(df[f'{side}_action_value'].values, 1))[is_side]
+                if not ((df.choice.iloc[0] in ('left', 'right')) and df.trial.iloc[0] > 1):
+                    df.loc[0, 'rpe'] = df.reward[0]
+
+            _independent_variable_frames[(session_hash, model_id, hemi)] = df
+
+
+def clear_independent_variable_cache(session_key=None):
+    """
+    Clear the process-level independent-variable frames (e.g. after re-fitting the models of a session)
+    :param session_key: only clear the frames of this session (default: clear all)
+    """
+    if session_key is None:
+        _independent_variable_frames.clear()
+        return
+
+    session_hash = dict_to_hash({k: session_key[k] for k in experiment.Session.primary_key})
+    for cache_key in [k for k in _independent_variable_frames if k[0] == session_hash]:
+        del _independent_variable_frames[cache_key]
 
 
 def _get_sess_info(sess_key):
@@ -125,6 +180,121 @@ def _get_sess_info(sess_key):
            f"(adj. {s['session_foraging_eff_optimal_random_seed']*100 if s['session_foraging_eff_optimal_random_seed'] is not None else -1:.3g}%)"
 
 
+# ---- Per-session trial-set cache for TrialCondition ----
+
+_trial_condition_hashes = {}
+_session_trial_fingerprints = {}
+_trial_set_cache = {}
+
+
+def get_trial_set_cache_dir():
+    """
+    retrieve the local directory for the on-disk layer of the trial-set cache
+    config should be in dj.config of the format:
+
+      dj.config = {
+        ...,
+        'custom': {
+          'trial_condition.cache_dir': '/path/string'
+        }
+        ...
+      }
+
+    default to None (in-memory cache only)
+    """
+    cache_dir = dj.config.get('custom', {}).get('trial_condition.cache_dir')
+    return pathlib.Path(cache_dir) if cache_dir else None
+
+
+def _get_session_trial_fingerprint(session_key):
+    """
+    Checksum of the trial-defining content of a session (BehaviorTrial, WaterPortChoice, PhotostimEvent,
+    Photostim, PhotostimBrainRegion) - computed server-side in a single aggregate query, once per session per process
+    (call clear_trial_set_cache() after modifying these tables of a session in the same process)
+    """
+    session_hash = dict_to_hash(session_key)
+    if session_hash not in _session_trial_fingerprints:
+        q_fingerprint = experiment.Session.proj() & session_key
+        for idx, tbl in enumerate((experiment.BehaviorTrial, experiment.WaterPortChoice, experiment.PhotostimEvent,
+                                   experiment.Photostim, experiment.PhotostimBrainRegion)):
+            attrs = ['`{}`'.format(a) for a in tbl.heading.names
+                     if a not in experiment.Session.primary_key and not tbl.heading.attributes[a].is_blob]
+            q_fingerprint = q_fingerprint.aggr(tbl, ..., keep_all_rows=True, **{
+                'count_{}'.format(idx): 'count(*)',
+                'checksum_{}'.format(idx): 'sum(crc32(concat_ws(",", {})))'.format(', '.join(attrs))})
+        fingerprint = q_fingerprint.fetch1()
+        if not fingerprint['count_0']:
+            return dict_to_hash(fingerprint)  # not ingested yet - do not memoize
+        _session_trial_fingerprints[session_hash] = dict_to_hash(fingerprint)
+    return _session_trial_fingerprints[session_hash]
+
+
+def get_session_trial_set(trial_condition, trial_condition_name, session_key, trial_offset=0):
+    """
+    Resolve a TrialCondition to the sorted trial numbers of a single session,
+    memoized per (trial_condition_hash, session, trial_offset)
+
+    The cache is held in process memory and, if "trial_condition.cache_dir" is configured, on disk.
+    Entries are keyed on a checksum of the session's trial tables (see _get_session_trial_fingerprint),
+    so disk entries of an earlier version of the session's trials are left unused by new processes
+    (delete the cache directory to reclaim their disk space)
+
+    :param trial_condition: psth.TrialCondition or psth_foraging.TrialCondition
+    :param trial_condition_name: name of the trial condition
+    :param session_key: a dict containing the experiment.Session primary key (e.g. a unit key)
+    :param trial_offset: trial offset (psth_foraging.TrialCondition only)
+    :return: np.array of trial numbers
+    """
+    session_key = {k: session_key[k] for k in experiment.Session.primary_key}
+
+    cond_key = (trial_condition.full_table_name, trial_condition_name)
+    if cond_key not in _trial_condition_hashes:
+        _trial_condition_hashes[cond_key] = (trial_condition & {
+            'trial_condition_name': trial_condition_name}).fetch1('trial_condition_hash')
+    cond_hash = _trial_condition_hashes[cond_key]
+
+    fingerprint = _get_session_trial_fingerprint(session_key)
+    cache_key = (cond_hash, dict_to_hash(session_key), trial_offset, fingerprint)
+
+    if cache_key not in _trial_set_cache:
+        cache_dir = get_trial_set_cache_dir()
+        cache_fp = (cache_dir / 'trials_{}_{}_{}_{}.npy'.format(*cache_key)
+                    if cache_dir is not None else None)
+
+        if cache_fp is not None and cache_fp.exists():
+            trials = np.load(cache_fp)
+        else:
+            trials = trial_condition.get_trials(trial_condition_name, *(
+                [trial_offset] if trial_offset else []))
+            trials = (experiment.BehaviorTrial & session_key & trials).fetch(
+                'trial', order_by='trial').astype(int)
+            if cache_fp is not None:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                np.save(cache_fp, trials)
+
+        trials.flags.writeable = False  # shared between callers
+        _trial_set_cache[cache_key] = trials
+
+    return _trial_set_cache[cache_key]
+
+
+def clear_trial_set_cache(session_key=None):
+    """
+    Clear the process-level trial-set cache (e.g. after (re)ingesting trials of a session)
+    :param session_key: only clear the entries of this session (default: clear all)
+    """
+    if session_key is None:
+        _trial_condition_hashes.clear()
+        _session_trial_fingerprints.clear()
+        _trial_set_cache.clear()
+        return
+
+    session_hash = dict_to_hash({k: session_key[k] for k in experiment.Session.primary_key})
+    _session_trial_fingerprints.pop(session_hash, None)
+    for cache_key in [k for k in _trial_set_cache if k[1] == session_hash]:
+        del _trial_set_cache[cache_key]
+
+
 from . import psth, psth_foraging
 
 def _get_ephys_trial_event_times(all_align_types, align_to, trial_keys):
@@ -171,3 +341,4 @@ def _get_stim_onset_time(units, trial_cond_name):
                    & psth_schema.TrialCondition().get_trials(trial_cond_name) & units).proj(
         stim_onset_from_go='photostim_event_time - go_time').fetch('stim_onset_from_go')
     return np.nanmean(stim_onsets.astype(float))
+
@@ -0,0 +1,32 @@
+import numpy as np
+
+from pipeline.model.bandit_model import BanditModel, BanditModelBatch, BATCH_FORAGERS
+from pipeline.model.bandit_model_comparison import MODELS
+
+
+def test_batch_replays_as_bandit_model():
+    ''' each agent of a batch simulation has the latent variables of BanditModel fitted to its own histories '''
+    rng = np.random.RandomState(0)
+    n_agents, n_trials = 4, 300
+
+    for forager, para_names, lower_bounds, higher_bounds in (model[:4] for model in MODELS):
+        assert forager in BATCH_FORAGERS, forager
+        paras = dict(zip(para_names, rng.uniform(lower_bounds, higher_bounds, (n_agents, len(para_names))).T))
+        batch = BanditModelBatch(forager, n_agents, n_trials=n_trials, seeds=range(n_agents), **paras)
+        batch.simulate()
+
+        for agent in range(n_agents):
+            bandit = BanditModel(forager, **{name: value[agent] for name, value in paras.items()},
+                                 fit_choice_history=batch.choice_history[agent][:, :n_trials],
+                                 fit_reward_history=batch.reward_history[agent][:, :n_trials],
+                                 fit_iti=np.ones(n_trials))
+            bandit.simulate()
+
+            if forager == 'LossCounting':
+                assert np.allclose(np.abs(bandit.loss_count[0]), np.abs(batch.loss_count[agent, 0])), forager
+                continue
+
+            assert np.allclose(bandit.q_estimation, batch.q_estimation[agent], equal_nan=True), forager
+            if forager != 'RW1972_epsi':   # random tie breaks in the fitting mode
+                assert np.allclose(bandit.predictive_choice_prob[:, :n_trials],
+                                   batch.choice_prob[agent][:, :n_trials]), forager
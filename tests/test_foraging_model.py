@@ -0,0 +1,16 @@
+import pytest
+
+try:
+    from pipeline import foraging_model
+except Exception as e:  # foraging_model declares its schema on import
+    pytest.skip('pipeline.foraging_model unavailable: {}'.format(e), allow_module_level=True)
+
+
+def test_order_fitting_jobs_longest_first():
+    keys = [{'subject_id': 1, 'session': session, 'model_id': model_id}
+            for session in (1, 2) for model_id in (1, 2, 3)]
+    costs = [3., 10., 1., 10., 0., 5.]
+
+    ordered = foraging_model.order_fitting_jobs(keys, costs)
+
+    assert ordered == [keys[1], keys[3], keys[5], keys[0], keys[2], keys[4]]   # ties keep their order
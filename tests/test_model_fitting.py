@@ -0,0 +1,31 @@
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+
+from pipeline.model.bandit_model import BanditModel
+from pipeline.model.fitting_functions import cross_validate_bandit
+
+
+def _simulated_session(n_trials=300):
+    np.random.seed(0)
+    bandit = BanditModel('RW1972_epsi', learn_rate=0.3, epsilon=0.2, biasL=0.1, n_trials=n_trials)
+    bandit.simulate()
+    return bandit.choice_history[:, :-1], bandit.reward_history[:, :-1]
+
+
+def test_cross_validate_bandit_serial_equals_executor():
+    ''' same seed gives the same cross-validation whether the folds run serially or in an executor '''
+    choice_history, reward_history = _simulated_session()
+    args = ('RW1972_epsi', ['learn_rate', 'epsilon', 'biasL'], [[0, 0, -0.5], [1, 1, 0.5]],
+            choice_history, reward_history)
+
+    serial = cross_validate_bandit(*args, DE_pop_size=4, DE_vectorized=True, seed=5, if_verbose=False)
+
+    global_state = np.random.get_state()[1].copy()
+    with ProcessPoolExecutor(2) as executor:
+        parallel = cross_validate_bandit(*args, DE_pop_size=4, DE_vectorized=True, seed=5,
+                                         fold_executor=executor, if_verbose=False)
+
+    assert serial == parallel
+    assert np.array_equal(np.random.get_state()[1], global_state)  # global RNG left untouched
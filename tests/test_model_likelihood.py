@@ -0,0 +1,69 @@
+
+import numpy as np
+
+from pipeline.model.bandit_model import BanditModel
+from pipeline.model.bandit_model_comparison import MODELS
+from pipeline.model.fitting_functions import negLL_func, negLL_func_population
+from pipeline.model.likelihood import predictive_choice_prob, predictive_choice_prob_population
+
+
+def _random_histories(rng, n_trials=300, K=2):
+    choice_history = rng.randint(K, size=(1, n_trials))
+    reward_history = np.zeros([K, n_trials])
+    reward_history[choice_history[0], np.arange(n_trials)] = rng.rand(n_trials) < 0.4
+    iti = rng.exponential(5, n_trials) + 1
+    return choice_history, reward_history, iti
+
+
+def _random_paras(rng, model):
+    _, para_names, lower_bounds, higher_bounds = model[:4]
+    return [dict(zip(para_names, values)) for values in
+            (lower_bounds, higher_bounds, rng.uniform(lower_bounds, higher_bounds),
+             rng.uniform(lower_bounds, higher_bounds))]
+
+
+def test_predictive_choice_prob_equals_bandit_model():
+    ''' the likelihood engine reproduces BanditModel's predictive choice probability for every model '''
+    rng = np.random.RandomState(0)
+
+    for model in MODELS:
+        forager = model[0]
+        choice_history, reward_history, iti = _random_histories(rng)
+
+        for paras in _random_paras(rng, model):
+            np.random.seed(1)  # same random tie breaks (RW1972_epsi) in both
+            bandit = BanditModel(forager=forager, **paras, fit_choice_history=choice_history,
+                                 fit_reward_history=reward_history, fit_iti=iti)
+            bandit.simulate()
+
+            np.random.seed(1)
+            prob = predictive_choice_prob(forager, choice_history, reward_history, iti, **paras)
+
+            assert np.allclose(prob, bandit.predictive_choice_prob, rtol=1e-10, atol=1e-12, equal_nan=True), \
+                '{} {}'.format(forager, paras)
+
+
+def test_population_equals_single_set():
+    ''' population likelihoods equal those of each parameter set in turn, random tie breaks included '''
+    rng = np.random.RandomState(0)
+
+    for model in MODELS:
+        forager, para_names = model[:2]
+        choice_history, reward_history, iti = _random_histories(rng)
+        paras = _random_paras(rng, model)
+        fit_values = np.array([[p[name] for p in paras] for name in para_names])   # [n_paras, n_population]
+
+        np.random.seed(1)
+        prob = predictive_choice_prob_population(forager, choice_history, reward_history, iti,
+                                                 **dict(zip(para_names, fit_values)))
+        np.random.seed(1)
+        single_prob = [predictive_choice_prob(forager, choice_history, reward_history, iti, **p) for p in paras]
+        assert np.allclose(prob, single_prob, rtol=1e-10, atol=1e-12, equal_nan=True), forager
+
+        for fit_set in ([], np.arange(0, choice_history.shape[1], 3)):
+            args = (forager, para_names, choice_history, reward_history, iti, None, {}, fit_set)
+            np.random.seed(1)
+            negLL = negLL_func_population(fit_values, *args)
+            np.random.seed(1)
+            single_negLL = [negLL_func(fit_value, *args) for fit_value in fit_values.T]
+            assert np.allclose(negLL, single_negLL, rtol=1e-10, equal_nan=True), forager
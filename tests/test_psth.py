@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+try:
+    from pipeline import psth
+except Exception as e:  # psth declares its schema on import
+    pytest.skip('pipeline.psth unavailable: {}'.format(e), allow_module_level=True)
+
+
+def _population(n_units=5, n_trials=8, n_times=20):
+    rng = np.random.RandomState(0)
+    psth_per_trial = rng.poisson(5, (n_units, n_trials, n_times)).astype(float)
+    cd_vec = rng.randn(n_units)
+    return psth_per_trial, cd_vec / np.linalg.norm(cd_vec)
+
+
+def test_project_trial_psth_complete_matches_dot_product():
+    psth_per_trial, cd_vec = _population()
+    np.testing.assert_allclose(psth.project_trial_psth(psth_per_trial, cd_vec),
+                               np.einsum('utk,u->tk', psth_per_trial, cd_vec))
+
+
+def test_project_trial_psth_missing_unit_trial():
+    ''' a unit missing from one trial leaves the other trials untouched and renormalizes that trial '''
+    psth_per_trial, cd_vec = _population()
+    full = np.einsum('utk,u->tk', psth_per_trial, cd_vec)
+    psth_per_trial[1, 3] = np.nan
+    psth_per_trial[:, 6] = np.nan
+
+    proj = psth.project_trial_psth(psth_per_trial, cd_vec)
+
+    others = [t for t in range(psth_per_trial.shape[1]) if t not in (3, 6)]
+    np.testing.assert_allclose(proj[others], full[others])
+
+    present = np.arange(len(cd_vec)) != 1
+    cd_present = cd_vec[present]
+    np.testing.assert_allclose(proj[3], cd_present @ psth_per_trial[present, 3] / np.linalg.norm(cd_present))
+    assert np.all(np.isfinite(proj[3]))
+    assert np.all(np.isnan(proj[6]))
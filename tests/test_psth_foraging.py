@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+sm = pytest.importorskip('statsmodels.api')
+
+try:
+    from pipeline import psth_foraging
+except Exception as e:  # psth_foraging declares its schema on import
+    pytest.skip('pipeline.psth_foraging unavailable: {}'.format(e), allow_module_level=True)
+
+
+@pytest.mark.parametrize('if_intercept', [True, False])
+def test_fit_multi_target_ols_matches_statsmodels(if_intercept):
+    rng = np.random.RandomState(0)
+    x = rng.randn(200, 3)
+    y = 0.5 + x @ rng.randn(3, 4) + rng.randn(200, 4)
+    y[:, -1] = rng.randn(200)  # a target unrelated to x
+
+    fit = psth_foraging.fit_multi_target_ols(y, x, if_intercept)
+
+    for target in range(y.shape[1]):
+        expected = sm.OLS(y[:, target], sm.add_constant(x) if if_intercept else x).fit()
+        for attr in ('params', 'bse', 'tvalues', 'pvalues'):
+            np.testing.assert_allclose(fit[attr][:, target], getattr(expected, attr), rtol=1e-8, err_msg=attr)
+        for attr in ('rsquared', 'rsquared_adj', 'f_pvalue'):
+            np.testing.assert_allclose(fit[attr][target], getattr(expected, attr), rtol=1e-8, err_msg=attr)